@@ -1,33 +1,277 @@
+import numpy as np
 import pandas as pd
 from datetime import datetime, timedelta
 import logging
-from collections import defaultdict
+import hashlib
+import json
+import os
+import threading
+from collections import Counter, OrderedDict, defaultdict
+from concurrent.futures import ProcessPoolExecutor
 
-import nltk
-from nltk.sentiment.vader import SentimentIntensityAnalyzer
-import torch
-from sentence_transformers import SentenceTransformer
-from transformers import BartTokenizer, BartForConditionalGeneration
-from bertopic import BERTopic
-from bertopic.representation import KeyBERTInspired, MaximalMarginalRelevance, PartOfSpeech
-from umap import UMAP
-from hdbscan import HDBSCAN
-from sklearn.feature_extraction.text import CountVectorizer
+# nltk, torch, transformers, sentence_transformers, bertopic, umap, hdbscan and 
+# sklearn are imported inside the functions that use them, so that importing 
+# this module (e.g. for an ingest and sentiment run) stays fast and light
 
+from model_registry import registry
+from telemetry import recorder
+from dedup import find_near_duplicates
+from records import CommentBatch
 
+# fp32 PyTorch, dynamically quantised int8 PyTorch, or an exported ONNX Runtime session
+INFERENCE_BACKENDS = ('torch', 'int8', 'onnx')
+
+
+def load_sentiment_analyser():
+    """VADER analyser, shared through the model registry."""
+    from nltk.sentiment.vader import SentimentIntensityAnalyzer
+    return registry.get(('vader',), SentimentIntensityAnalyzer)
+
+def set_torch_threads(intra_op_threads:int=None, inter_op_threads:int=None):
+    """PyTorch CPU thread counts, for the whole process. None leaves a count unchanged."""
+    import torch
+    if intra_op_threads:
+        torch.set_num_threads(intra_op_threads)
+    if inter_op_threads and torch.get_num_interop_threads() != inter_op_threads:
+        try:
+            torch.set_num_interop_threads(inter_op_threads)
+        except RuntimeError:
+            # Can only be set before PyTorch first runs ops in parallel
+            logging.warning(f"Could not set PyTorch inter-op threads to {inter_op_threads}; "
+                            f"keeping {torch.get_num_interop_threads()}.")
+
+def onnx_session_options(intra_op_threads:int=None, inter_op_threads:int=None):
+    """ONNX Runtime session options with full graph optimisation and the given thread counts."""
+    import onnxruntime as ort
+    session_options = ort.SessionOptions()
+    session_options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    if intra_op_threads:
+        session_options.intra_op_num_threads = intra_op_threads
+    if inter_op_threads:
+        # Inter-op threads are only used to run independent nodes in parallel
+        session_options.execution_mode = ort.ExecutionMode.ORT_PARALLEL
+        session_options.inter_op_num_threads = inter_op_threads
+    return session_options
+
+def quantise_int8(model):
+    """Dynamic int8 quantisation of a torch model's Linear layers, for CPU inference."""
+    import torch
+    return torch.quantization.quantize_dynamic(model.eval(), {torch.nn.Linear}, dtype=torch.qint8)
+
+def check_backend(backend:str):
+    if backend not in INFERENCE_BACKENDS:
+        raise ValueError(f"Unknown inference backend '{backend}', expected one of {INFERENCE_BACKENDS}")
+
+def model_key(name:str, model_path:str, backend:str, intra_op_threads:int=None, inter_op_threads:int=None)->tuple:
+    """Registry key of a model. ONNX sessions fix their thread counts when created, so they are part of its key."""
+    if backend == 'onnx':
+        return (name, model_path, backend, intra_op_threads, inter_op_threads)
+    return (name, model_path, backend)
+
+def embedding_cache_name(model_path:str, backend:str='torch')->str:
+    """
+    Model name embeddings are cached under. Other backends don't give 
+    bit-identical embeddings, so they are cached separately from fp32's.
+    """
+    return model_path if backend == 'torch' else f"{model_path}:{backend}"
+
+def load_embedding_model(model_path:str, backend:str='torch', intra_op_threads:int=None, inter_op_threads:int=None):
+    """
+    Sentence embedding model, loaded once per process. backend is one of
+    INFERENCE_BACKENDS; the onnx backend exports the model to ONNX on 
+    first load if model_path has no ONNX file yet (needs optimum).
+    """
+    check_backend(backend)
+    from sentence_transformers import SentenceTransformer
+
+    def load():
+        if backend == 'onnx':
+            return SentenceTransformer(model_path, backend='onnx',
+                                       model_kwargs={'provider': 'CPUExecutionProvider',
+                                                     'session_options': onnx_session_options(intra_op_threads, 
+                                                                                             inter_op_threads)})
+        model = SentenceTransformer(model_path)
+        return quantise_int8(model) if backend == 'int8' else model
+
+    if backend != 'onnx':
+        set_torch_threads(intra_op_threads, inter_op_threads)
+    return registry.get(model_key('sentence-transformer', model_path, backend, intra_op_threads, inter_op_threads), load)
+
+def load_summariser(model_path:str, backend:str='torch', intra_op_threads:int=None, inter_op_threads:int=None):
+    """
+    BART model and tokeniser, loaded once per process. backend is one of
+    INFERENCE_BACKENDS; the onnx backend exports the model to ONNX on 
+    first load if model_path has no ONNX files yet (needs optimum).
+    """
+    check_backend(backend)
+    from transformers import BartTokenizer, BartForConditionalGeneration
+
+    def load():
+        if backend == 'onnx':
+            from optimum.onnxruntime import ORTModelForSeq2SeqLM
+            model = ORTModelForSeq2SeqLM.from_pretrained(model_path, 
+                                                         export=not os.path.exists(os.path.join(model_path, 'encoder_model.onnx')),
+                                                         provider='CPUExecutionProvider',
+                                                         session_options=onnx_session_options(intra_op_threads, 
+                                                                                              inter_op_threads))
+        else:
+            model = BartForConditionalGeneration.from_pretrained(model_path)
+            if backend == 'int8':
+                model = quantise_int8(model)
+        return model, BartTokenizer.from_pretrained(model_path)
+
+    # generate_summaries runs the tokeniser's tensors through torch either way
+    set_torch_threads(intra_op_threads, inter_op_threads)
+    return registry.get(model_key('bart', model_path, backend, intra_op_threads, inter_op_threads), load)
+
+class SentimentCache:
+    """Thread-safe LRU cache of VADER scores, keyed by a hash of the text."""
+    def __init__(self, max_size:int=100_000):
+        self.max_size = max_size
+        self.scores = OrderedDict()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(text:str)->bytes:
+        return hashlib.blake2b(text.encode('utf-8'), digest_size=16).digest()
+
+    def get(self, key):
+        with self.lock:
+            scores = self.scores.get(key)
+            if scores is not None:
+                self.scores.move_to_end(key)
+            return scores
+
+    def put(self, key, scores:dict):
+        with self.lock:
+            self.scores[key] = scores
+            self.scores.move_to_end(key)
+            while len(self.scores) > self.max_size:
+                self.scores.popitem(last=False)
+
+# Shared across calls, so repeated texts (reposts, templates) are scored once
+sentiment_cache = SentimentCache()
+
+def score_texts(texts: list)->list:
+    """VADER polarity scores for each text. Runs in pool workers too."""
+    sia = load_sentiment_analyser()
+    return [sia.polarity_scores(text) for text in texts]
+
+@recorder.instrument()
 def get_sentiment(df: pd.DataFrame, 
-                  text_column: str):
-    """Caluclate sentiment scores from Reddit comments"""
-    # Initialise VADER
-    sia = SentimentIntensityAnalyzer()
-    # Apply VADER analysis on text column
-    sent_df=df.copy()
-    sent_df['sentiment_scores'] = sent_df[text_column].apply(lambda x: sia.polarity_scores(x))
-    sent_df['compound'] = sent_df['sentiment_scores'].apply(lambda score_dict: score_dict['compound'])
-    sent_df['sentiment'] = sent_df['compound'].apply(lambda c: 'POSITIVE' if c >= 0.05 else ('NEGATIVE' if c <= -0.05 else 'NEUTRAL'))
+                  text_column: str,
+                  scored_ids=None,
+                  n_jobs: int=1,
+                  chunk_size: int=2000,
+                  cache: SentimentCache=sentiment_cache):
+    """
+    Caluclate sentiment scores from Reddit comments.
+
+    Params:
+    -------
+    * df `pd.DataFrame` or `CommentBatch`: comments, with a comment_id column 
+      if scored_ids is used.
+    * text_column `str`: column holding the text to score.
+    * scored_ids: comment IDs already scored; these rows are skipped and 
+      left out of the result.
+    * n_jobs `int`: worker processes for scoring; 1 scores in this process.
+    * chunk_size `int`: texts sent to a worker at a time.
+    * cache `SentimentCache`: scores reused by text hash, or None.
+
+    Returns:
+    --------
+    sent_df `pd.DataFrame`: the scored rows of df, with sentiment_scores, 
+    compound and sentiment columns added.
+    """
+    if isinstance(df, CommentBatch):
+        # Only the columns scored, not the whole batch
+        if scored_ids is not None:
+            df = CommentBatch(record for record in df if record.comment_id not in scored_ids)
+            scored_ids = None
+        df = df.to_frame(columns=('comment_id', text_column))
+    if scored_ids is not None:
+        sent_df = df[~df['comment_id'].isin(scored_ids)].copy()
+    else:
+        sent_df = df.copy()
+    texts = sent_df[text_column].fillna('').astype(str).tolist()
+
+    # Score each distinct text once, reusing cached scores where possible
+    keys = [SentimentCache.key(text) for text in texts]
+    scores_by_key = {}
+    texts_to_score = {}
+    for key, text in zip(keys, texts):
+        if key in scores_by_key or key in texts_to_score:
+            continue
+        cached = cache.get(key) if cache is not None else None
+        if cached is not None:
+            scores_by_key[key] = cached
+        else:
+            texts_to_score[key] = text
+
+    pending_keys, pending_texts = list(texts_to_score), list(texts_to_score.values())
+    if n_jobs > 1 and len(pending_texts) > chunk_size:
+        chunks = [pending_texts[i:i + chunk_size] for i in range(0, len(pending_texts), chunk_size)]
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            new_scores = [scores for chunk_scores in executor.map(score_texts, chunks) for scores in chunk_scores]
+    else:
+        new_scores = score_texts(pending_texts)
+    for key, scores in zip(pending_keys, new_scores):
+        scores_by_key[key] = scores
+        if cache is not None:
+            cache.put(key, scores)
+    logging.info(f"Sentiment: {len(texts)} comments, {len(pending_texts)} distinct texts scored.")
+
+    sent_df['sentiment_scores'] = [scores_by_key[key] for key in keys]
+    compound = np.array([scores_by_key[key]['compound'] for key in keys], dtype=float)
+    sent_df['compound'] = compound
+    sent_df['sentiment'] = np.select([compound >= 0.05, compound <= -0.05], 
+                                     ['POSITIVE', 'NEGATIVE'], 
+                                     default='NEUTRAL')
     
     return sent_df
 
+@recorder.instrument()
+def get_embeddings(embedding_model,
+                   comments: list,
+                   comment_ids: list=None,
+                   embedding_store=None,
+                   model_name: str=None,
+                   batch_size: int=32)->np.ndarray:
+    """
+    Embed comments, reusing vectors cached in embedding_store (e.g. a 
+    DatabaseManager) and encoding only the comments missing from it.
+
+    Params:
+    -------
+    * embedding_model `SentenceTransformer`: model used for cache misses.
+    * comments `list`: text to embed.
+    * comment_ids `list`: IDs of the comments, used as cache keys.
+    * embedding_store: object with get_embeddings/put_embeddings, or None to 
+      encode everything.
+    * model_name `str`: model part of the cache key.
+    * batch_size `int`: encoding batch size.
+
+    Returns:
+    --------
+    embeddings `np.ndarray`: one row per comment, in input order.
+    """
+    if embedding_store is None or comment_ids is None:
+        return embedding_model.encode(comments, batch_size=batch_size, show_progress_bar=True)
+
+    cached = embedding_store.get_embeddings(list(comment_ids), model_name)
+    missing = [i for i, comment_id in enumerate(comment_ids) if comment_id not in cached]
+    if missing:
+        new_embeddings = embedding_model.encode([comments[i] for i in missing], 
+                                                batch_size=batch_size, 
+                                                show_progress_bar=True)
+        missing_ids = [comment_ids[i] for i in missing]
+        embedding_store.put_embeddings(missing_ids, model_name, new_embeddings)
+        cached.update(zip(missing_ids, np.asarray(new_embeddings, dtype=np.float32)))
+    logging.info(f"Embeddings: {len(comments) - len(missing)} from cache, {len(missing)} encoded.")
+
+    return np.vstack([cached[comment_id] for comment_id in comment_ids])
+
+@recorder.instrument(items=lambda result: len(result[0]))
 def get_topics(comments: list,
                embedding_model_path:str="bge-large-en", 
                umap_n_neighbours:int=50, 
@@ -37,7 +281,15 @@ def get_topics(comments: list,
                hdbscan_min_cluster_size:int=10,
                hdbscan_cluster_metric:str='euclidean',
                vectoriser_min_ngram:int=1,
-               vectoriser_max_ngram:int=3)->pd.DataFrame:
+               vectoriser_max_ngram:int=3,
+               comment_ids:list=None,
+               embedding_store=None,
+               encode_batch_size:int=32,
+               return_embeddings:bool=False,
+               dedup_threshold:float=0.8,
+               embedding_backend:str='torch',
+               intra_op_threads:int=None,
+               inter_op_threads:int=None)->pd.DataFrame:
     
     """
     BERTopic model for topic modelling of Reddit comments.
@@ -54,16 +306,85 @@ def get_topics(comments: list,
     * hbdscan_cluster_metric `str`:
     * vectoriser_min_ngram `int`:
     * vectroiser_max_ngram `int`:
+    * comment_ids `list`: IDs of the comments, to look up cached embeddings.
+    * embedding_store: embedding cache (e.g. a DatabaseManager); only 
+      comments missing from it are encoded.
+    * encode_batch_size `int`: batch size for encoding cache misses.
+    * return_embeddings `bool`: also return the comment embeddings, e.g. 
+      for topic_summarisation's extractive stage.
+    * dedup_threshold `float`: near-duplicate comments (estimated Jaccard 
+      similarity at least this) are embedded and clustered once, then 
+      given the topic of their representative. None disables this.
+    * embedding_backend `str`: 'torch' (fp32), 'int8' or 'onnx', see 
+      load_embedding_model.
+    * intra_op_threads, inter_op_threads `int`: CPU thread counts of the
+      embedding model (default: leave unchanged).
     
     Returns:
     --------
     df `pd.DataFrame`: a DataFrame of topic modelling representations. 
     topics:
     topics_info:
+    embeddings: only if return_embeddings is True.
     """
+    groups = None
+    if dedup_threshold is not None:
+        groups = find_near_duplicates(comments, threshold=dedup_threshold)
+        comments = [comments[i] for i in groups.representatives]
+        if comment_ids is not None:
+            comment_ids = [comment_ids[i] for i in groups.representatives]
+
     # Create embeddings
-    embedding_model = SentenceTransformer(embedding_model_path)
-    embeddings = embedding_model.encode(comments, show_progress_bar=True)
+    embedding_model = load_embedding_model(embedding_model_path, embedding_backend, 
+                                           intra_op_threads, inter_op_threads)
+    embeddings = get_embeddings(embedding_model, comments, 
+                                comment_ids=comment_ids, 
+                                embedding_store=embedding_store, 
+                                model_name=embedding_cache_name(embedding_model_path, embedding_backend),
+                                batch_size=encode_batch_size)
+
+    topic_model = build_topic_model(embedding_model,
+                                    umap_n_neighbours=umap_n_neighbours,
+                                    umap_n_components=umap_n_components,
+                                    umap_min_dist=umap_min_dist,
+                                    umap_metric=umap_metric,
+                                    hdbscan_min_cluster_size=hdbscan_min_cluster_size,
+                                    hdbscan_cluster_metric=hdbscan_cluster_metric,
+                                    vectoriser_min_ngram=vectoriser_min_ngram,
+                                    vectoriser_max_ngram=vectoriser_max_ngram)
+    topics, probs = topic_model.fit_transform(comments, embeddings)
+    topic_info = topic_model.get_topic_info()
+    # df = topic_model.get_topic_info()
+    logging.info("Topic modelling complete")
+
+    if groups is not None:
+        # Back to one topic per comment, with topic sizes counting every duplicate
+        topics = groups.expand(topics)
+        embeddings = embeddings[groups.inverse]
+        topic_info['Count'] = topic_info['Topic'].map(Counter(topics)).fillna(0).astype(int)
+
+    topic_info['date'] = datetime.now().date()
+
+    if return_embeddings:
+        return topics, topic_info, embeddings
+    return topics, topic_info
+
+
+def build_topic_model(embedding_model,
+                      umap_n_neighbours:int=50, 
+                      umap_n_components:int=5,
+                      umap_min_dist:float=0,
+                      umap_metric:str='cosine',
+                      hdbscan_min_cluster_size:int=10,
+                      hdbscan_cluster_metric:str='euclidean',
+                      vectoriser_min_ngram:int=1,
+                      vectoriser_max_ngram:int=3):
+    """Build an unfitted BERTopic pipeline; see get_topics for the params."""
+    from bertopic import BERTopic
+    from bertopic.representation import KeyBERTInspired, MaximalMarginalRelevance
+    from umap import UMAP
+    from hdbscan import HDBSCAN
+    from sklearn.feature_extraction.text import CountVectorizer
 
     # Reduce dimensionality
     umap_model = UMAP(n_neighbors=umap_n_neighbours, n_components=umap_n_components, min_dist=umap_min_dist, metric=umap_metric, random_state=42)
@@ -97,118 +418,420 @@ def get_topics(comments: list,
     verbose=True,
     calculate_probabilities=True
     )
-    topics, probs = topic_model.fit_transform(comments, embeddings)
+    return topic_model
+
+
+def topic_centroids(embeddings, topics)->dict:
+    """Unit-length mean embedding of each topic, outliers excluded."""
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    topics = np.asarray(topics)
+    centroids = {}
+    for topic in np.unique(topics):
+        if topic == -1:
+            continue
+        centroid = embeddings[topics == topic].mean(axis=0)
+        centroids[int(topic)] = centroid / max(np.linalg.norm(centroid), 1e-12)
+    return centroids
+
+def align_topic_ids(new_centroids:dict, old_centroids:dict, next_id:int, min_similarity:float=0.7):
+    """
+    Give the topics of a refitted model stable IDs: each new topic takes 
+    the ID of the most similar previous topic (cosine similarity of 
+    centroids, at least min_similarity, each old ID used once); the rest 
+    get fresh IDs from next_id.
+
+    Returns:
+    --------
+    mapping `dict`: new model topic -> stable ID.
+    next_id `int`: next unused stable ID.
+    """
+    pairs = []
+    for new_topic, new_centroid in new_centroids.items():
+        for stable_id, old_centroid in old_centroids.items():
+            similarity = float(np.dot(new_centroid, old_centroid))
+            if similarity >= min_similarity:
+                pairs.append((similarity, new_topic, stable_id))
+
+    mapping, used_ids = {}, set()
+    for similarity, new_topic, stable_id in sorted(pairs, reverse=True):
+        if new_topic not in mapping and stable_id not in used_ids:
+            mapping[new_topic] = stable_id
+            used_ids.add(stable_id)
+    for new_topic in sorted(new_centroids):
+        if new_topic not in mapping:
+            mapping[new_topic] = next_id
+            next_id += 1
+    return mapping, next_id
+
+def load_topic_model_state(model_dir:str):
+    """Metadata and stable-ID centroids of the saved topic model, or (None, {})."""
+    metadata_path = os.path.join(model_dir, 'metadata.json')
+    if not os.path.exists(metadata_path):
+        return None, {}
+    with open(metadata_path) as f:
+        metadata = json.load(f)
+    metadata['stable_ids'] = {int(topic): stable_id for topic, stable_id in metadata['stable_ids'].items()}
+    centroids = np.load(os.path.join(model_dir, 'centroids.npz'))
+    return metadata, {int(stable_id): centroids[stable_id] for stable_id in centroids.files}
+
+def save_topic_model_state(model_dir:str, topic_model, metadata:dict, centroids:dict):
+    os.makedirs(model_dir, exist_ok=True)
+    topic_model.save(os.path.join(model_dir, 'model'), serialization='pickle', save_embedding_model=False)
+    np.savez(os.path.join(model_dir, 'centroids.npz'), **{str(stable_id): c for stable_id, c in centroids.items()})
+    with open(os.path.join(model_dir, 'metadata.json'), 'w') as f:
+        json.dump(metadata, f, indent=2)
+
+@recorder.instrument(items=lambda result: len(result[0]))
+def get_topics_incremental(comments: list,
+                           comment_ids: list,
+                           topic_store,
+                           model_dir:str="topic_model",
+                           embedding_model_path:str="bge-large-en",
+                           refit_every_days:int=7,
+                           max_outlier_ratio:float=0.4,
+                           embedding_store=None,
+                           encode_batch_size:int=32,
+                           dedup_threshold:float=0.8,
+                           embedding_backend:str='torch',
+                           intra_op_threads:int=None,
+                           inter_op_threads:int=None,
+                           **topic_model_kwargs):
+    """
+    Topic modelling that reuses a saved BERTopic model. Comments already 
+    assigned by the saved model keep their topic; new comments are assigned
+    with transform (HDBSCAN approximate prediction). The model is refitted 
+    on the whole window only when there is none yet, it is older than 
+    refit_every_days, or the share of new comments it leaves as outliers 
+    exceeds max_outlier_ratio. Topics keep stable IDs across refits (see 
+    align_topic_ids), so topic_summaries can be tracked over time.
+
+    Params:
+    -------
+    * comments `list`: text to topic model. 
+    * comment_ids `list`: IDs of the comments.
+    * topic_store: stores topic assignments (e.g. a DatabaseManager).
+    * model_dir `str`: where the fitted model is saved.
+    * embedding_model_path `str`: filepath to embedding model.
+    * refit_every_days `int`: refresh the model at least this often.
+    * max_outlier_ratio `float`: drift threshold that triggers a refit.
+    * embedding_store: embedding cache, see get_embeddings.
+    * encode_batch_size `int`: batch size for encoding cache misses.
+    * dedup_threshold `float`: near-duplicate collapse threshold, see 
+      get_topics. Only representatives are embedded, assigned and stored.
+    * embedding_backend `str`, intra_op_threads, inter_op_threads `int`: 
+      inference backend and thread counts, see get_topics.
+    * topic_model_kwargs: passed to build_topic_model on refit.
+
+    Returns:
+    --------
+    topics: stable topic ID of each comment (-1 for outliers).
+    topic_info `pd.DataFrame`: topic representations, with Count over these comments.
+    embeddings: the comment embeddings.
+    """
+    groups = None
+    if dedup_threshold is not None:
+        groups = find_near_duplicates(comments, threshold=dedup_threshold)
+        comments = [comments[i] for i in groups.representatives]
+        comment_ids = [comment_ids[i] for i in groups.representatives]
+
+    embedding_model = load_embedding_model(embedding_model_path, embedding_backend, 
+                                           intra_op_threads, inter_op_threads)
+    embeddings = get_embeddings(embedding_model, comments, 
+                                comment_ids=comment_ids, 
+                                embedding_store=embedding_store, 
+                                model_name=embedding_cache_name(embedding_model_path, embedding_backend),
+                                batch_size=encode_batch_size)
+    metadata, stable_centroids = load_topic_model_state(model_dir)
+
+    refit_reason = None
+    if metadata is None:
+        refit_reason = "no saved model"
+    elif datetime.now() - datetime.fromisoformat(metadata['fitted_at']) > timedelta(days=refit_every_days):
+        refit_reason = f"model older than {refit_every_days} days"
+    else:
+        from bertopic import BERTopic
+        topic_model = BERTopic.load(os.path.join(model_dir, 'model'), embedding_model=embedding_model)
+        assigned = topic_store.get_comment_topics(comment_ids, metadata['version'])
+        new_indices = [i for i, comment_id in enumerate(comment_ids) if comment_id not in assigned]
+        if new_indices:
+            new_topics, _ = topic_model.transform([comments[i] for i in new_indices], embeddings[new_indices])
+            new_ids = [comment_ids[i] for i in new_indices]
+            topic_store.put_comment_topics(new_ids, metadata['version'], new_topics)
+            assigned.update(zip(new_ids, (int(topic) for topic in new_topics)))
+            outlier_ratio = float(np.mean(np.asarray(new_topics) == -1))
+            logging.info(f"Assigned {len(new_indices)} new comments to topics, outlier ratio {outlier_ratio:.2f}.")
+            if outlier_ratio > max_outlier_ratio:
+                refit_reason = f"outlier ratio {outlier_ratio:.2f} above {max_outlier_ratio}"
+        model_topics = [assigned[comment_id] for comment_id in comment_ids]
+
+    if refit_reason is not None:
+        logging.info(f"Refitting topic model: {refit_reason}.")
+        topic_model = build_topic_model(embedding_model, **topic_model_kwargs)
+        model_topics, _ = topic_model.fit_transform(comments, embeddings)
+        model_topics = [int(topic) for topic in model_topics]
+        new_centroids = topic_centroids(embeddings, model_topics)
+        stable_ids, next_stable_id = align_topic_ids(new_centroids, stable_centroids, 
+                                                     metadata['next_stable_id'] if metadata else 0)
+        fitted_at = datetime.now()
+        metadata = {
+            'version': fitted_at.strftime('%Y%m%d%H%M%S'),
+            'fitted_at': fitted_at.isoformat(),
+            'stable_ids': stable_ids,
+            'next_stable_id': next_stable_id
+        }
+        # Keep centroids of topics that have disappeared, in case they return
+        stable_centroids.update({stable_ids[topic]: centroid for topic, centroid in new_centroids.items()})
+        save_topic_model_state(model_dir, topic_model, metadata, stable_centroids)
+        topic_store.replace_comment_topics(comment_ids, metadata['version'], model_topics)
+
+    stable_ids = metadata['stable_ids']
+    topics = [stable_ids.get(topic, -1) if topic != -1 else -1 for topic in model_topics]
+    if groups is not None:
+        topics = groups.expand(topics)
+        embeddings = embeddings[groups.inverse]
     topic_info = topic_model.get_topic_info()
-    # df = topic_model.get_topic_info()
+    topic_info['Topic'] = topic_info['Topic'].map(lambda topic: stable_ids.get(topic, -1) if topic != -1 else -1)
+    topic_info['Count'] = topic_info['Topic'].map(Counter(topics)).fillna(0).astype(int)
+    topic_info['date'] = datetime.now().date()
     logging.info("Topic modelling complete")
 
-    topic_info['date'] = datetime.now().date()
+    return topics, topic_info, embeddings
 
-    return topics, topic_info
 
+def approx_token_count(text:str)->int:
+    """Rough BART token count - about four tokens for every three words."""
+    return len(text.split()) * 4 // 3 + 1
+
+def select_representative_comments(comments:list, 
+                                   embeddings, 
+                                   top_k:int=20, 
+                                   diversity:float=0.3, 
+                                   token_budget:int=None)->list:
+    """
+    Pick the comments that best represent a topic: those nearest the topic
+    centroid, traded off against similarity to comments already picked
+    (Maximal Marginal Relevance).
 
-def summarise(
-        text_to_summarise:str,
+    Params:
+    -------
+    * comments `list`: the topic's comments.
+    * embeddings: one embedding per comment.
+    * top_k `int`: maximum number of comments to pick.
+    * diversity `float`: 0 picks purely by closeness to the centroid, 1 purely 
+      by dissimilarity to the comments already picked.
+    * token_budget `int`: approximate token budget of the picked comments;
+      comments that no longer fit are dropped from the candidates, and 
+      picking stops once none fit (default: no limit). The most relevant
+      comment is always picked.
+
+    Returns:
+    --------
+    selected `list`: the picked comments, most representative first.
+    """
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    normed = embeddings / np.maximum(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12)
+    centroid = normed.mean(axis=0)
+    centroid /= max(np.linalg.norm(centroid), 1e-12)
+    relevance = normed @ centroid
+
+    tokens = np.array([approx_token_count(comment) for comment in comments])
+    available = np.ones(len(comments), dtype=bool)
+    max_similarity = np.zeros(len(comments), dtype=np.float32)
+    selected, used_tokens = [], 0
+    # Every pass picks a comment, so this runs at most top_k times
+    while len(selected) < top_k and available.any():
+        if selected:
+            scores = (1 - diversity) * relevance - diversity * max_similarity
+        else:
+            scores = relevance.copy()
+        scores[~available] = -np.inf
+        best = int(np.argmax(scores))
+        available[best] = False
+        selected.append(best)
+        used_tokens += int(tokens[best])
+        max_similarity = np.maximum(max_similarity, normed @ normed[best])
+        if token_budget is not None:
+            # Drop every comment that no longer fits in what is left of the budget
+            available &= tokens <= token_budget - used_tokens
+
+    return [comments[i] for i in selected]
+
+def split_into_token_chunks(tokeniser, text:str, max_length:int)->list:
+    """
+    Split text on token boundaries into chunks of at most max_length tokens,
+    special tokens included. Returns lists of input IDs.
+    """
+    token_ids = tokeniser(text, add_special_tokens=False, verbose=False)['input_ids']
+    body_length = max_length - tokeniser.num_special_tokens_to_add()
+    chunks = [token_ids[i:i + body_length] for i in range(0, len(token_ids), body_length)] or [[]]
+    return [tokeniser.build_inputs_with_special_tokens(chunk) for chunk in chunks]
+
+def generate_summaries(summariser, tokeniser, chunks:list, batch_size:int, **generate_kwargs)->list:
+    """
+    Summarise tokenised chunks in batches. Chunks are sorted by length so 
+    that each batch is padded only to its own longest chunk.
+    """
+    import torch
+
+    order = sorted(range(len(chunks)), key=lambda i: len(chunks[i]), reverse=True)
+    summaries = [None] * len(chunks)
+    for start in range(0, len(order), batch_size):
+        batch_indices = order[start:start + batch_size]
+        inputs = tokeniser.pad({'input_ids': [chunks[i] for i in batch_indices]}, 
+                               padding='longest', 
+                               return_tensors='pt')
+        with torch.inference_mode():
+            summary_ids = summariser.generate(inputs['input_ids'], 
+                                              attention_mask=inputs['attention_mask'],
+                                              **generate_kwargs)
+        for i, ids in zip(batch_indices, summary_ids):
+            summaries[i] = tokeniser.decode(ids, skip_special_tokens=True)
+    return summaries
+
+@recorder.instrument()
+def summarise_many(
+        texts:list,
         model_path:str="bart-cnn-large", 
         input_chunk_max_length:int=1024,
-        return_tensors:str='pt',
-        truncation:bool=True,
-        padding:str='max_length',
         output_max_length:int=150,
         output_min_length:int=40,
         length_penalty:float=2.0,
         early_stopping:bool=True,
-        num_beams:int=1
-)->pd.DataFrame:
+        num_beams:int=1,
+        batch_size:int=8,
+        backend:str='torch',
+        intra_op_threads:int=None,
+        inter_op_threads:int=None
+)->list:
     """
-    Function to summarise text using BART.
+    Summarise several texts using BART. Each text is split into chunks on
+    token boundaries; the chunks of all texts are summarised together in 
+    length-sorted, dynamically padded batches, and texts longer than one 
+    chunk get a second, batched pass over their joined chunk summaries.
 
     Params:
     -------
-    * text_to_summarise `str`: text to summarise.
+    * texts `list`: texts to summarise.
     * model_path `str`: path to the pre-trained BART model.
-    * input_chunk_max_length `int`: maximum length of input tokens.
-    * return_tensors `str`: format of the return tensors. Default: 'pt' for PyTorch tensors.
-    * truncation `bool`: whether to truncate texts longer than `input_max_length`.
-    * padding `str`: how to handle texts shorter than `input_max_length`.
+    * input_chunk_max_length `int`: maximum length of an input chunk, in tokens.
     * output_max_length `int`: maximum length of the summary output.
     * output_min_length `int`: minimum length of the summary output.
     * length_penalty `float`: penalty for a summary that is too short or too long.
     * early_stopping `bool`: whether to stop once the model is sure about the output.
     * num_beams `int`: number of beams for beam search.
-    
+    * batch_size `int`: number of chunks passed to each generate call.
+    * backend `str`: 'torch' (fp32), 'int8' or 'onnx', see load_summariser.
+    * intra_op_threads, inter_op_threads `int`: CPU thread counts of the
+      model (default: leave unchanged).
+
+    Returns:
+    --------
+    summaries `list`: one summary per text.
+    """
+    summariser, tokeniser = load_summariser(model_path, backend, intra_op_threads, inter_op_threads)
+    generate_kwargs = dict(max_length=output_max_length, 
+                           min_length=output_min_length,
+                           length_penalty=length_penalty,
+                           early_stopping=early_stopping,
+                           num_beams=num_beams)
+
+    # Chunk every text, remembering which text each chunk came from
+    chunks, chunk_owners = [], []
+    for text_index, text in enumerate(texts):
+        text_chunks = split_into_token_chunks(tokeniser, text, input_chunk_max_length)
+        chunks.extend(text_chunks)
+        chunk_owners.extend([text_index] * len(text_chunks))
+    logging.info(f"Summarising {len(texts)} texts in {len(chunks)} chunks.")
+
+    chunk_summaries = generate_summaries(summariser, tokeniser, chunks, batch_size,
+                                         no_repeat_ngram_size=3,
+                                         top_k=50,
+                                         top_p=0.95,
+                                         **generate_kwargs)
+    summaries_by_text = defaultdict(list)
+    for text_index, chunk_summary in zip(chunk_owners, chunk_summaries):
+        summaries_by_text[text_index].append(chunk_summary)
+
+    # A single chunk's summary is final; longer texts summarise their chunk summaries
+    final_summaries = [None] * len(texts)
+    reduce_indices, reduce_chunks = [], []
+    for text_index in range(len(texts)):
+        text_summaries = summaries_by_text[text_index]
+        if len(text_summaries) == 1:
+            final_summaries[text_index] = text_summaries[0]
+        else:
+            final_inputs = tokeniser(" ".join(text_summaries), 
+                                     max_length=input_chunk_max_length, 
+                                     truncation=True)
+            reduce_indices.append(text_index)
+            reduce_chunks.append(final_inputs['input_ids'])
+
+    for text_index, final_summary in zip(reduce_indices, 
+                                         generate_summaries(summariser, tokeniser, reduce_chunks, 
+                                                            batch_size, **generate_kwargs)):
+        final_summaries[text_index] = final_summary
+
+    return final_summaries
+
+@recorder.instrument(items=lambda result: 1)
+def summarise(text_to_summarise:str, **kwargs)->str:
+    """
+    Function to summarise text using BART. Takes the same keyword arguments
+    as summarise_many.
+
     Returns:
     --------
     final_summary `str`: the summarized text.
     """
-    summariser = BartForConditionalGeneration.from_pretrained(model_path)
-    tokeniser = BartTokenizer.from_pretrained(model_path)
-
-    # Concatenate all text into a large string and split into chunks
-    full_text = text_to_summarise
-    chunks = [full_text[i:i + input_chunk_max_length] for i in range(0, len(full_text), input_chunk_max_length)]
-
-    chunk_summaries = []
-    for chunk in chunks:
-        inputs = tokeniser(chunk, 
-                        max_length=input_chunk_max_length, 
-                        return_tensors=return_tensors, 
-                        truncation=truncation, 
-                        padding=padding)
-
-        summary_ids = summariser.generate(inputs['input_ids'], 
-                                    attention_mask=inputs['attention_mask'],
-                                        max_length=output_max_length, 
-                                        min_length=output_min_length,
-                                        length_penalty=length_penalty,
-                                        early_stopping=early_stopping,
-                                        num_beams=num_beams,
-                                        no_repeat_ngram_size=3,
-                                        top_k=50,
-                                        top_p=0.95
-                                        )
-        chunk_summary = tokeniser.decode(summary_ids[0], skip_special_tokens=True)
-        chunk_summaries.append(chunk_summary)
-
-    final_text_to_summarise = " ".join(chunk_summaries)
-    final_inputs = tokeniser(final_text_to_summarise, 
-                        max_length=input_chunk_max_length, 
-                        return_tensors=return_tensors, 
-                        truncation=truncation, 
-                        padding=padding)
-    final_summary_ids = summariser.generate(final_inputs['input_ids'], 
-                                    attention_mask=inputs['attention_mask'],
-                                        max_length=output_max_length, 
-                                        min_length=output_min_length,
-                                        length_penalty=length_penalty,
-                                        early_stopping=early_stopping,
-                                        num_beams=num_beams
-                                        )
-    final_summary = tokeniser.decode(final_summary_ids[0], skip_special_tokens=True)
-
-    return final_summary
-
-def topic_summarisation(comments: list, topics, topic_info)->pd.DataFrame:
+    return summarise_many([text_to_summarise], **kwargs)[0]
+
+@recorder.instrument()
+def topic_summarisation(comments: list, 
+                        topics, 
+                        topic_info, 
+                        embeddings=None,
+                        top_k:int=20,
+                        mmr_diversity:float=0.3,
+                        token_budget:int=2048,
+                        **summarise_kwargs)->pd.DataFrame:
     """This function combines the BERTopic modelling outputs with a 
-    summarisation function to summarise clusters of text. 
+    summarisation function to summarise clusters of text. All topics are
+    summarised in one batched summarise_many call; summarise_kwargs are 
+    passed on to it.
+
+    When embeddings are given, only the top_k most representative comments
+    of each topic (see select_representative_comments), up to token_budget
+    tokens, are summarised, so the cost per topic doesn't grow with its size.
     """
 
     # Initialise variables
     topic_comments = defaultdict(list)
+    topic_indices = defaultdict(list)
     topic_summaries = []
     todays_date = datetime.now().date()
 
     # Create dictionary of comments by topic
-    for comment, topic in zip(comments, topics):
+    for i, (comment, topic) in enumerate(zip(comments, topics)):
         topic_comments[topic].append(comment)
+        topic_indices[topic].append(i)
+    topic_comments.pop(-1, None) # skip outlier topic
 
-    for topic_id, comments in topic_comments.items():
-        if topic_id == -1: # skip outlier topic
-            continue
-        # Combine comments into a string
-        combined_comments = ' '.join(comments)
-        # Summarise
-        summary = summarise(combined_comments)
+    # Combine each topic's comments into a string and summarise them together
+    topic_ids = list(topic_comments)
+    texts_to_summarise = []
+    for topic_id in topic_ids:
+        if embeddings is not None:
+            selected = select_representative_comments(topic_comments[topic_id],
+                                                      np.asarray(embeddings)[topic_indices[topic_id]],
+                                                      top_k=top_k,
+                                                      diversity=mmr_diversity,
+                                                      token_budget=token_budget)
+        else:
+            selected = topic_comments[topic_id]
+        texts_to_summarise.append(' '.join(selected))
+    summaries = summarise_many(texts_to_summarise, **summarise_kwargs)
+
+    for topic_id, summary in zip(topic_ids, summaries):
         # Extract keywords
         keybert_list = topic_info[topic_info['Topic'] == topic_id]['KeyBERT'].values[0]
         keybert = ', '.join(keybert_list)
@@ -221,7 +844,7 @@ def topic_summarisation(comments: list, topics, topic_info)->pd.DataFrame:
             "Summary": summary,
             "KeyBERT": keybert,
             "MMR": mmr,
-            "Size": len(comments)
+            "Size": len(topic_comments[topic_id])
         })
         logging.info(f"Summary completed for topic cluster: {topic_id}")
 
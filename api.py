@@ -1,42 +1,280 @@
 import praw
+import prawcore
 import truststore
+from transport import HTTPTransport
+import logging
+import random
+import re
+import threading
 import time
+from collections import defaultdict
+from urllib.parse import urlparse
 
 class APIQueryCounter:
     def __init__(self,):
         self.query_count = 0
         self.start_time = time.time()
+        self.lock = threading.Lock()
 
     def increment(self):
-        self.query_count =+ 1
-    
+        with self.lock:
+            self.query_count += 1
+
     def get_count(self):
         return self.query_count
-    
+
     def reset(self):
-        self.query_count = 0
-        self.start_time = time.time()
-        
+        with self.lock:
+            self.query_count = 0
+            self.start_time = time.time()
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket. Tokens refill at `rate` per second up to
+    `capacity`; callers block until a token is available.
+    """
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last_refill = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+
+    def acquire(self, tokens=1):
+        """Take tokens, sleeping until the bucket can cover them."""
+        with self.lock:
+            now = time.monotonic()
+            self._refill(now)
+            # Reserve the tokens now, so that waiting callers queue in order
+            self.tokens -= tokens
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+
+    def set_rate(self, rate):
+        with self.lock:
+            self._refill(time.monotonic())
+            self.rate = rate
+
+    def pause(self, seconds):
+        """Hold back every caller for at least `seconds`."""
+        with self.lock:
+            self._refill(time.monotonic())
+            self.tokens = min(self.tokens, -seconds * self.rate)
+
+
+class EndpointStats:
+    """Request count, status codes and latency histogram for one endpoint."""
+    LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, float('inf'))
+
+    def __init__(self):
+        self.count = 0
+        self.retries = 0
+        self.errors = 0
+        self.total_latency = 0.0
+        self.status_counts = defaultdict(int)
+        self.latency_histogram = [0] * len(self.LATENCY_BUCKETS)
+
+    def record(self, status, latency):
+        self.count += 1
+        self.total_latency += latency
+        self.status_counts[status] += 1
+        for i, upper_bound in enumerate(self.LATENCY_BUCKETS):
+            if latency <= upper_bound:
+                self.latency_histogram[i] += 1
+                break
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'retries': self.retries,
+            'errors': self.errors,
+            'mean_latency': self.total_latency / self.count if self.count else 0.0,
+            'status_counts': dict(self.status_counts),
+            'latency_histogram': dict(zip(self.LATENCY_BUCKETS, self.latency_histogram))
+        }
+
+
+class RequestScheduler:
+    """
+    Paces, retries and accounts for every HTTP request made by the Reddit
+    clients of an APIConnection. One scheduler is shared by all clients, so
+    parallel fetchers draw from the same budget.
+
+    Reddit allows 100 requests per minute per OAuth client. The token bucket
+    is set to that rate and is slowed down further when the
+    x-ratelimit-remaining/x-ratelimit-reset response headers show the budget
+    running out. 429 and 5xx responses are retried with exponential backoff,
+    honouring Retry-After.
+    """
+    RETRY_STATUSES = {429, 500, 502, 503, 504}
+    ENDPOINT_PATTERNS = [
+        (re.compile(r'^/r/[^/]+'), '/r/{subreddit}'),
+        (re.compile(r'/comments/[^/]+(/.*)?$'), '/comments/{id}'),
+        (re.compile(r'^/(user|u)/[^/]+'), '/user/{name}'),
+    ]
+
+    def __init__(self, counter, calls_per_minute=100, burst=10, max_retries=3, backoff_base=2.0):
+        self.counter = counter
+        self.max_rate = calls_per_minute / 60
+        self.bucket = TokenBucket(rate=self.max_rate, capacity=burst)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.ratelimit_remaining = None
+        self.ratelimit_reset = None
+        self.stats = defaultdict(EndpointStats)
+        self.lock = threading.Lock()
+
+    @classmethod
+    def endpoint_name(cls, method, url):
+        """Group URLs by endpoint, e.g. GET /r/{subreddit}/new."""
+        path = urlparse(url).path.rstrip('/') or '/'
+        for pattern, replacement in cls.ENDPOINT_PATTERNS:
+            path = pattern.sub(replacement, path)
+        return f"{method.upper()} {path}"
+
+    def send(self, send_request, method, url, *args, **kwargs):
+        """Send a request through the limiter, retrying on 429/5xx responses."""
+        endpoint = self.endpoint_name(method, url)
+        for attempt in range(self.max_retries + 1):
+            self.bucket.acquire()
+            self.counter.increment()
+            start = time.perf_counter()
+            try:
+                response = send_request(method, url, *args, **kwargs)
+            except Exception:
+                with self.lock:
+                    self.stats[endpoint].errors += 1
+                raise
+            latency = time.perf_counter() - start
+
+            with self.lock:
+                self.stats[endpoint].record(response.status_code, latency)
+            has_ratelimit_headers = self._read_ratelimit_headers(response.headers)
+
+            if response.status_code not in self.RETRY_STATUSES or attempt == self.max_retries:
+                if not has_ratelimit_headers:
+                    self._recover_rate()
+                return response
+
+            delay = self._backoff_delay(response, attempt)
+            logging.warning(f"{endpoint} returned {response.status_code}, retrying in {delay:.1f}s.")
+            with self.lock:
+                self.stats[endpoint].retries += 1
+            if response.status_code == 429:
+                # Throttled: halve the request rate for everyone sharing the bucket
+                self.bucket.set_rate(max(self.bucket.rate / 2, self.max_rate / 10))
+            self.bucket.pause(delay)
+
+    def _backoff_delay(self, response, attempt):
+        retry_after = response.headers.get('retry-after')
+        if retry_after is not None:
+            try:
+                return float(retry_after)
+            except ValueError:
+                pass
+        return self.backoff_base ** attempt + random.uniform(0, 1)
+
+    def _recover_rate(self):
+        """Step the rate back up towards the configured maximum after a throttle."""
+        if self.bucket.rate < self.max_rate:
+            self.bucket.set_rate(min(self.max_rate, self.bucket.rate * 1.1))
+
+    def _read_ratelimit_headers(self, headers):
+        """Fit the request rate to Reddit's rate-limit headers, if present."""
+        remaining = headers.get('x-ratelimit-remaining')
+        reset = headers.get('x-ratelimit-reset')
+        if remaining is None or reset is None:
+            return False
+        remaining, reset = float(remaining), max(float(reset), 1.0)
+        self.ratelimit_remaining, self.ratelimit_reset = remaining, reset
+        if remaining < 1:
+            logging.warning(f"Rate limit exhausted, pausing requests for {reset:.0f}s.")
+            self.bucket.pause(reset)
+        else:
+            # Spread what is left of the window's budget over the rest of it
+            self.bucket.set_rate(min(self.max_rate, remaining / reset))
+        return True
+
+    def get_stats(self):
+        """Per-endpoint request statistics."""
+        with self.lock:
+            return {endpoint: stats.to_dict() for endpoint, stats in self.stats.items()}
+
+    def log_stats(self):
+        for endpoint, stats in sorted(self.get_stats().items()):
+            logging.info(f"{endpoint}: {stats['count']} requests, {stats['retries']} retries, "
+                         f"{stats['errors']} errors, mean latency {stats['mean_latency']:.3f}s, "
+                         f"statuses {stats['status_counts']}")
+        if self.ratelimit_remaining is not None:
+            logging.info(f"Rate limit remaining: {self.ratelimit_remaining:.0f} "
+                         f"(resets in {self.ratelimit_reset:.0f}s)")
+
+
+class ScheduledRequestor(prawcore.Requestor):
+    """
+    prawcore requestor that hands every HTTP request to the transport, which
+    either serves it from its store or sends it through the RequestScheduler.
+    """
+    def __init__(self, *args, scheduler=None, transport=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.scheduler = scheduler
+        self.transport = transport
+
+    def _send(self, method, url, *args, **kwargs):
+        if self.scheduler is None:
+            return super().request(method, url, *args, **kwargs)
+        return self.scheduler.send(super().request, method, url, *args, **kwargs)
+
+    def request(self, method, url, *args, **kwargs):
+        if self.transport is None:
+            return self._send(method, url, *args, **kwargs)
+        return self.transport.send(self._send, method, url, *args, **kwargs)
+
+
 class APIConnection:
-    def __init__(self, client_id, client_secret, user_agent):
+    def __init__(self, client_id, client_secret, user_agent, calls_per_minute=100, burst=10, max_retries=3,
+                 transport=None):
         self.client_id = client_id
         self.client_secret = client_secret
         self.user_agent = user_agent
+        self.transport = transport or HTTPTransport(mode='live')
         self.api_counter = APIQueryCounter()
+        # Shared by every client created from this connection
+        self.scheduler = RequestScheduler(self.api_counter,
+                                          calls_per_minute=calls_per_minute,
+                                          burst=burst,
+                                          max_retries=max_retries)
 
-    def initialise_client(self):
+    def initialise_client(self, transport=None):
+        """
+        Create a Reddit client. transport (default: the connection's own) 
+        decides whether requests go live, are recorded, or are replayed.
+        """
+        transport = transport or self.transport
         truststore.inject_into_ssl()
+        # Replay needs no real credentials, but praw still requires some
+        offline = transport.mode == 'replay'
         reddit = praw.Reddit(
-            client_id=self.client_id,
-            client_secret=self.client_secret,
-            user_agent=self.user_agent
+            client_id=self.client_id or ('replay' if offline else None),
+            client_secret=self.client_secret or ('replay' if offline else None),
+            user_agent=self.user_agent or ('reddit-api replay' if offline else None),
+            requestor_class=ScheduledRequestor,
+            requestor_kwargs={'scheduler': self.scheduler, 'transport': transport}
         )
         return reddit
-    
+
     def make_api_call(self, function, *args, **kwargs):
-        self.api_counter.increment()
+        """Call a praw function. Its HTTP requests are counted by the scheduler."""
         return function(*args, **kwargs)
-    
+
     def get_total_calls(self):
         return self.api_counter.get_count()
 
+    def get_request_stats(self):
+        return self.scheduler.get_stats()
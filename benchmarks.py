@@ -0,0 +1,373 @@
+"""
+Benchmarks for the pipeline's hot paths, mostly offline on synthetic comments.
+
+Usage: python benchmarks.py [--suites firm_matching database sentiment topics parity fetch]
+                            [--comments 20000] [--output results.csv]
+                            [--baseline results.csv --tolerance 0.2]
+
+The topics suite needs small local models, e.g.
+    --embedding-model models/all-MiniLM-L6-v2 --summariser-model models/distilbart-cnn-6-6
+and is skipped without them, as is the parity suite, which checks the
+--backends against fp32 PyTorch on the same models: embedding cosine drift,
+summary ROUGE and throughput. Nothing is downloaded: Hugging Face is set to
+offline mode.
+
+The fetch suite compares the API requests of GetData's fetch strategies
+over the same window. It talks to Reddit (with the REDDIT_* credentials),
+or replays responses stored by transport.py (REDDIT_HTTP_MODE), so it only
+runs when named in --suites.
+
+The exit code is 1 if any benchmark's throughput fell by more
+than --tolerance against --baseline, or a backend is outside --max-drift or
+--min-rouge.
+"""
+import argparse
+import logging
+import os
+import random
+import re
+import string
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+
+from firm_matcher import FirmMatcher
+from synthetic_data import SyntheticCommentGenerator, read_tweet_templates
+
+SUITES = ('firm_matching', 'database', 'sentiment', 'topics', 'parity', 'fetch')
+# Suites that need network access or recorded responses
+OPT_IN_SUITES = ('fetch',)
+
+
+def make_firm_list(n_firms:int, seed:int=42) -> pd.DataFrame:
+    """firms.csv plus synthetic firms with random tickers, up to n_firms rows."""
+    rng = random.Random(seed)
+    firms = pd.read_csv("firms.csv")
+    rows = []
+    tickers = set(firms['ticker'].dropna())
+    while len(firms) + len(rows) < n_firms:
+        ticker = ''.join(rng.choices(string.ascii_uppercase, k=rng.randint(3, 5)))
+        if ticker in tickers:
+            continue
+        tickers.add(ticker)
+        name = ''.join(rng.choices(string.ascii_lowercase, k=rng.randint(5, 9))).capitalize()
+        rows.append({'name': f"{name} Holdings", 'ticker': ticker})
+    return pd.concat([firms, pd.DataFrame(rows)], ignore_index=True).head(n_firms)
+
+
+def make_comments(firms:pd.DataFrame, n_comments:int, mention_rate:float=0.3, seed:int=42) -> list:
+    """Template comments, a share of which mention a random firm."""
+    rng = random.Random(seed)
+    templates = read_tweet_templates()
+    names = firms['name'].tolist() + firms['ticker'].dropna().tolist()
+    comments = []
+    for _ in range(n_comments):
+        template = rng.choice(templates)
+        subject = rng.choice(names) if rng.random() < mention_rate else "my bank"
+        comments.append(template.format(subject))
+    return comments
+
+
+def build_regex_baseline(firm_list_path:str):
+    """The single alternation regex get_comments compiled before FirmMatcher."""
+    df = pd.read_csv(firm_list_path)
+    patterns = df[['name','altname', 'abbreviation', 'ticker','altticker']].fillna('').apply(lambda x: '|'.join(x[x != '']), axis=1).tolist()
+    patterns = [pattern for pattern in set(patterns) if pattern]
+    bounded = ['|'.join(r'\b' + term + r'\b' for term in pattern.split('|')) for pattern in patterns]
+    return re.compile('|'.join(bounded), re.IGNORECASE)
+
+
+def time_it(function, repeats:int=3) -> float:
+    """Best wall time of function() over repeats, in seconds."""
+    best = float('inf')
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def result(benchmark:str, items:int, seconds:float) -> dict:
+    return {'benchmark': benchmark, 'items': items, 'seconds': round(seconds, 4),
+            'items_per_s': round(items / seconds, 1) if seconds else float('inf')}
+
+
+def benchmark_firm_matching(firm_counts:list, n_comments:int, repeats:int=3) -> pd.DataFrame:
+    """Compare the old alternation regex with FirmMatcher as the firm list grows."""
+    results = []
+    for n_firms in firm_counts:
+        firms = make_firm_list(n_firms)
+        comments = make_comments(firms, n_comments)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            firm_list_path = os.path.join(tmp_dir, "firms.csv")
+            firms.to_csv(firm_list_path, index=False)
+            pattern_re = build_regex_baseline(firm_list_path)
+            firm_matcher = FirmMatcher.from_csv(firm_list_path)
+
+        # get_comments used search() once to filter and again for the phrase
+        def run_regex():
+            for comment in comments:
+                if pattern_re.search(comment):
+                    pattern_re.search(comment).group(0)
+
+        def run_matcher():
+            for comment in comments:
+                firm_matcher.find_all(comment)
+
+        regex_time = time_it(run_regex, repeats)
+        matcher_time = time_it(run_matcher, repeats)
+        results.append({
+            'firms': len(firms),
+            'comments': n_comments,
+            'regex_s': round(regex_time, 4),
+            'matcher_s': round(matcher_time, 4),
+            'speedup': round(regex_time / matcher_time, 2)
+        })
+    return pd.DataFrame(results)
+
+
+def run_firm_matching_suite(args) -> list:
+    comparison = benchmark_firm_matching(args.firms, args.comments, args.repeats)
+    print(comparison.to_string(index=False))
+    return [result(f"firm_matching[{row.firms} firms]", row.comments, row.matcher_s)
+            for row in comparison.itertuples()]
+
+
+def run_database_suite(args, comments_df:pd.DataFrame) -> list:
+    """Bulk inserts and the get_data window queries, on a scratch database."""
+    from database import DatabaseManager
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        database_manager = DatabaseManager(os.path.join(tmp_dir, "benchmark.db"))
+        database_manager.connect(wal=True, synchronous='NORMAL', cache_size=-64000, mmap_size=256 * 1024**2)
+        database_manager.create_raw_table()
+
+        start = time.perf_counter()
+        for i in range(0, len(comments_df), 500):
+            database_manager.insert_new_comments(comments_df.iloc[i:i + 500])
+        results.append(result("database.insert_new_comments", len(comments_df), time.perf_counter() - start))
+
+        # Second pass: every row is already present
+        start = time.perf_counter()
+        for i in range(0, len(comments_df), 500):
+            database_manager.insert_new_comments(comments_df.iloc[i:i + 500])
+        results.append(result("database.insert_new_comments[existing]", len(comments_df), time.perf_counter() - start))
+
+        queries = {
+            "database.get_data[7 days]": dict(n_previous_days=7, columns=['comment_id', 'comment']),
+            "database.get_data[1 day]": dict(n_previous_days=1),
+            "database.get_data[1 firm]": dict(n_previous_days=7, firms=[comments_df.loc[comments_df['firm'] != '', 'firm'].mode().iloc[0]]),
+        }
+        for name, kwargs in queries.items():
+            rows = []
+            seconds = time_it(lambda: rows.append(len(database_manager.get_data(**kwargs))), args.repeats)
+            results.append(result(name, rows[-1], seconds))
+        database_manager.close()
+    return results
+
+
+def run_sentiment_suite(args, comments_df:pd.DataFrame) -> list:
+    import analytics as an
+
+    df = comments_df[['comment_id', 'comment']]
+    results = []
+    # Fresh cache each time, so every text is scored
+    seconds = time_it(lambda: an.get_sentiment(df, 'comment', cache=an.SentimentCache()), args.repeats)
+    results.append(result("sentiment.get_sentiment", len(df), seconds))
+    warm_cache = an.SentimentCache()
+    an.get_sentiment(df, 'comment', cache=warm_cache)
+    seconds = time_it(lambda: an.get_sentiment(df, 'comment', cache=warm_cache), args.repeats)
+    results.append(result("sentiment.get_sentiment[cached]", len(df), seconds))
+    return results
+
+
+def run_topics_suite(args, comments_df:pd.DataFrame) -> list:
+    if not args.embedding_model or not args.summariser_model:
+        logging.warning("Skipping the topics suite: --embedding-model and --summariser-model are needed.")
+        return []
+    import analytics as an
+
+    comments = comments_df['comment'].head(args.topic_comments).tolist()
+    results = []
+    start = time.perf_counter()
+    topics, topic_info, embeddings = an.get_topics(comments, embedding_model_path=args.embedding_model,
+                                                   hdbscan_min_cluster_size=10, return_embeddings=True)
+    results.append(result("topics.get_topics", len(comments), time.perf_counter() - start))
+
+    start = time.perf_counter()
+    summary_df = an.topic_summarisation(comments, topics, topic_info, embeddings=embeddings,
+                                        model_path=args.summariser_model)
+    results.append(result("topics.topic_summarisation", len(summary_df), time.perf_counter() - start))
+
+    texts = comments[:args.summaries]
+    seconds = time_it(lambda: an.summarise_many(texts, model_path=args.summariser_model), 1)
+    results.append(result("topics.summarise_many", len(texts), seconds))
+    return results
+
+
+def rouge_l(summaries:list, references:list)->float:
+    """Mean ROUGE-L F1 of summaries against references, with the rouge package."""
+    from rouge import Rouge
+
+    # rouge can't score empty text
+    pairs = [(summary, reference) for summary, reference in zip(summaries, references)
+             if summary.strip() and reference.strip()]
+    if not pairs:
+        return float('nan')
+    scores = Rouge().get_scores([summary for summary, _ in pairs], [reference for _, reference in pairs], avg=True)
+    return scores['rouge-l']['f']
+
+
+def run_parity_suite(args, comments_df:pd.DataFrame) -> tuple:
+    """
+    Each of args.backends against fp32 PyTorch: cosine drift of the comment
+    embeddings and ROUGE-L of the summaries, taking the fp32 outputs as the
+    reference, plus the throughput of both. Returns the results and the
+    backends outside args.max_drift or args.min_rouge.
+    """
+    if not args.embedding_model or not args.summariser_model:
+        logging.warning("Skipping the parity suite: --embedding-model and --summariser-model are needed.")
+        return [], []
+    import analytics as an
+    from model_registry import registry
+
+    comments = comments_df['comment'].head(args.topic_comments).tolist()
+    texts = comments[:args.summaries]
+    threads = dict(intra_op_threads=args.intra_op_threads, inter_op_threads=args.inter_op_threads)
+    results, failures, reference = [], [], {}
+    for backend in ['torch'] + [backend for backend in args.backends if backend != 'torch']:
+        embedding_model = an.load_embedding_model(args.embedding_model, backend, **threads)
+        start = time.perf_counter()
+        embeddings = np.asarray(embedding_model.encode(comments, batch_size=32))
+        embed_s = time.perf_counter() - start
+        # Load before timing, so only inference is measured
+        an.load_summariser(args.summariser_model, backend, **threads)
+        start = time.perf_counter()
+        summaries = an.summarise_many(texts, model_path=args.summariser_model, backend=backend, **threads)
+        summarise_s = time.perf_counter() - start
+
+        if backend == 'torch':
+            reference = {'embeddings': embeddings, 'summaries': summaries}
+            drift, rouge = 0.0, 1.0
+        else:
+            cosine = (embeddings * reference['embeddings']).sum(axis=1) / (
+                np.linalg.norm(embeddings, axis=1) * np.linalg.norm(reference['embeddings'], axis=1))
+            drift = float(np.max(1 - cosine))
+            rouge = rouge_l(summaries, reference['summaries'])
+            if drift > args.max_drift or rouge < args.min_rouge:
+                failures.append({'backend': backend, 'max_cosine_drift': drift, 'rouge_l': rouge})
+        results.append({**result(f"parity.embed[{backend}]", len(comments), embed_s), 'max_cosine_drift': round(drift, 5)})
+        results.append({**result(f"parity.summarise[{backend}]", len(texts), summarise_s), 'rouge_l': round(rouge, 4)})
+
+        # Keep one backend's models in memory at a time
+        for key in list(registry.memory_usage()):
+            if key[0] in ('sentence-transformer', 'bart') and key[2] == backend:
+                registry.unload(key)
+    return results, failures
+
+
+def run_fetch_suite(args) -> list:
+    """Requests each fetch strategy makes to collect up to args.fetch_target comments from the last args.fetch_hours."""
+    from api import APIConnection
+    from transport import HTTPTransport
+    from get_data import GetData, FETCH_STRATEGIES
+
+    transport = HTTPTransport(mode=os.environ.get("REDDIT_HTTP_MODE", "live"),
+                              store_path=os.environ.get("REDDIT_HTTP_STORE", "http_store"))
+    api_connection = APIConnection(os.environ.get("REDDIT_CLIENT_ID"), os.environ.get("REDDIT_CLIENT_SECRET"),
+                                   os.environ.get("REDDIT_USER_AGENT"), transport=transport)
+    since = datetime.now() - timedelta(hours=args.fetch_hours)
+    results = []
+    for strategy in FETCH_STRATEGIES:
+        # No database, so no cursors: both crawl the whole window
+        data = GetData(api_connection, "firms.csv", args.subreddits, max_workers=1, fetch_strategy=strategy)
+        calls_before = api_connection.get_total_calls()
+        start = time.perf_counter()
+        df = data.get_comments(args.fetch_target, since)
+        seconds = time.perf_counter() - start
+        requests = api_connection.get_total_calls() - calls_before
+        results.append({**result(f"fetch[{strategy}]", len(df), seconds), 'requests': requests,
+                        'comments_per_request': round(len(df) / requests, 2) if requests else None})
+    return results
+
+
+def compare_to_baseline(results:pd.DataFrame, baseline_path:str, tolerance:float) -> pd.DataFrame:
+    """Benchmarks whose throughput fell by more than tolerance against a saved run."""
+    baseline = pd.read_csv(baseline_path)[['benchmark', 'items_per_s']]
+    merged = results.merge(baseline, on='benchmark', suffixes=('', '_baseline'))
+    merged['change'] = merged['items_per_s'] / merged['items_per_s_baseline'] - 1
+    return merged[merged['change'] < -tolerance]
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--suites", nargs="+", choices=SUITES, default=[suite for suite in SUITES if suite not in OPT_IN_SUITES])
+    parser.add_argument("--firms", type=int, nargs="+", default=[33, 1000, 5000])
+    parser.add_argument("--comments", type=int, default=20000)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--duplicate-rate", type=float, default=0.05)
+    parser.add_argument("--embedding-model", help="local sentence-transformers model for the topics suite")
+    parser.add_argument("--summariser-model", help="local BART model for the topics suite")
+    parser.add_argument("--topic-comments", type=int, default=2000)
+    parser.add_argument("--summaries", type=int, default=16)
+    parser.add_argument("--backends", nargs="+", choices=('torch', 'int8', 'onnx'), default=['int8', 'onnx'],
+                        help="inference backends the parity suite checks against fp32 PyTorch")
+    parser.add_argument("--intra-op-threads", type=int)
+    parser.add_argument("--inter-op-threads", type=int)
+    parser.add_argument("--max-drift", type=float, default=0.02, help="largest allowed 1 - cosine similarity to fp32")
+    parser.add_argument("--min-rouge", type=float, default=0.5, help="lowest allowed ROUGE-L F1 against fp32 summaries")
+    parser.add_argument("--subreddits", nargs="+", default=['wallstreetbets', 'stocks'], help="subreddits for the fetch suite")
+    parser.add_argument("--fetch-hours", type=float, default=2)
+    parser.add_argument("--fetch-target", type=int, default=1000)
+    parser.add_argument("--output", help="save the results to this CSV")
+    parser.add_argument("--baseline", help="CSV from an earlier --output run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+
+    # Only ever use models already on disk
+    os.environ.setdefault("HF_HUB_OFFLINE", "1")
+    os.environ.setdefault("TRANSFORMERS_OFFLINE", "1")
+
+    comments_df = SyntheticCommentGenerator(duplicate_rate=args.duplicate_rate).generate(args.comments)
+    results, parity_failures = [], []
+    for suite in args.suites:
+        try:
+            if suite == 'firm_matching':
+                results += run_firm_matching_suite(args)
+            elif suite == 'database':
+                results += run_database_suite(args, comments_df)
+            elif suite == 'sentiment':
+                results += run_sentiment_suite(args, comments_df)
+            elif suite == 'topics':
+                results += run_topics_suite(args, comments_df)
+            elif suite == 'parity':
+                parity_results, parity_failures = run_parity_suite(args, comments_df)
+                results += parity_results
+            elif suite == 'fetch':
+                results += run_fetch_suite(args)
+        except (ImportError, LookupError, OSError) as e:
+            # Missing package, NLTK data or local model
+            logging.warning(f"Skipping the {suite} suite: {e}")
+
+    results = pd.DataFrame(results)
+    print(results.to_string(index=False))
+    if args.output:
+        results.to_csv(args.output, index=False)
+    failed = False
+    if args.baseline and not results.empty:
+        regressions = compare_to_baseline(results, args.baseline, args.tolerance)
+        if not regressions.empty:
+            print("\nThroughput regressions:")
+            print(regressions.to_string(index=False))
+            failed = True
+    if parity_failures:
+        print("\nBackends outside the parity limits:")
+        print(pd.DataFrame(parity_failures).to_string(index=False))
+        failed = True
+    sys.exit(1 if failed else 0)
@@ -1,33 +1,160 @@
+import numpy as np
 import pandas as pd
 import sqlite3
 import logging
+import os
+from contextlib import contextmanager
 from datetime import datetime, timedelta
+from urllib.request import pathname2url
 
+from firm_matcher import FirmMatcher
+from records import CommentBatch, COMMENT_COLUMNS
+from telemetry import recorder
+
+# Columns of archived comments: the comments table plus their sentiment
+ARCHIVE_COLUMNS = ['comment_id', 'post_title', 'subreddit', 'comment_date', 'comment', 'matched_phrase',
+                   'upvotes', 'firm', 'comment_epoch', 'compound', 'sentiment']
+# Low-cardinality columns, stored dictionary encoded
+ARCHIVE_DICTIONARY_COLUMNS = ['subreddit', 'firm', 'sentiment']
+
+def id_chunks(ids, size:int=500):
+    """
+    Split ids into lists of at most size, each with its '?,?,...' 
+    placeholders, to stay under SQLite's limit on bound parameters.
+    """
+    ids = list(ids)
+    for i in range(0, len(ids), size):
+        chunk = ids[i:i + size]
+        yield chunk, ','.join('?' * len(chunk))
+
+def date_to_epoch(comment_date):
+    """Convert a local 'YYYY-MM-DD HH:MM:SS' comment_date to epoch seconds."""
+    try:
+        return int(datetime.strptime(comment_date, '%Y-%m-%d %H:%M:%S').timestamp())
+    except (TypeError, ValueError):
+        return None
+
+def archive_schema():
+    """Arrow schema of the Parquet archive (pyarrow is only needed for archiving)."""
+    import pyarrow as pa
+    types = {'upvotes': pa.int64(), 'comment_epoch': pa.int64(), 'compound': pa.float64()}
+    return pa.schema([(column, pa.dictionary(pa.int32(), pa.string()) if column in ARCHIVE_DICTIONARY_COLUMNS 
+                       else types.get(column, pa.string())) 
+                      for column in ARCHIVE_COLUMNS])
+
+@recorder.instrument_methods()
 class DatabaseManager:
-    def __init__(self, db_path):
+    def __init__(self, db_path, archive_dir:str="archive"):
         self.db_path = db_path
+        self.archive_dir = archive_dir
         self.conn = None
+        self.connect_kwargs = {}
 
-    def connect(self):
-        """Establish a database connection."""
-        self.conn = sqlite3.connect(self.db_path)
+    def connect(self, wal:bool=False, synchronous:str=None, cache_size:int=None, mmap_size:int=None,
+                read_only:bool=False):
+        """
+        Establish a database connection, optionally tuning it for bulk writes.
+
+        Params:
+        -------
+        * wal `bool`: use write-ahead logging, so readers don't block the writer.
+        * synchronous `str`: PRAGMA synchronous level, e.g. 'NORMAL' (safe with WAL).
+        * cache_size `int`: PRAGMA cache_size - pages, or KiB if negative.
+        * mmap_size `int`: PRAGMA mmap_size in bytes.
+        * read_only `bool`: open the database read-only (wal and synchronous
+          are ignored). The connection may be used from any thread, one at 
+          a time, so it can be pooled.
+        """
+        self.connect_kwargs = {'wal': wal, 'synchronous': synchronous, 'cache_size': cache_size, 'mmap_size': mmap_size,
+                               'read_only': read_only}
+        if read_only:
+            uri = f"file:{pathname2url(os.path.abspath(self.db_path))}?mode=ro"
+            self.conn = sqlite3.connect(uri, uri=True, timeout=30, check_same_thread=False)
+        else:
+            # Wait for other connections' write transactions rather than failing straight away
+            self.conn = sqlite3.connect(self.db_path, timeout=30)
+        if wal and not read_only:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+        if synchronous is not None and not read_only:
+            self.conn.execute(f"PRAGMA synchronous={synchronous}")
+        if cache_size is not None:
+            self.conn.execute(f"PRAGMA cache_size={int(cache_size)}")
+        if mmap_size is not None:
+            self.conn.execute(f"PRAGMA mmap_size={int(mmap_size)}")
         logging.info("Database connection established.")
 
-    def get_data(self, n_previous_days:int):
-        """Retrieve data from comments table for past n days"""
+    def copy(self):
+        """
+        A new DatabaseManager connected to the same database with the same 
+        settings. sqlite connections can't be shared between threads, so 
+        each pipeline stage running in a worker thread uses its own.
+        """
+        database_manager = DatabaseManager(self.db_path, archive_dir=self.archive_dir)
+        database_manager.connect(**self.connect_kwargs)
+        return database_manager
+
+    @contextmanager
+    def _immediate_transaction(self):
+        """
+        A transaction that takes the write lock as it begins, committed on 
+        success and rolled back on error. A transaction that reads before 
+        it writes would otherwise fail with 'database is locked', without 
+        waiting, if another connection commits in between.
+        """
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield self.conn
+        except BaseException:
+            self.conn.rollback()
+            raise
+        self.conn.commit()
+
+    def get_data(self, n_previous_days:int, columns:list=None, firms:list=None, subreddits:list=None,
+                 chunksize:int=None):
+        """
+        Retrieve data from comments table for past n days. The date range is
+        read through the comment_epoch index.
+
+        Params:
+        -------
+        * n_previous_days `int`: number of days back from now to include.
+        * columns `list`: columns to return (default: all).
+        * firms `list`: only return comments matched to these firms.
+        * subreddits `list`: only return comments from these subreddits.
+        * chunksize `int`: if given, return an iterator of DataFrames with 
+          up to chunksize rows each, instead of one DataFrame.
+        """
         today = datetime.now()
         n_days_ago = today - timedelta(days=n_previous_days)
-        query = """
-        SELECT * FROM comments
-        WHERE comment_date >= ?
+
+        if columns:
+            table_columns = {row[1] for row in self.conn.execute("PRAGMA table_info(comments)")}
+            unknown_columns = set(columns) - table_columns
+            if unknown_columns:
+                raise ValueError(f"Unknown columns for 'comments' table: {sorted(unknown_columns)}")
+        projection = ', '.join(columns) if columns else '*'
+
+        conditions = ["comment_epoch >= ?"]
+        params = [int(n_days_ago.timestamp())]
+        for column, values in (('firm', firms), ('subreddit', subreddits)):
+            if values:
+                conditions.append(f"{column} IN ({', '.join('?' * len(values))})")
+                params.extend(values)
+
+        query = f"""
+        SELECT {projection} FROM comments
+        WHERE {' AND '.join(conditions)}
         """
-        df = pd.read_sql_query(query, self.conn, params=[n_days_ago])
-        return df
+        return pd.read_sql_query(query, self.conn, params=params, chunksize=chunksize)
     
     ### --- Raw data table --- ###
 
-    def create_raw_table(self):
-        """Create the comments table if it doesn't exist."""
+    def create_raw_table(self, firm_list_path:str="firms.csv"):
+        """
+        Create the comments table if it doesn't exist. Rows stored before 
+        the firm column existed get the firm of their matched_phrase, as
+        firm_list_path's FirmMatcher names it.
+        """
         create_table_sql = """
         CREATE TABLE IF NOT EXISTS comments (
             comment_id TEXT PRIMARY KEY,
@@ -36,37 +163,120 @@ class DatabaseManager:
             comment_date TEXT,
             comment TEXT,
             matched_phrase TEXT,
-            upvotes INTEGER
+            upvotes INTEGER,
+            firm TEXT,
+            comment_epoch INTEGER
         );
         """
         cursor = self.conn.cursor()
         cursor.execute(create_table_sql)
+        self.add_missing_columns('comments', {'firm': 'TEXT', 'comment_epoch': 'INTEGER'})
+        # Fill comment_epoch for rows written before the column existed
+        self.conn.create_function('local_epoch', 1, date_to_epoch, deterministic=True)
+        cursor.execute("""
+        UPDATE comments SET comment_epoch = local_epoch(comment_date)
+        WHERE comment_epoch IS NULL
+        """)
+        self._fill_missing_firms(firm_list_path)
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_comments_epoch ON comments (comment_epoch)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_comments_date ON comments (comment_date)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_comments_subreddit_epoch ON comments (subreddit, comment_epoch)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_comments_firm_epoch ON comments (firm, comment_epoch)")
         self.conn.commit()
         logging.info("Table 'comments' ready.")
 
-    def get_existing_comment_ids(self, table):
-        """Fetch existing comment IDs from the database."""
-        query = f"SELECT comment_id FROM {table}"
-        existing_ids = pd.read_sql(query, self.conn)
-        return set(existing_ids['comment_id'])
+    def _fill_missing_firms(self, firm_list_path:str):
+        """Set firm from matched_phrase where it is NULL, i.e. for rows written before the column existed."""
+        if self.conn.execute("SELECT 1 FROM comments WHERE firm IS NULL LIMIT 1").fetchone() is None:
+            return
+        if not os.path.exists(firm_list_path):
+            logging.warning(f"'{firm_list_path}' not found, leaving the firm of older comments unset.")
+            return
+        matcher = FirmMatcher.from_csv(firm_list_path)
+
+        def firm_of(matched_phrase):
+            match = matcher.search(matched_phrase)
+            return match.firm if match else ''
+
+        self.conn.create_function('firm_of', 1, firm_of, deterministic=True)
+        filled = self.conn.execute("UPDATE comments SET firm = firm_of(matched_phrase) WHERE firm IS NULL").rowcount
+        logging.info(f"Set the firm of {filled} comments stored before the firm column existed.")
+
+    def add_missing_columns(self, table, columns:dict):
+        """Add columns to a table created by an older version of the schema."""
+        cursor = self.conn.cursor()
+        existing_columns = {row[1] for row in cursor.execute(f"PRAGMA table_info({table})")}
+        for column, column_type in columns.items():
+            if column not in existing_columns:
+                cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {column_type}")
+                logging.info(f"Added column '{column}' to '{table}' table.")
+
+    def get_existing_ids(self, table:str, comment_ids)->set:
+        """Return which of the given comment IDs are already in table."""
+        existing_ids = set()
+        for batch, placeholders in id_chunks(comment_ids):
+            query = f"SELECT comment_id FROM {table} WHERE comment_id IN ({placeholders})"
+            existing_ids.update(row[0] for row in self.conn.execute(query, batch))
+        return existing_ids
+
+    def bulk_insert(self, table:str, df:pd.DataFrame):
+        """
+        Insert the rows of df into table in one transaction, leaving SQLite
+        to skip rows whose primary key already exists. Columns of df that 
+        the table doesn't have are ignored.
+
+        Returns:
+        --------
+        (inserted, skipped) `tuple`: number of rows written and skipped.
+        """
+        table_columns = [row[1] for row in self.conn.execute(f"PRAGMA table_info({table})")]
+        columns = [column for column in df.columns if column in table_columns]
+        if df.empty or not columns:
+            return 0, 0
+
+        # Plain Python values, with NaN as NULL
+        values = df[columns].astype(object).where(df[columns].notna(), None).values.tolist()
+        inserted = self._insert_rows(table, columns, values)
+        return inserted, len(values) - inserted
+
+    def _insert_rows(self, table:str, columns, rows)->int:
+        """INSERT OR IGNORE rows (any iterable of tuples) in one transaction. Returns the number inserted."""
+        insert_sql = f"""
+        INSERT OR IGNORE INTO {table} ({', '.join(columns)})
+        VALUES ({', '.join('?' * len(columns))})
+        """
+        changes_before = self.conn.total_changes
+        with self.conn:
+            self.conn.executemany(insert_sql, rows)
+        return self.conn.total_changes - changes_before
 
     def insert_new_comments(self, df):
-        """Insert new comments into the database, avoiding duplicates."""
+        """
+        Insert new comments into the database, avoiding duplicates. df is a
+        DataFrame or a CommentBatch, whose records are written directly.
+        """
         if self.conn is None:
             logging.error("Database connection not established.")
-            return
+            return 0, 0
 
-        existing_comment_ids = self.get_existing_comment_ids(table='comments')
-        df_new_comments = df[~df['comment_id'].isin(existing_comment_ids)]
+        if isinstance(df, CommentBatch):
+            inserted = self._insert_rows('comments', COMMENT_COLUMNS, df.rows(COMMENT_COLUMNS))
+            skipped = len(df) - inserted
+            logging.info(f"Inserted {inserted} new comments into 'comments' table ({skipped} already present).")
+            return inserted, skipped
 
-        if not df_new_comments.empty:
-            df_new_comments.to_sql(name='comments', 
-                                   con=self.conn, 
-                                   if_exists='append', 
-                                   index=False)
-            logging.info("New data inserted successfully into 'comments' table")
-        else:
-            logging.info("No new comments to insert into 'comments' table.")
+        # Keep comment_epoch in step with comment_date
+        if 'comment_date' in df.columns:
+            if 'comment_epoch' not in df.columns:
+                df = df.assign(comment_epoch=None)
+            missing_epoch = df['comment_epoch'].isna()
+            if missing_epoch.any():
+                df = df.copy()
+                df.loc[missing_epoch, 'comment_epoch'] = df.loc[missing_epoch, 'comment_date'].map(date_to_epoch)
+
+        inserted, skipped = self.bulk_insert('comments', df)
+        logging.info(f"Inserted {inserted} new comments into 'comments' table ({skipped} already present).")
+        return inserted, skipped
     
     ### --- Sentiment table --- ###
 
@@ -84,23 +294,402 @@ class DatabaseManager:
         self.conn.commit()
         logging.info("Table 'sentiment' ready.")
     
+    def get_unscored_comments(self, n_previous_days:int)->pd.DataFrame:
+        """Comments from the past n days that have no row in the sentiment table yet."""
+        since = int((datetime.now() - timedelta(days=n_previous_days)).timestamp())
+        query = """
+        SELECT c.comment_id, c.comment FROM comments c
+        LEFT JOIN sentiment s ON s.comment_id = c.comment_id
+        WHERE c.comment_epoch >= ? AND s.comment_id IS NULL
+        """
+        return pd.read_sql(query, self.conn, params=(since,))
+
+    def iter_unscored_comments(self, n_previous_days:int, chunksize:int=50_000):
+        """
+        get_unscored_comments in DataFrames of up to chunksize rows, so a 
+        long backfill window is never held in memory at once. Each chunk is
+        a fresh query after the last comment_id seen, so the caller can 
+        write scores for a chunk before asking for the next.
+        """
+        since = int((datetime.now() - timedelta(days=n_previous_days)).timestamp())
+        query = """
+        SELECT c.comment_id, c.comment FROM comments c
+        LEFT JOIN sentiment s ON s.comment_id = c.comment_id
+        WHERE c.comment_epoch >= ? AND s.comment_id IS NULL AND c.comment_id > ?
+        ORDER BY c.comment_id
+        LIMIT ?
+        """
+        last_id = ''
+        while True:
+            chunk = pd.read_sql(query, self.conn, params=(since, last_id, chunksize))
+            if chunk.empty:
+                return
+            yield chunk
+            last_id = chunk['comment_id'].iloc[-1]
+
     def update_sentiment_table(self, df):
-        """Insert new data into the sentiment table."""
+        """
+        Insert new data into the sentiment table and add the new rows to the
+        sentiment_daily rollup, in one transaction. Rows whose comment_id is 
+        already scored are skipped, so nothing is counted twice.
+        """
         if self.conn is None:
             logging.error("Database connection not established.")
-            return
+            return 0, 0
+        if df.empty:
+            return 0, 0
 
-        existing_comment_ids = self.get_existing_comment_ids(table='sentiment')
-        df_new_comments = df[~df['comment_id'].isin(existing_comment_ids)]
+        rows = df[['comment_id', 'compound', 'sentiment']]
+        values = rows.astype(object).where(rows.notna(), None).values.tolist()
+        # Checks the stored scores before writing, so take the write lock first
+        with self._immediate_transaction():
+            # Stage the batch, keeping only comments not scored yet
+            self.conn.execute("""
+            CREATE TEMP TABLE IF NOT EXISTS sentiment_staging (
+                comment_id TEXT PRIMARY KEY,
+                compound FLOAT,
+                sentiment TEXT
+            )
+            """)
+            self.conn.execute("DELETE FROM sentiment_staging")
+            self.conn.executemany("INSERT OR IGNORE INTO sentiment_staging VALUES (?, ?, ?)", values)
+            self.conn.execute("""
+            DELETE FROM sentiment_staging WHERE comment_id IN (SELECT comment_id FROM sentiment)
+            """)
+            inserted = self.conn.execute("SELECT COUNT(*) FROM sentiment_staging").fetchone()[0]
+            self.conn.execute("""
+            INSERT INTO sentiment (comment_id, compound, sentiment) 
+            SELECT comment_id, compound, sentiment FROM sentiment_staging
+            """)
+            self._add_to_sentiment_rollup('sentiment_staging')
+        skipped = len(values) - inserted
+        logging.info(f"Inserted {inserted} new rows into 'sentiment' table ({skipped} already present).")
+        return inserted, skipped
 
-        if not df_new_comments.empty:
-            df_new_comments.to_sql(name='sentiment', 
-                                   con=self.conn, 
-                                   if_exists='append', 
-                                   index=False)
-            logging.info("New data inserted successfully into 'sentiment' table.")
-        else:
-            logging.info("No new data to insert into 'sentiment' table.")
+    ### --- Sentiment rollup table --- ###
+
+    def create_sentiment_rollup_table(self):
+        """
+        Create the sentiment_daily rollup if it doesn't exist: per firm, 
+        subreddit and day, the running sums from which sentiment_daily_stats
+        derives count, mean and population variance of compound, label counts and the 
+        upvote-weighted score. Built from the stored sentiment when new.
+        """
+        create_table_sql = """
+        CREATE TABLE IF NOT EXISTS sentiment_daily (
+            firm TEXT,
+            subreddit TEXT,
+            day TEXT,
+            n INTEGER,
+            sum_compound REAL,
+            sum_sq_compound REAL,
+            positive INTEGER,
+            negative INTEGER,
+            neutral INTEGER,
+            sum_weight REAL,
+            sum_weighted_compound REAL,
+            PRIMARY KEY (firm, subreddit, day)
+        );
+        """
+        # Upvotes weigh a comment as upvotes + 1, so unvoted comments still count
+        create_view_sql = """
+        CREATE VIEW IF NOT EXISTS sentiment_daily_stats AS
+        SELECT firm, subreddit, day, n,
+               sum_compound / n AS mean_compound,
+               MAX(sum_sq_compound / n - (sum_compound / n) * (sum_compound / n), 0) AS var_compound,
+               positive, negative, neutral,
+               sum_weighted_compound / sum_weight AS upvote_weighted_compound
+        FROM sentiment_daily
+        """
+        cursor = self.conn.cursor()
+        cursor.execute(create_table_sql)
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_sentiment_daily_day ON sentiment_daily (day)")
+        cursor.execute(create_view_sql)
+        self.conn.commit()
+        if self.conn.execute("SELECT 1 FROM sentiment_daily LIMIT 1").fetchone() is None:
+            self.rebuild_sentiment_rollup()
+        logging.info("Table 'sentiment_daily' ready.")
+
+    def _add_to_sentiment_rollup(self, source_table:str):
+        """Add the sentiment rows in source_table to sentiment_daily. Caller manages the transaction."""
+        # WHERE true lets SQLite tell the upsert's ON CONFLICT from a join constraint
+        self.conn.execute(f"""
+        INSERT INTO sentiment_daily (firm, subreddit, day, n, sum_compound, sum_sq_compound, 
+                                     positive, negative, neutral, sum_weight, sum_weighted_compound)
+        SELECT COALESCE(c.firm, ''), c.subreddit, substr(c.comment_date, 1, 10),
+               COUNT(*), SUM(s.compound), SUM(s.compound * s.compound),
+               SUM(s.sentiment = 'POSITIVE'), SUM(s.sentiment = 'NEGATIVE'), SUM(s.sentiment = 'NEUTRAL'),
+               SUM(MAX(COALESCE(c.upvotes, 0), 0) + 1), 
+               SUM((MAX(COALESCE(c.upvotes, 0), 0) + 1) * s.compound)
+        FROM {source_table} s JOIN comments c ON c.comment_id = s.comment_id
+        WHERE true
+        GROUP BY 1, 2, 3
+        ON CONFLICT (firm, subreddit, day) DO UPDATE SET
+            n = n + excluded.n,
+            sum_compound = sum_compound + excluded.sum_compound,
+            sum_sq_compound = sum_sq_compound + excluded.sum_sq_compound,
+            positive = positive + excluded.positive,
+            negative = negative + excluded.negative,
+            neutral = neutral + excluded.neutral,
+            sum_weight = sum_weight + excluded.sum_weight,
+            sum_weighted_compound = sum_weighted_compound + excluded.sum_weighted_compound
+        """)
+
+    def rebuild_sentiment_rollup(self):
+        """Recompute sentiment_daily from the sentiment and comments tables."""
+        with self.conn:
+            self.conn.execute("DELETE FROM sentiment_daily")
+            self._add_to_sentiment_rollup('sentiment')
+        logging.info("Rebuilt 'sentiment_daily' rollup.")
+
+    def get_sentiment_trend(self, n_previous_days:int, firms:list=None, subreddits:list=None, 
+                            by_subreddit:bool=False)->pd.DataFrame:
+        """
+        Daily sentiment per firm over the past n days, read from the rollup.
+
+        Params:
+        -------
+        * n_previous_days `int`: number of days back from today to include.
+        * firms `list`: only these firms (canonical names from firms.csv).
+        * subreddits `list`: only these subreddits.
+        * by_subreddit `bool`: one row per subreddit too, instead of combining them.
+        """
+        since = (datetime.now() - timedelta(days=n_previous_days)).strftime('%Y-%m-%d')
+        conditions, params = ["day >= ?"], [since]
+        if firms:
+            conditions.append(f"firm IN ({','.join('?' * len(firms))})")
+            params += list(firms)
+        if subreddits:
+            conditions.append(f"subreddit IN ({','.join('?' * len(subreddits))})")
+            params += list(subreddits)
+        group_columns = "firm, subreddit, day" if by_subreddit else "firm, day"
+        query = f"""
+        SELECT {group_columns}, SUM(n) AS n,
+               SUM(sum_compound) / SUM(n) AS mean_compound,
+               MAX(SUM(sum_sq_compound) / SUM(n) - (SUM(sum_compound) / SUM(n)) * (SUM(sum_compound) / SUM(n)), 0) AS var_compound,
+               SUM(positive) AS positive, SUM(negative) AS negative, SUM(neutral) AS neutral,
+               SUM(sum_weighted_compound) / SUM(sum_weight) AS upvote_weighted_compound
+        FROM sentiment_daily
+        WHERE {' AND '.join(conditions)}
+        GROUP BY {group_columns}
+        ORDER BY {group_columns}
+        """
+        return pd.read_sql(query, self.conn, params=params)
+
+    def get_comment_sample(self, firm:str, n_previous_days:int=7, limit:int=20)->pd.DataFrame:
+        """The most upvoted comments about firm from the past n days, with their sentiment."""
+        since = int((datetime.now() - timedelta(days=n_previous_days)).timestamp())
+        query = """
+        SELECT c.comment_id, c.subreddit, c.post_title, c.comment_date, c.comment, c.matched_phrase, 
+               c.upvotes, s.compound, s.sentiment
+        FROM comments c LEFT JOIN sentiment s ON s.comment_id = c.comment_id
+        WHERE c.firm = ? AND c.comment_epoch >= ?
+        ORDER BY c.upvotes DESC, c.comment_epoch DESC
+        LIMIT ?
+        """
+        return pd.read_sql(query, self.conn, params=(firm, since, int(limit)))
+
+    def get_data_version(self)->int:
+        """PRAGMA data_version: changes whenever another connection commits to the database."""
+        return self.conn.execute("PRAGMA data_version").fetchone()[0]
+
+    ### --- Crawl cursor tables --- ###
+
+    def create_cursor_tables(self):
+        """Create the tables holding the crawl high-water marks if they don't exist."""
+        create_subreddit_sql = """
+        CREATE TABLE IF NOT EXISTS subreddit_cursors (
+            subreddit TEXT PRIMARY KEY,
+            newest_post_utc FLOAT,
+            updated_at TEXT
+        );
+        """
+        create_post_sql = """
+        CREATE TABLE IF NOT EXISTS post_cursors (
+            post_id TEXT PRIMARY KEY,
+            subreddit TEXT,
+            post_created_utc FLOAT,
+            num_comments INTEGER,
+            newest_comment_utc FLOAT,
+            updated_at TEXT
+        );
+        """
+        cursor = self.conn.cursor()
+        cursor.execute(create_subreddit_sql)
+        cursor.execute(create_post_sql)
+        # Newest comment seen in the subreddit's comment listing
+        self.add_missing_columns('subreddit_cursors', {'newest_comment_utc': 'FLOAT'})
+        self.conn.commit()
+        logging.info("Tables 'subreddit_cursors' and 'post_cursors' ready.")
+
+    def get_subreddit_cursor(self, subreddit:str):
+        """Get the creation time of the newest post seen in a subreddit, if any."""
+        row = self.conn.execute("SELECT newest_post_utc FROM subreddit_cursors WHERE subreddit = ?", 
+                                (subreddit,)).fetchone()
+        return row[0] if row else None
+
+    def update_subreddit_cursor(self, subreddit:str, newest_post_utc:float):
+        """Move a subreddit's newest post mark forward."""
+        self.conn.execute("""
+        INSERT INTO subreddit_cursors (subreddit, newest_post_utc, updated_at) VALUES (?, ?, ?)
+        ON CONFLICT(subreddit) DO UPDATE SET 
+            newest_post_utc = MAX(COALESCE(newest_post_utc, 0), excluded.newest_post_utc),
+            updated_at = excluded.updated_at
+        """, (subreddit, newest_post_utc, datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
+        self.conn.commit()
+
+    def get_subreddit_comment_cursor(self, subreddit:str):
+        """Get the creation time of the newest comment seen in a subreddit's comment listing, if any."""
+        row = self.conn.execute("SELECT newest_comment_utc FROM subreddit_cursors WHERE subreddit = ?", 
+                                (subreddit,)).fetchone()
+        return row[0] if row else None
+
+    def update_subreddit_comment_cursor(self, subreddit:str, newest_comment_utc:float):
+        """Move a subreddit's newest comment mark forward."""
+        self.conn.execute("""
+        INSERT INTO subreddit_cursors (subreddit, newest_comment_utc, updated_at) VALUES (?, ?, ?)
+        ON CONFLICT(subreddit) DO UPDATE SET 
+            newest_comment_utc = MAX(COALESCE(newest_comment_utc, 0), excluded.newest_comment_utc),
+            updated_at = excluded.updated_at
+        """, (subreddit, newest_comment_utc, datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
+        self.conn.commit()
+
+    def get_post_cursors(self, post_ids:list):
+        """Get the stored cursors for the given posts, keyed by post ID."""
+        cursors = {}
+        for batch, placeholders in id_chunks(post_ids):
+            query = f"""
+            SELECT post_id, num_comments, newest_comment_utc FROM post_cursors
+            WHERE post_id IN ({placeholders})
+            """
+            for post_id, num_comments, newest_comment_utc in self.conn.execute(query, batch):
+                cursors[post_id] = {'num_comments': num_comments, 'newest_comment_utc': newest_comment_utc}
+        return cursors
+
+    def update_post_cursors(self, post_cursors:list):
+        """Upsert the cursors of fully crawled posts."""
+        updated_at = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        rows = [(c['post_id'], c['subreddit'], c['post_created_utc'], c['num_comments'], 
+                 c['newest_comment_utc'], updated_at) for c in post_cursors]
+        self.conn.executemany("""
+        INSERT INTO post_cursors (post_id, subreddit, post_created_utc, num_comments, newest_comment_utc, updated_at)
+        VALUES (?, ?, ?, ?, ?, ?)
+        ON CONFLICT(post_id) DO UPDATE SET
+            num_comments = excluded.num_comments,
+            newest_comment_utc = MAX(newest_comment_utc, excluded.newest_comment_utc),
+            updated_at = excluded.updated_at
+        """, rows)
+        self.conn.commit()
+        logging.info(f"Updated cursors for {len(rows)} posts.")
+
+    def prune_post_cursors(self, before_utc:float):
+        """Delete cursors of posts created before before_utc, which are no longer crawled."""
+        self.conn.execute("DELETE FROM post_cursors WHERE post_created_utc < ?", (before_utc,))
+        self.conn.commit()
+
+    ### --- Embeddings table --- ###
+
+    def create_embeddings_table(self):
+        """Create the embeddings cache table if it doesn't exist."""
+        create_table_sql = """
+        CREATE TABLE IF NOT EXISTS embeddings (
+            comment_id TEXT,
+            model TEXT,
+            dim INTEGER,
+            vector BLOB,
+            last_used INTEGER,
+            PRIMARY KEY (comment_id, model)
+        );
+        """
+        cursor = self.conn.cursor()
+        cursor.execute(create_table_sql)
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_embeddings_last_used ON embeddings (last_used)")
+        self.conn.commit()
+        logging.info("Table 'embeddings' ready.")
+
+    def get_embeddings(self, comment_ids:list, model:str):
+        """
+        Get cached float32 embeddings for the given comments, keyed by 
+        comment ID. Comments without a cached embedding are left out.
+        """
+        embeddings = {}
+        now = int(datetime.now().timestamp())
+        with self.conn:
+            for batch, placeholders in id_chunks(comment_ids):
+                query = f"""
+                SELECT comment_id, vector FROM embeddings
+                WHERE model = ? AND comment_id IN ({placeholders})
+                """
+                for comment_id, vector in self.conn.execute(query, [model, *batch]):
+                    embeddings[comment_id] = np.frombuffer(vector, dtype=np.float32)
+                # Mark the hits as used, so eviction keeps them
+                self.conn.execute(f"""
+                UPDATE embeddings SET last_used = ? 
+                WHERE model = ? AND comment_id IN ({placeholders})
+                """, [now, model, *batch])
+        return embeddings
+
+    def put_embeddings(self, comment_ids:list, model:str, embeddings):
+        """Cache one embedding per comment ID, stored as float32."""
+        now = int(datetime.now().timestamp())
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        rows = [(comment_id, model, embedding.shape[0], embedding.tobytes(), now) 
+                for comment_id, embedding in zip(comment_ids, embeddings)]
+        with self.conn:
+            self.conn.executemany("""
+            INSERT OR REPLACE INTO embeddings (comment_id, model, dim, vector, last_used)
+            VALUES (?, ?, ?, ?, ?)
+            """, rows)
+
+    def evict_embeddings(self, n_previous_days:int):
+        """Delete cached embeddings not used in the past n days."""
+        cutoff = int((datetime.now() - timedelta(days=n_previous_days)).timestamp())
+        with self.conn:
+            deleted = self.conn.execute("DELETE FROM embeddings WHERE last_used < ?", (cutoff,)).rowcount
+        logging.info(f"Evicted {deleted} cached embeddings.")
+        return deleted
+
+    ### --- Comment topics table --- ###
+
+    def create_comment_topics_table(self):
+        """Create the table of per-comment topic assignments if it doesn't exist."""
+        create_table_sql = """
+        CREATE TABLE IF NOT EXISTS comment_topics (
+            comment_id TEXT,
+            model_version TEXT,
+            topic INTEGER,
+            PRIMARY KEY (comment_id, model_version)
+        );
+        """
+        cursor = self.conn.cursor()
+        cursor.execute(create_table_sql)
+        self.conn.commit()
+        logging.info("Table 'comment_topics' ready.")
+
+    def get_comment_topics(self, comment_ids:list, model_version:str)->dict:
+        """Get the topics assigned to the given comments by a model version."""
+        topics = {}
+        for batch, placeholders in id_chunks(comment_ids):
+            query = f"""
+            SELECT comment_id, topic FROM comment_topics
+            WHERE model_version = ? AND comment_id IN ({placeholders})
+            """
+            topics.update(self.conn.execute(query, [model_version, *batch]))
+        return topics
+
+    def put_comment_topics(self, comment_ids:list, model_version:str, topics:list):
+        """Store the topics a model version assigned to comments."""
+        rows = [(comment_id, model_version, int(topic)) for comment_id, topic in zip(comment_ids, topics)]
+        with self.conn:
+            self.conn.executemany("""
+            INSERT OR REPLACE INTO comment_topics (comment_id, model_version, topic) VALUES (?, ?, ?)
+            """, rows)
+
+    def replace_comment_topics(self, comment_ids:list, model_version:str, topics:list):
+        """Store the assignments of a newly fitted model, dropping those of older versions."""
+        with self.conn:
+            self.conn.execute("DELETE FROM comment_topics WHERE model_version != ?", (model_version,))
+        self.put_comment_topics(comment_ids, model_version, topics)
 
     ### --- Topics table --- ###
 
@@ -108,7 +697,9 @@ class DatabaseManager:
         """Get latest date from the topics table"""
         query = f"SELECT date FROM {table} ORDER BY date DESC LIMIT 1"
         latest_date = pd.read_sql(query, self.conn)
-        # Format to datetime object
+        # None if nothing has been written yet
+        if latest_date.empty:
+            return None
         latest_date = latest_date['date'][0]
         return latest_date
 
@@ -129,6 +720,15 @@ class DatabaseManager:
         self.conn.commit()
         logging.info("Table 'topics' ready.")
 
+    def get_latest_topic_summaries(self)->pd.DataFrame:
+        """The topic summaries of the latest day topic modelling ran, largest topics first."""
+        query = """
+        SELECT * FROM topic_summaries
+        WHERE date = (SELECT MAX(date) FROM topic_summaries)
+        ORDER BY size DESC
+        """
+        return pd.read_sql(query, self.conn)
+
     def update_topic_summaries_table(self, df):
         """Insert new data into the topic_summaries table."""
         if self.conn is None:
@@ -142,6 +742,276 @@ class DatabaseManager:
         logging.info("New data inserted successfully into 'topic_summaries' table.")
 
 
+    ### --- Pipeline checkpoint tables --- ###
+
+    def create_pipeline_tables(self):
+        """Create the tables recording pipeline runs and stage completion if they don't exist."""
+        create_runs_sql = """
+        CREATE TABLE IF NOT EXISTS pipeline_runs (
+            run_id TEXT PRIMARY KEY,
+            pipeline TEXT,
+            started_at REAL,
+            finished_at REAL,
+            status TEXT
+        );
+        """
+        create_stages_sql = """
+        CREATE TABLE IF NOT EXISTS pipeline_stages (
+            run_id TEXT,
+            stage TEXT,
+            status TEXT,
+            started_at REAL,
+            finished_at REAL,
+            error TEXT,
+            outputs BLOB,
+            PRIMARY KEY (run_id, stage)
+        );
+        """
+        cursor = self.conn.cursor()
+        cursor.execute(create_runs_sql)
+        cursor.execute(create_stages_sql)
+        self.conn.commit()
+        self.add_missing_columns('pipeline_runs', {'pipeline': 'TEXT'})
+        logging.info("Tables 'pipeline_runs' and 'pipeline_stages' ready.")
+
+    def get_resumable_run(self, since:float, pipeline:str):
+        """ID of the latest run of pipeline started since the given epoch that didn't complete, or None."""
+        row = self.conn.execute("""
+        SELECT run_id FROM pipeline_runs
+        WHERE started_at >= ? AND pipeline = ? AND status != 'complete'
+        ORDER BY started_at DESC LIMIT 1
+        """, (since, pipeline)).fetchone()
+        return row[0] if row else None
+
+    def start_run(self, run_id:str, pipeline:str):
+        with self.conn:
+            self.conn.execute("""
+            INSERT INTO pipeline_runs (run_id, pipeline, started_at, status) VALUES (?, ?, ?, 'running')
+            ON CONFLICT(run_id) DO UPDATE SET status = 'running', finished_at = NULL
+            """, (run_id, pipeline, datetime.now().timestamp()))
+
+    def finish_run(self, run_id:str, status:str):
+        with self.conn:
+            self.conn.execute("UPDATE pipeline_runs SET status = ?, finished_at = ? WHERE run_id = ?",
+                              (status, datetime.now().timestamp(), run_id))
+
+    def get_stage_checkpoints(self, run_id:str)->dict:
+        """Stages completed in a run, mapped to their saved outputs (or None)."""
+        rows = self.conn.execute("""
+        SELECT stage, outputs FROM pipeline_stages WHERE run_id = ? AND status = 'complete'
+        """, (run_id,))
+        return dict(rows)
+
+    def checkpoint_stage(self, run_id:str, stage:str, status:str, started_at:float, finished_at:float,
+                         error:str=None, outputs:bytes=None):
+        """Record how a stage of a run ended."""
+        with self.conn:
+            self.conn.execute("""
+            INSERT OR REPLACE INTO pipeline_stages (run_id, stage, status, started_at, finished_at, error, outputs)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            """, (run_id, stage, status, started_at, finished_at, error, outputs))
+
+    ### --- Run metrics table --- ###
+
+    def create_run_metrics_table(self):
+        """Create the table of per-step timings and throughput if it doesn't exist."""
+        create_table_sql = """
+        CREATE TABLE IF NOT EXISTS run_metrics (
+            run_id TEXT,
+            step TEXT,
+            started_at REAL,
+            wall_s REAL,
+            cpu_s REAL,
+            peak_rss_mb REAL,
+            items INTEGER,
+            items_per_s REAL,
+            error TEXT,
+            nested INTEGER
+        );
+        """
+        cursor = self.conn.cursor()
+        cursor.execute(create_table_sql)
+        self.add_missing_columns('run_metrics', {'nested': 'INTEGER'})
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_run_metrics_step ON run_metrics (step, started_at)")
+        self.conn.commit()
+        logging.info("Table 'run_metrics' ready.")
+
+    def insert_run_metrics(self, run_id:str, metrics:list):
+        """
+        Insert the measurements of a run, as returned by MetricsRecorder.drain.
+        Totals should leave out nested rows, measured within another row's call.
+        """
+        columns = ['step', 'started_at', 'wall_s', 'cpu_s', 'peak_rss_mb', 'items', 'items_per_s', 'error', 'nested']
+        rows = [[run_id] + [metric[column] for column in columns] for metric in metrics]
+        with self.conn:
+            self.conn.executemany(f"""
+            INSERT INTO run_metrics (run_id, {', '.join(columns)}) VALUES ({', '.join('?' * (len(columns) + 1))})
+            """, rows)
+        logging.info(f"Inserted {len(rows)} rows into 'run_metrics' table.")
+
+    ### --- Parquet archive --- ###
+
+    def archive_comments(self, retention_days:int=90, chunksize:int=100_000, vacuum:bool=True)->int:
+        """
+        Move comments older than retention_days, with their sentiment, to
+        Parquet files under archive_dir/comments, one directory per day 
+        (day=YYYY-MM-DD). They are then deleted from the database, with 
+        their sentiment, topic assignments and cached embeddings, and the 
+        database is vacuumed to give the space back. Files are zstd 
+        compressed, with subreddit, firm and sentiment dictionary encoded.
+
+        Files are written under hidden temporary names and only renamed, 
+        once all are complete, within the write transaction deleting their
+        rows (and just the rows written), so an interrupted run leaves the 
+        database and the archive as they were. Should a commit still fail 
+        after the rename, readers of the archive drop the comments archived
+        twice. sentiment_daily 
+        keeps its rows, so get_sentiment_trend still covers archived days
+        (rebuild_sentiment_rollup would drop them).
+
+        Returns:
+        --------
+        archived `int`: number of comments moved to the archive.
+        """
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        cutoff = int((datetime.now() - timedelta(days=retention_days)).timestamp())
+        query = f"""
+        SELECT {', '.join(('s.' if column in ('compound', 'sentiment') else 'c.') + column for column in ARCHIVE_COLUMNS)}
+        FROM comments c LEFT JOIN sentiment s ON s.comment_id = c.comment_id
+        WHERE c.comment_epoch < ?
+        ORDER BY c.comment_epoch
+        """
+        schema = archive_schema()
+        stamp = datetime.now().strftime('%Y%m%d%H%M%S')
+        self.conn.execute("CREATE TEMP TABLE IF NOT EXISTS archived_ids (comment_id TEXT PRIMARY KEY)")
+        self.conn.execute("DELETE FROM archived_ids")
+        written = []
+        published = []
+        try:
+            for i, chunk in enumerate(pd.read_sql_query(query, self.conn, params=(cutoff,), chunksize=chunksize)):
+                for day, day_df in chunk.groupby(chunk['comment_date'].str[:10]):
+                    day_dir = os.path.join(self.archive_dir, 'comments', f"day={day}")
+                    os.makedirs(day_dir, exist_ok=True)
+                    name = f"part-{stamp}-{i}.parquet"
+                    table = pa.Table.from_pandas(day_df, schema=schema, preserve_index=False)
+                    pq.write_table(table, os.path.join(day_dir, f".{name}.tmp"), compression='zstd',
+                                   use_dictionary=ARCHIVE_DICTIONARY_COLUMNS)
+                    written.append((day_dir, name))
+                self.conn.executemany("INSERT OR IGNORE INTO archived_ids VALUES (?)", 
+                                      [(comment_id,) for comment_id in chunk['comment_id']])
+            # End the read, so the deletes can take the write lock
+            self.conn.commit()
+
+            tables = {row[0] for row in self.conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+            with self._immediate_transaction():
+                for table in ('sentiment', 'comment_topics', 'embeddings'):
+                    if table in tables:
+                        self.conn.execute(f"DELETE FROM {table} WHERE comment_id IN (SELECT comment_id FROM archived_ids)")
+                archived = self.conn.execute("""
+                DELETE FROM comments WHERE comment_id IN (SELECT comment_id FROM archived_ids)
+                """).rowcount
+                self.conn.execute("DELETE FROM archived_ids")
+                # Publish the files only once their rows are sure to go
+                published = []
+                for day_dir, name in written:
+                    os.replace(os.path.join(day_dir, f".{name}.tmp"), os.path.join(day_dir, name))
+                    published.append((day_dir, name))
+        except BaseException:
+            for day_dir, name in written:
+                if (day_dir, name) not in published:
+                    os.remove(os.path.join(day_dir, f".{name}.tmp"))
+            self.conn.rollback()
+            raise
+        logging.info(f"Archived {archived} comments older than {retention_days} days to '{self.archive_dir}'.")
+
+        if vacuum and archived:
+            self.conn.execute("VACUUM")
+            # Shrink the WAL file the vacuum went through, too
+            self.conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            logging.info("Database vacuumed.")
+        return archived
+
+    def get_archived_data(self, since:datetime, until:datetime=None, columns:list=None, firms:list=None,
+                          subreddits:list=None)->pd.DataFrame:
+        """
+        Archived comments from since up to until (default: now), read from
+        the Parquet archive. Only the day directories in range are read, 
+        and only the requested columns (any of ARCHIVE_COLUMNS). A comment
+        archived more than once is returned once.
+        """
+        columns = list(columns or ARCHIVE_COLUMNS)
+        unknown_columns = set(columns) - set(ARCHIVE_COLUMNS)
+        if unknown_columns:
+            raise ValueError(f"Unknown archive columns: {sorted(unknown_columns)}")
+        comments_dir = os.path.join(self.archive_dir, 'comments')
+        if not os.path.isdir(comments_dir):
+            return pd.DataFrame(columns=columns)
+
+        import pyarrow as pa
+        import pyarrow.dataset as ds
+
+        until = until or datetime.now()
+        partitioning = ds.partitioning(pa.schema([('day', pa.string())]), flavor='hive')
+        dataset = ds.dataset(comments_dir, format='parquet', schema=archive_schema().append(pa.field('day', pa.string())),
+                             partitioning=partitioning)
+        # The day bounds prune whole directories; the epoch bounds are exact
+        expression = ((ds.field('day') >= since.strftime('%Y-%m-%d')) & (ds.field('day') <= until.strftime('%Y-%m-%d'))
+                      & (ds.field('comment_epoch') >= int(since.timestamp())) 
+                      & (ds.field('comment_epoch') < int(until.timestamp())))
+        if firms:
+            expression &= ds.field('firm').isin(list(firms))
+        if subreddits:
+            expression &= ds.field('subreddit').isin(list(subreddits))
+        read_columns = columns if 'comment_id' in columns else columns + ['comment_id']
+        df = dataset.to_table(columns=read_columns, filter=expression).to_pandas()
+        df = df.drop_duplicates('comment_id', keep='last', ignore_index=True)[columns]
+        for column in set(columns) & set(ARCHIVE_DICTIONARY_COLUMNS):
+            df[column] = df[column].astype(object)
+        return df
+
+    def get_history(self, since:datetime, until:datetime=None, columns:list=None, firms:list=None,
+                    subreddits:list=None)->pd.DataFrame:
+        """
+        Comments with their sentiment from since up to until (default: now),
+        from the database and the Parquet archive together, e.g. for 
+        backfills and historical sentiment studies.
+
+        Params:
+        -------
+        * since, until `datetime`: time range of comment_epoch.
+        * columns `list`: any of ARCHIVE_COLUMNS (default: all).
+        * firms `list`: only return comments matched to these firms.
+        * subreddits `list`: only return comments from these subreddits.
+        """
+        columns = list(columns or ARCHIVE_COLUMNS)
+        # comment_id is needed to drop comments stored again after they were archived
+        read_columns = columns if 'comment_id' in columns else columns + ['comment_id']
+        archived_df = self.get_archived_data(since, until, columns=read_columns, firms=firms, subreddits=subreddits)
+
+        until = until or datetime.now()
+        conditions = ["c.comment_epoch >= ?", "c.comment_epoch < ?"]
+        params = [int(since.timestamp()), int(until.timestamp())]
+        for column, values in (('firm', firms), ('subreddit', subreddits)):
+            if values:
+                conditions.append(f"c.{column} IN ({', '.join('?' * len(values))})")
+                params.extend(values)
+        query = f"""
+        SELECT {', '.join(('s.' if column in ('compound', 'sentiment') else 'c.') + column for column in read_columns)}
+        FROM comments c LEFT JOIN sentiment s ON s.comment_id = c.comment_id
+        WHERE {' AND '.join(conditions)}
+        """
+        hot_df = pd.read_sql_query(query, self.conn, params=params)
+        if archived_df.empty:
+            return hot_df[columns]
+        df = pd.concat([archived_df, hot_df], ignore_index=True)
+        # A comment stored again after it was archived
+        df = df.drop_duplicates('comment_id', keep='last', ignore_index=True)[columns]
+        if 'comment_epoch' in columns:
+            df = df.sort_values('comment_epoch', ignore_index=True)
+        return df
+
     def close(self):
         """Close the database connection."""
         if self.conn:
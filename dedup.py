@@ -0,0 +1,132 @@
+import logging
+import re
+import zlib
+from typing import NamedTuple
+
+import numpy as np
+
+# Any mersenne prime above the 32-bit shingle hashes keeps a*h + b within uint64
+MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+URL_RE = re.compile(r'https?://\S+|www\.\S+')
+NON_WORD_RE = re.compile(r'[^\w$%]+')
+
+
+class DuplicateGroups(NamedTuple):
+    representatives: np.ndarray  # index into texts of each group's representative
+    inverse: np.ndarray          # for each text, the index of its group in representatives
+    counts: np.ndarray           # number of texts in each group
+
+    def expand(self, values):
+        """Map one value per representative back to one value per text."""
+        return [values[group] for group in self.inverse]
+
+
+def normalise(text:str)->str:
+    """Lowercase text and strip links and punctuation, which templated posts vary the most."""
+    text = URL_RE.sub(' ', str(text).lower())
+    return NON_WORD_RE.sub(' ', text).strip()
+
+
+def shingle_hashes(text:str, shingle_size:int=5)->np.ndarray:
+    """crc32 of every character shingle in text."""
+    if len(text) <= shingle_size:
+        shingles = {text}
+    else:
+        shingles = {text[i:i + shingle_size] for i in range(len(text) - shingle_size + 1)}
+    return np.fromiter((zlib.crc32(shingle.encode('utf-8')) for shingle in shingles),
+                       dtype=np.uint64, count=len(shingles))
+
+
+class MinHasher:
+    """MinHash signatures from num_perm universal hash functions (a*h + b mod p)."""
+    def __init__(self, num_perm:int=64, seed:int=42):
+        rng = np.random.default_rng(seed)
+        # a, b < 2**31 and h < 2**32, so a*h + b can't overflow uint64
+        self.a = rng.integers(1, 1 << 31, size=num_perm, dtype=np.uint64)
+        self.b = rng.integers(0, 1 << 31, size=num_perm, dtype=np.uint64)
+
+    def signature(self, hashes:np.ndarray)->np.ndarray:
+        return ((np.outer(self.a, hashes) + self.b[:, None]) % MERSENNE_PRIME).min(axis=1)
+
+
+def find_near_duplicates(texts:list,
+                         threshold:float=0.8,
+                         num_perm:int=64,
+                         bands:int=16,
+                         shingle_size:int=5,
+                         seed:int=42)->DuplicateGroups:
+    """
+    Group texts that are exact or near duplicates of each other, using
+    MinHash signatures over character shingles and banded LSH.
+
+    Texts are first collapsed on their normalised form. Signatures that
+    share a band become candidate pairs, which are joined only if their
+    estimated Jaccard similarity reaches threshold. Each group is
+    represented by its first text. Texts with nothing left once 
+    normalised (only emoji, links or punctuation) each form their own 
+    group, as there is nothing to tell whether they are alike.
+
+    Params:
+    -------
+    * texts `list`: texts to group.
+    * threshold `float`: minimum estimated Jaccard similarity of shingle sets.
+    * num_perm `int`: MinHash signature length; must be divisible by bands.
+    * bands `int`: LSH bands. More bands find more candidates at lower similarity.
+    * shingle_size `int`: characters per shingle.
+    * seed `int`: seed of the hash functions.
+
+    Returns:
+    --------
+    DuplicateGroups
+    """
+    if num_perm % bands:
+        raise ValueError(f"num_perm ({num_perm}) must be divisible by bands ({bands})")
+
+    # Exact duplicates after normalisation
+    unique_index = {}
+    first_of_unique = []
+    text_to_unique = np.empty(len(texts), dtype=np.int64)
+    for i, text in enumerate(texts):
+        key = normalise(text)
+        if not key:
+            # An int key never equals a normalised text, nor another text's
+            key = i
+        if key not in unique_index:
+            unique_index[key] = len(first_of_unique)
+            first_of_unique.append(i)
+        text_to_unique[i] = unique_index[key]
+
+    unique_texts = list(unique_index)
+    parent = np.arange(len(unique_texts))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    comparable = [i for i, text in enumerate(unique_texts) if isinstance(text, str)]
+    if len(comparable) > 1:
+        hasher = MinHasher(num_perm, seed)
+        signatures = np.zeros((len(unique_texts), num_perm), dtype=np.uint64)
+        for i in comparable:
+            signatures[i] = hasher.signature(shingle_hashes(unique_texts[i], shingle_size))
+        rows = num_perm // bands
+        for band in range(bands):
+            buckets = {}
+            for i in comparable:
+                j = buckets.setdefault(signatures[i, band * rows:(band + 1) * rows].tobytes(), i)
+                if j == i:
+                    continue
+                root_i, root_j = find(i), find(j)
+                if root_i != root_j and np.mean(signatures[i] == signatures[j]) >= threshold:
+                    parent[max(root_i, root_j)] = min(root_i, root_j)
+
+    # Roots are the lowest unique index of each group, i.e. its first text
+    roots = np.array([find(i) for i in range(len(unique_texts))], dtype=np.int64)
+    root_ids, unique_to_group = np.unique(roots, return_inverse=True)
+    inverse = unique_to_group[text_to_unique] if len(texts) else np.empty(0, dtype=np.int64)
+    representatives = np.asarray(first_of_unique, dtype=np.int64)[root_ids]
+    counts = np.bincount(inverse, minlength=len(representatives))
+    logging.info(f"Collapsed {len(texts)} texts into {len(representatives)} after near-duplicate detection.")
+    return DuplicateGroups(representatives, inverse, counts)
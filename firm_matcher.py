@@ -0,0 +1,115 @@
+import pandas as pd
+import logging
+import re
+from typing import NamedTuple
+
+# Positions where a firm term may start: any non-space character that does
+# not continue a word
+WORD_START_RE = re.compile(r'(?<!\w)\S')
+
+
+class FirmMatch(NamedTuple):
+    start: int
+    end: int
+    phrase: str  # text as it appears in the comment
+    firm: str    # canonical 'name' from firms.csv
+    ticker: str  # canonical 'ticker' (or 'altticker') from firms.csv
+
+
+def _is_word_char(char):
+    return char.isalnum() or char == '_'
+
+
+class FirmMatcher:
+    """
+    Multi-pattern matcher for firm names, abbreviations and tickers.
+
+    Terms are stored in a character trie. A comment is scanned once: the trie
+    is only walked from word starts, and a hit must end on a word boundary,
+    so the cost grows with the length of the text rather than the number of
+    terms. Matching is case-insensitive and returns leftmost-longest,
+    non-overlapping hits.
+    """
+    def __init__(self, firms):
+        """
+        Params:
+        -------
+        * firms `list`: (name, ticker, terms) tuples, one per firm.
+        """
+        self.trie = {}
+        self.firms = []
+        for name, ticker, terms in firms:
+            firm_index = len(self.firms)
+            self.firms.append((name, ticker))
+            for term in terms:
+                self._add_term(term, firm_index)
+
+    @classmethod
+    def from_csv(cls, firm_list_path: str):
+        """Build a matcher from a firms.csv style file."""
+        df = pd.read_csv(firm_list_path)
+        term_columns = ['name', 'altname', 'abbreviation', 'ticker', 'altticker']
+        df[term_columns] = df[term_columns].fillna('')
+        firms = []
+        for _, row in df.iterrows():
+            terms = [row[column].strip() for column in term_columns if row[column].strip()]
+            ticker = row['ticker'].strip() or row['altticker'].strip()
+            firms.append((row['name'].strip(), ticker, terms))
+        return cls(firms)
+
+    def _add_term(self, term, firm_index):
+        term = term.lower()
+        node = self.trie
+        for char in term:
+            node = node.setdefault(char, {})
+        if None in node:
+            # Same term listed for more than one firm - keep the first
+            if node[None] != firm_index:
+                logging.debug(f"Term '{term}' already mapped to {self.firms[node[None]][0]}")
+            return
+        node[None] = firm_index
+
+    @staticmethod
+    def _lower(text):
+        """Lowercase text without changing its length, so spans stay valid."""
+        lowered = text.lower()
+        if len(lowered) == len(text):
+            return lowered
+        return ''.join(char if len(char.lower()) != 1 else char.lower() for char in text)
+
+    def find_all(self, text: str) -> list:
+        """Return every firm hit in text, in order of appearance."""
+        if not text:
+            return []
+        lowered = self._lower(text)
+        text_length = len(text)
+        hits = []
+        next_free = 0
+        for start_match in WORD_START_RE.finditer(lowered):
+            start = start_match.start()
+            if start < next_free:
+                continue
+            node = self.trie
+            best = None
+            position = start
+            while position < text_length:
+                node = node.get(lowered[position])
+                if node is None:
+                    break
+                position += 1
+                # Terms ending in a word character need a word boundary after them
+                if None in node and (position == text_length
+                                     or not _is_word_char(lowered[position - 1])
+                                     or not _is_word_char(lowered[position])):
+                    best = (position, node[None])
+            if best is not None:
+                end, firm_index = best
+                name, ticker = self.firms[firm_index]
+                hits.append(FirmMatch(start, end, text[start:end], name, ticker))
+                next_free = end
+        return hits
+
+    def search(self, text: str):
+        """Return the first firm hit in text, or None."""
+        hits = self.find_all(text)
+        return hits[0] if hits else None
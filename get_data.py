@@ -2,39 +2,62 @@ import pandas as pd
 import datetime
 import logging
 import re
+import threading
+import queue
+from collections import OrderedDict, deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from firm_matcher import FirmMatcher
+from records import CommentRecord, CommentBatch
+from telemetry import recorder
+
+# Stripped from matched phrases
+PHRASE_JUNK_RE = re.compile(r'\\b|\\s|\+')
+# 'posts': expand the comment tree of every recent post; 'comments': page
+# the subreddit-wide comment listing, newest first
+FETCH_STRATEGIES = ('posts', 'comments')
 
 class GetData:
-    def __init__(self, api_connection, firm_list_path: str, subreddits: list):
+    def __init__(self, api_connection, firm_list_path: str, subreddits: list, max_workers: int = 1,
+                 database_manager=None, fetch_strategy: str = 'posts'):
+        if fetch_strategy not in FETCH_STRATEGIES:
+            raise ValueError(f"Unknown fetch strategy '{fetch_strategy}', expected one of {FETCH_STRATEGIES}")
         self.api_connection = api_connection
         self.reddit_client = api_connection.initialise_client()
         self.firm_list_path = firm_list_path
         self.subreddits = subreddits
+        self.max_workers = max_workers
+        # Where the crawl cursors are kept; without it every post in the window is crawled
+        self.database_manager = database_manager
+        self.fetch_strategy = fetch_strategy
+        self.pending_post_cursors = []
+        self.pending_subreddit_cursors = []
+        # Newest post listed per subreddit: seen by the running crawl, and pending save_cursors once it ends
+        self.listed_newest_post_utc = {}
+        self.pending_newest_post_utc = {}
+        # Titles of posts whose comments came from a comment listing without one
+        self.post_titles = OrderedDict()
+        self.post_titles_lock = threading.Lock()
+        self._thread_local = threading.local()
     
-    def load_ticker_patterns_from_csv(self):
-        df = pd.read_csv(self.firm_list_path)
-        # Combine the 'name', 'abbreviation', and 'ticker' into a single list, excluding any NaN values
-        patterns = df[['name','altname', 'abbreviation', 'ticker','altticker']].fillna('').apply(lambda x: '|'.join(x[x != '']), axis=1).tolist()
-        # Ensure patterns are unique and non-empty
-        patterns = [pattern for pattern in set(patterns) if pattern]
-        return patterns
-
-    def add_word_boundaries(self, search_patterns):
-        updated_patterns = []
-        for pattern in search_patterns:
-            terms = pattern.split('|')  # Split pattern into terms
-            bounded_terms = [r'\b' + term + r'\b' for term in terms]  # Add boundaries to each term
-            updated_patterns.append('|'.join(bounded_terms))  # Rejoin the terms
-        return updated_patterns
+    def load_firm_matcher(self):
+        """Build the firm matcher used to find firm mentions in comments."""
+        return FirmMatcher.from_csv(self.firm_list_path)
     
     @staticmethod
     def clean_comments(df):
         """
         Clean columns in df, and where no comments are found, create 
-        the columns with appropriate default values.
+        the columns with appropriate default values. CommentBatches from 
+        iter_comment_batches are cleaned as they are collected and are 
+        returned as they are.
         """
+        if isinstance(df, CommentBatch):
+            return df
+
         # Handle 'matched_phrase' specifically if it exists
         if 'matched_phrase' in df.columns:
-            df['matched_phrase'] = df['matched_phrase'].str.replace(r'\\b|\\s|\+', '', regex=True)
+            df['matched_phrase'] = df['matched_phrase'].str.replace(PHRASE_JUNK_RE, '', regex=True)
 
         # List of all expected columns with their default values
         expected_columns_with_defaults = {
@@ -42,8 +65,10 @@ class GetData:
             'post_title': '', 
             'comment_id': '', 
             'comment_date': '',  
+            'comment_epoch': 0,
             'comment': '', 
             'matched_phrase': '',  # Ensuring it's listed even though it's handled above
+            'firm': '',
             'upvotes': 0,  # Assuming 'upvotes' is numeric
         }
 
@@ -54,58 +79,421 @@ class GetData:
 
         return df
 
-    def get_comments(self, comment_target, last_run_time):
-        data = []
-        seen_comment_ids = set()
-        comment_counter = 0
-        one_day_ago = datetime.datetime.now() - datetime.timedelta(days=1)
+    def get_client(self):
+        """
+        Return the Reddit client for the calling thread. praw instances are
+        not thread safe, so each worker thread gets its own client, all 
+        sharing the connection's rate limiter.
+        """
+        if threading.current_thread() is threading.main_thread():
+            return self.reddit_client
+        client = getattr(self._thread_local, 'client', None)
+        if client is None:
+            client = self.api_connection.initialise_client()
+            self._thread_local.client = client
+        return client
+
+    def iter_recent_posts(self, subreddit, since):
+        """Yield posts from the subreddit's 'new' listing created after since."""
+        subreddit_data = self.get_client().subreddit(subreddit)
+        for post in self.api_connection.make_api_call(subreddit_data.new, limit=None):  # Fetch as many as needed, but filter by date
+            post_creation_time = datetime.datetime.fromtimestamp(post.created_utc)
+            if post_creation_time < since:
+                # The listing is newest first, so every later post is older too
+                break
+            yield post
+
+    def select_posts_to_crawl(self, subreddit, posts):
+        """
+        Pair each post with its stored crawl cursor, dropping posts whose 
+        comment count is unchanged since they were last fully crawled.
+        """
+        if self.database_manager is None:
+            return [(post, None) for post in posts]
+
+        newest_post_utc = self.database_manager.get_subreddit_cursor(subreddit)
+        if posts:
+            # With several workers, a subreddit's posts come a listing page at a time
+            self.listed_newest_post_utc[subreddit] = max(self.listed_newest_post_utc.get(subreddit, 0),
+                                                         *(post.created_utc for post in posts))
+        cursors = self.database_manager.get_post_cursors([post.id for post in posts])
+
+        selected = []
+        for post in posts:
+            cursor = cursors.get(post.id)
+            if cursor is not None and cursor['num_comments'] == post.num_comments:
+                continue
+            selected.append((post, cursor))
+
+        new_posts = sum(1 for post in posts if newest_post_utc is None or post.created_utc > newest_post_utc)
+        logging.info(f"r/{subreddit}: {len(posts)} posts listed in window, {new_posts} new, "
+                     f"{len(posts) - len(selected)} unchanged since last crawl.")
+        return selected
+
+    def process_post(self, subreddit, post, firm_matcher, last_run_time, collector, cursor=None):
+        """
+        Fetch the comment tree of a post and add matching comments to the 
+        collector. Returns the post's new crawl cursor, or None if the tree 
+        was not read to the end.
+        """
+        if collector.is_full():
+            return None
+
+        # Only comments newer than both the last run and the newest comment 
+        # already seen on this post are of interest
+        newest_seen_utc = cursor['newest_comment_utc'] if cursor else 0
+        since_utc = max(last_run_time.timestamp(), newest_seen_utc)
+
+        logging.info("Processing post: {}".format(post.title))
+        # Rebind the post to this thread's client before fetching its comments
+        submission = self.get_client().submission(id=post.id)
+        submission.comments.replace_more(limit=0)
+        for comment in submission.comments.list():
+            newest_seen_utc = max(newest_seen_utc, comment.created_utc)
+            if collector.is_seen(comment.id) or comment.created_utc <= since_utc:
+                continue
+
+            # Scan the body once; the first hit is recorded against the comment
+            match = firm_matcher.search(comment.body)
+            if match:
+                collector.add(CommentRecord(subreddit=subreddit,
+                                            post_title=post.title,
+                                            comment_id=comment.id,
+                                            comment_epoch=comment.created_utc,
+                                            comment=comment.body,
+                                            matched_phrase=PHRASE_JUNK_RE.sub('', match.phrase),
+                                            firm=match.firm,
+                                            upvotes=comment.score))
+
+            collector.count_checked()
+            if collector.is_full():
+                return None
+
+        return {
+            'post_id': post.id,
+            'subreddit': subreddit,
+            'post_created_utc': post.created_utc,
+            'num_comments': post.num_comments,
+            'newest_comment_utc': newest_seen_utc
+        }
+
+    def get_post_title(self, comment, max_cached=1024):
+        """
+        Title of a comment's post: the link_title the comment listing 
+        includes, or else looked up once per post and cached.
+        """
+        # vars() rather than getattr, which would make praw fetch the comment
+        link_title = vars(comment).get('link_title')
+        if link_title:
+            return link_title
+        post_id = comment.link_id.split('_', 1)[-1]
+        with self.post_titles_lock:
+            if post_id in self.post_titles:
+                self.post_titles.move_to_end(post_id)
+                return self.post_titles[post_id]
+        title = self.api_connection.make_api_call(lambda: self.get_client().submission(id=post_id).title)
+        with self.post_titles_lock:
+            self.post_titles[post_id] = title
+            while len(self.post_titles) > max_cached:
+                self.post_titles.popitem(last=False)
+        return title
+
+    def process_subreddit_comments(self, subreddit, firm_matcher, last_run_time, collector, newest_seen_utc=None):
+        """
+        Page the subreddit's comment listing down to the newest comment seen
+        by an earlier crawl (or last_run_time), adding matching comments to
+        the collector. Returns the subreddit's new comment cursor, or None 
+        if the collector filled up first - the comments between the cursor
+        and where the crawl stopped have not been read yet.
+        """
+        if collector.is_full():
+            return None
+
+        since_utc = max(last_run_time.timestamp(), newest_seen_utc or 0)
+        newest_utc = since_utc
+        n_listed = 0
+        reached_cursor = False
+        subreddit_data = self.get_client().subreddit(subreddit)
+        for comment in self.api_connection.make_api_call(subreddit_data.comments, limit=None):
+            if comment.created_utc <= since_utc:
+                # The listing is newest first, so every later comment is older too
+                reached_cursor = True
+                break
+            n_listed += 1
+            newest_utc = max(newest_utc, comment.created_utc)
+            if collector.is_seen(comment.id):
+                continue
+
+            match = firm_matcher.search(comment.body)
+            if match:
+                collector.add(CommentRecord(subreddit=subreddit,
+                                            post_title=self.get_post_title(comment),
+                                            comment_id=comment.id,
+                                            comment_epoch=comment.created_utc,
+                                            comment=comment.body,
+                                            matched_phrase=PHRASE_JUNK_RE.sub('', match.phrase),
+                                            firm=match.firm,
+                                            upvotes=comment.score))
+
+            collector.count_checked()
+            if collector.is_full():
+                return None
+
+        if not reached_cursor:
+            # Reddit only serves about the newest 1000 comments of a listing
+            logging.warning(f"r/{subreddit}: the comment listing ended after {n_listed} comments, before "
+                            f"the last crawl's newest comment - older ones were missed; crawl it more often.")
+        logging.info(f"r/{subreddit}: {n_listed} new comments listed.")
+        return {'subreddit': subreddit, 'newest_comment_utc': newest_utc}
+
+    @recorder.instrument('GetData.get_comments')
+    def get_comments(self, comment_target, last_run_time, max_workers=None, now=None):
+        """
+        Collect up to comment_target comments mentioning a firm, posted since
+        last_run_time on posts from the last day. With max_workers > 1 the 
+        subreddit listings and post comment trees are fetched in parallel.
+
+        With the 'comments' fetch strategy, comments come from each 
+        subreddit's comment listing instead, whatever post they are on. It
+        takes one request per 100 comments rather than at least one per 
+        post, and doesn't miss comments hidden behind "load more", but only
+        reaches back about 1000 comments per subreddit.
+
+        Cursors for fully crawled posts (or subreddits) are held in 
+        pending_post_cursors (pending_subreddit_cursors) until save_cursors
+        is called, once the comments have been stored. The newest post 
+        listed in each subreddit is saved with them once the crawl ends.
+        now sets the end of the crawl window (default: the current time), 
+        e.g. to the recording time when replaying stored responses.
+        """
+        batches = list(self.iter_comment_batches(comment_target, last_run_time, 
+                                                 batch_size=1000,
+                                                 max_workers=max_workers, 
+                                                 now=now, 
+                                                 save_cursors=False))
+        if not batches:
+            return pd.DataFrame()
+        return CommentBatch(record for batch in batches for record in batch).to_frame()
+
+    @recorder.instrument('GetData.iter_comment_batches')
+    def iter_comment_batches(self, comment_target, last_run_time, batch_size=500, max_workers=None, 
+                             now=None, save_cursors=True):
+        """
+        Crawl as get_comments does, but yield the comments as CommentBatches
+        of up to batch_size records as soon as they are collected, so memory
+        stays flat however large comment_target is.
+
+        With save_cursors, a post's cursor is saved once every batch holding
+        its comments has been handed over and the caller has asked for the 
+        next one - i.e. after the caller has stored them. A crash mid-crawl 
+        therefore keeps the work already done and repeats none of it.
+        """
+        max_workers = max_workers or self.max_workers
+        collector = CommentCollector(comment_target)
+        self.pending_post_cursors = []
+        self.pending_subreddit_cursors = []
+        self.listed_newest_post_utc = {}
+        self.pending_newest_post_utc = {}
+        calls_before = self.api_connection.get_total_calls()
+        one_day_ago = (now or datetime.datetime.now()) - datetime.timedelta(days=1)
+        # (cursor, comments collected when the post finished) for finished posts
+        finished_posts = []
+        yielded = 0
+
+        def release_cursors(up_to):
+            ready = [cursor for cursor, collected in finished_posts if collected <= up_to]
+            finished_posts[:] = [(cursor, collected) for cursor, collected in finished_posts if collected > up_to]
+            self.pending_post_cursors.extend(cursor for cursor in ready if 'post_id' in cursor)
+            self.pending_subreddit_cursors.extend(cursor for cursor in ready if 'post_id' not in cursor)
+            if save_cursors:
+                self.save_cursors()
 
         # Load search patterns
-        firms = self.load_ticker_patterns_from_csv()
-        firms_with_boundaries = self.add_word_boundaries(firms)
-        # Compile the patterns into a regular expression
-        pattern_re = re.compile('|'.join(firms_with_boundaries), re.IGNORECASE)
+        firm_matcher = self.load_firm_matcher()
+
+        if self.fetch_strategy == 'comments':
+            crawl = self._crawl_comment_listings(collector, firm_matcher, last_run_time, max_workers)
+        else:
+            crawl = self._crawl_posts(collector, firm_matcher, last_run_time, one_day_ago, max_workers)
+        for post_cursor in crawl:
+            if post_cursor is not None:
+                finished_posts.append((post_cursor, collector.collected))
+            while collector.buffered() >= batch_size:
+                batch = collector.drain(batch_size)
+                yielded += len(batch)
+                yield CommentBatch(batch)
+                release_cursors(yielded)
+
+        batch = collector.drain()
+        if batch:
+            yielded += len(batch)
+            yield CommentBatch(batch)
+        self.pending_newest_post_utc.update(self.listed_newest_post_utc)
+        release_cursors(yielded)
+
+        if collector.is_full():
+            logging.info("Reached comment target.")
+        logging.info(f"Total comments checked: {collector.comment_counter}")
+        logging.info(f"Total comments collected: {collector.collected}")
+        logging.info(f"API requests made by the '{self.fetch_strategy}' crawl: "
+                     f"{self.api_connection.get_total_calls() - calls_before}")
+
+    def _crawl_comment_listings(self, collector, firm_matcher, last_run_time, max_workers, poll_interval=0.1):
+        """
+        Page each subreddit's comment listing, yielding each subreddit's 
+        cursor as it finishes. With several workers, None is also yielded 
+        every poll_interval seconds in between, so the caller can hand on
+        the batches collected so far without waiting for whole listings.
+        """
+        # Cursor lookups stay on this thread, which owns the database connection
+        cursors = {subreddit: self.database_manager.get_subreddit_comment_cursor(subreddit) 
+                   if self.database_manager is not None else None
+                   for subreddit in self.subreddits}
+        if max_workers <= 1:
+            for subreddit in self.subreddits:
+                logging.info(f"Fetching comments from r/{subreddit}...")
+                yield self.process_subreddit_comments(subreddit, firm_matcher, last_run_time, collector, 
+                                                      cursors[subreddit])
+                if collector.is_full():
+                    return
+            return
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            in_flight = {executor.submit(self.process_subreddit_comments, subreddit, firm_matcher, 
+                                         last_run_time, collector, cursors[subreddit])
+                         for subreddit in self.subreddits}
+            while in_flight:
+                done, in_flight = wait(in_flight, timeout=poll_interval, return_when=FIRST_COMPLETED)
+                if not done:
+                    yield None
+                for future in done:
+                    yield future.result()
+
+    def _crawl_posts(self, collector, firm_matcher, last_run_time, since, max_workers):
+        """Crawl the posts in the window, yielding each post's cursor as it finishes."""
+        if max_workers <= 1:
+            for subreddit in self.subreddits:
+                logging.info(f"Fetching from r/{subreddit}...")
+                posts = list(self.iter_recent_posts(subreddit, since))
+                for post, cursor in self.select_posts_to_crawl(subreddit, posts):
+                    yield self.process_post(subreddit, post, firm_matcher, last_run_time, collector, cursor)
+                    if collector.is_full():
+                        return
+            return
 
-        for subreddit in self.subreddits:
+        # The listing workers and crawled posts report to this thread through
+        # events: ('listed', subreddit, post), ('listing done', subreddit, 
+        # future) and ('crawled', None, future)
+        events = queue.Queue()
+
+        def list_posts(subreddit):
             logging.info(f"Fetching from r/{subreddit}...")
-            subreddit_data = self.reddit_client.subreddit(subreddit)
-
-            for post in self.api_connection.make_api_call(subreddit_data.new, limit=None):  # Fetch as many as needed, but filter by date
-                post_creation_time = datetime.datetime.fromtimestamp(post.created_utc)
-                if post_creation_time < one_day_ago:
-                    continue
-
-                logging.info("Processing post: {}".format(post.title))
-                post.comments.replace_more(limit=0)
-                self.api_connection.api_counter.increment() # increment api call
-                for comment in post.comments.list():
-                    self.api_connection.api_counter.increment() # increment api call
-                    if comment.id in seen_comment_ids or datetime.datetime.fromtimestamp(comment.created_utc) <= last_run_time:
-                        continue
-
-                    if pattern_re.search(comment.body):
-                        comment_date = datetime.datetime.fromtimestamp(comment.created_utc).strftime('%Y-%m-%d %H:%M:%S')
-                        data.append({
-                            'subreddit': subreddit,
-                            'post_title': post.title,
-                            'comment_id': comment.id,
-                            'comment_date': comment_date,
-                            'comment': comment.body,
-                            'matched_phrase': pattern_re.search(comment.body).group(0), 
-                            'upvotes': comment.score
-                        })
-                        seen_comment_ids.add(comment.id)
-
-                    comment_counter += 1
-                    if len(data) >= comment_target:
-                        break
-
-                if len(data) >= comment_target:
-                    logging.info("Reached comment target.")
+            for post in self.iter_recent_posts(subreddit, since):
+                events.put(('listed', subreddit, post))
+
+        def report(kind, subreddit=None):
+            return lambda future: events.put((kind, subreddit, future))
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for subreddit in self.subreddits:
+                executor.submit(list_posts, subreddit).add_done_callback(report('listing done', subreddit))
+            listings_running = len(self.subreddits)
+            posts_to_crawl = deque()
+            in_flight = 0
+            while True:
+                # Keep only a few posts in flight, so collected comments never 
+                # run far ahead of the consumer
+                while posts_to_crawl and in_flight < 2 * max_workers and not collector.is_full():
+                    subreddit, post, cursor = posts_to_crawl.popleft()
+                    executor.submit(self.process_post, subreddit, post, firm_matcher, last_run_time, collector,
+                                    cursor).add_done_callback(report('crawled'))
+                    in_flight += 1
+                if not in_flight and (collector.is_full() or not (listings_running or posts_to_crawl)):
                     break
 
-        logging.info(f"Total comments checked: {comment_counter}")
-        logging.info(f"Total comments collected: {len(data)}")
+                # Wait for an event, then take every other one already waiting
+                pending_events = [events.get()]
+                while not events.empty():
+                    pending_events.append(events.get_nowait())
+                listed = OrderedDict()
+                for kind, subreddit, item in pending_events:
+                    if kind == 'listed':
+                        listed.setdefault(subreddit, []).append(item)
+                    elif kind == 'listing done':
+                        listings_running -= 1
+                        item.result()
+                    else:
+                        in_flight -= 1
+                        yield item.result()
+                # Posts are crawled as their listing page arrives, not once 
+                # every listing is complete. Cursor lookups stay on this 
+                # thread, which owns the database connection
+                for subreddit, posts in listed.items():
+                    posts_to_crawl.extend((subreddit, post, cursor)
+                                          for post, cursor in self.select_posts_to_crawl(subreddit, posts))
+
+    def save_cursors(self):
+        """Persist the cursors of posts and subreddits crawled by the last get_comments call."""
+        if self.database_manager is None:
+            return
+        for subreddit, newest_post_utc in self.pending_newest_post_utc.items():
+            self.database_manager.update_subreddit_cursor(subreddit, newest_post_utc)
+        self.pending_newest_post_utc = {}
+        for cursor in self.pending_subreddit_cursors:
+            self.database_manager.update_subreddit_comment_cursor(cursor['subreddit'], cursor['newest_comment_utc'])
+        self.pending_subreddit_cursors = []
+        if not self.pending_post_cursors:
+            return
+        self.database_manager.update_post_cursors(self.pending_post_cursors)
+        self.pending_post_cursors = []
+        # Posts older than the crawl window are never revisited
+        two_days_ago = datetime.datetime.now() - datetime.timedelta(days=2)
+        self.database_manager.prune_post_cursors(two_days_ago.timestamp())
+
+
+class CommentCollector:
+    """
+    Thread-safe buffer for the comments collected by a crawl, so that the 
+    comment target and de-duplication hold across parallel workers.
+    Records leave the buffer through drain.
+    """
+    def __init__(self, comment_target):
+        self.comment_target = comment_target
+        self.buffer = []
+        self.collected = 0
+        self.seen_comment_ids = set()
+        self.comment_counter = 0
+        self.lock = threading.Lock()
+
+    def is_full(self):
+        with self.lock:
+            return self.collected >= self.comment_target
+
+    def is_seen(self, comment_id):
+        with self.lock:
+            return comment_id in self.seen_comment_ids
+
+    def add(self, record):
+        """Add a record unless it is a duplicate or the target is already met."""
+        with self.lock:
+            if self.collected >= self.comment_target or record.comment_id in self.seen_comment_ids:
+                return False
+            self.buffer.append(record)
+            self.collected += 1
+            self.seen_comment_ids.add(record.comment_id)
+            return True
+
+    def buffered(self):
+        with self.lock:
+            return len(self.buffer)
+
+    def drain(self, max_records=None):
+        """Remove and return up to max_records buffered records (default: all)."""
+        with self.lock:
+            batch = self.buffer[:max_records]
+            del self.buffer[:max_records]
+            return batch
 
-        # Convert the list of dictionaries into a pandas DataFrame
-        return pd.DataFrame(data)
\ No newline at end of file
+    def count_checked(self):
+        with self.lock:
+            self.comment_counter += 1
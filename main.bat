@@ -1,4 +1,4 @@
 @echo off
 CALL C:\Miniconda3\Scripts\activate.bat reddit
-CALL python 
+CALL python main.py %*
 pause
\ No newline at end of file
@@ -1,134 +1,278 @@
+"""
+Reddit firm-mention pipeline.
+
+Usage: python main.py [--stages ingest sentiment topics summarise backfill archive] [--force-topics]
+                      [--inference-backend torch|int8|onnx] [--intra-op-threads N] [--inter-op-threads N]
+                      [--fetch-strategy posts|comments] [--sentiment-jobs N]
+
+Stages (default: ingest sentiment topics summarise):
+* ingest - fetch new comments mentioning the firms and store them.
+* sentiment - score new comments (and any stored comment left unscored).
+* topics - topic modelling of the last 7 days, once a day.
+* summarise - summarise each topic; needs topics, which is added if missing.
+* backfill - score every stored comment from the last --backfill-days days 
+  that has no sentiment yet.
+* archive - move comments older than --retention-days days to Parquet files
+  under --archive-dir and shrink the database. Runs on its own, e.g. 
+  weekly, as the vacuum holds up other writers.
+
+--inference-backend picks how the embedding and summarisation models run
+on the CPU: fp32 PyTorch (torch, the default), dynamically quantised int8
+PyTorch (int8) or ONNX Runtime (onnx). Check a backend against fp32 with
+`python benchmarks.py --suites parity` before switching.
+"""
 # Standard imports
+import argparse
 import logging
-import datetime
-import pandas as pd
 import os
-from datetime import datetime
+import sys
+from datetime import datetime, timedelta
 
-# Related 3rd party imports
-import praw 
-
-# Local imports
+# Local imports - analytics imports its ML libraries only when a stage needs them
 from api import APIConnection
-from get_data import GetData
+from transport import HTTPTransport
+from get_data import GetData, FETCH_STRATEGIES
 from database import DatabaseManager
+from pipeline import Stage, PipelineRunner, SkipStage
+from telemetry import recorder
 import analytics as an
 
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
-
-### --- CONNECT TO API --- ###
-
-CLIENT_ID = os.environ.get("REDDIT_CLIENT_ID")
-CLIENT_SECRET = os.environ.get("REDDIT_CLIENT_SECRET")
-USER_AGENT= os.environ.get("REDDIT_USER_AGENT")
-api_connection = APIConnection(CLIENT_ID, CLIENT_SECRET, USER_AGENT)
-
-### --- EXTRACT COMMENT DATA --- ###
-
-# Initialise data collection class
-data_inst = GetData(api_connection=api_connection,
-                    firm_list_path="firms.csv",
-                    subreddits=['wallstreetbets', 'investing', 'stocks', 'SecurityAnalysis', 'finance'])
-
-# Get last run time - only want to check comments since the last run time 
-try:
-    with open("last_run_time.txt", "r") as f:
-        last_run_time_str = f.read().strip()
-    last_run_time = datetime.strptime(last_run_time_str, '%Y-%m-%d %H:%M:%S')
-except FileNotFoundError:
-    # If the file doesn't exist, default to 24 hours ago
-    last_run_time = datetime.now() - datetime.timedelta(days=1)
-    logging.error(f"last_run_time.txt not found.")
-
-# Get comment data
-try:
-    df = data_inst.get_comments(comment_target=100, last_run_time=last_run_time)
-except Exception as e:
-    logging.error(f"Error retrieving comment data: {e}")
-try:
-    df = data_inst.clean_comments(df)
-except Exception as e:
-    logging.error(f"Error cleaning comment data: {e}")
-
-# Update last run time
-last_run_time = datetime.now()
-try:
+STAGES = ('ingest', 'sentiment', 'topics', 'summarise', 'backfill', 'archive')
+DEFAULT_STAGES = ('ingest', 'sentiment', 'topics', 'summarise')
+
+### --- PIPELINE STAGES --- ###
+
+def ingest(database_manager, api_connection, fetch_strategy, comment_batches):
+    """
+    Get comment data in batches - each batch is cleaned and written to the db,
+    then handed to the sentiment stage while the next batch is fetched.
+    """
+    db = database_manager.copy()
+    try:
+        data_inst = GetData(api_connection=api_connection,
+                            firm_list_path="firms.csv",
+                            subreddits=['wallstreetbets', 'investing', 'stocks', 'SecurityAnalysis', 'finance'],
+                            max_workers=5,
+                            database_manager=db,
+                            fetch_strategy=fetch_strategy)
+
+        # Get last run time - only want to check comments since the last run time 
+        try:
+            with open("last_run_time.txt", "r") as f:
+                last_run_time_str = f.read().strip()
+            last_run_time = datetime.strptime(last_run_time_str, '%Y-%m-%d %H:%M:%S')
+        except FileNotFoundError:
+            # If the file doesn't exist, default to 24 hours ago
+            last_run_time = datetime.now() - timedelta(days=1)
+            logging.error(f"last_run_time.txt not found.")
+
+        n_comments = 0
+        # CommentBatches of records, cleaned as they were collected, go straight to the db and sentiment
+        for batch in data_inst.iter_comment_batches(comment_target=100, last_run_time=last_run_time, batch_size=500):
+            db.insert_new_comments(batch)
+            comment_batches.put(batch)
+            n_comments += len(batch)
+    finally:
+        db.close()
+
+    # Update last run time - only once the crawl has finished
     with open("last_run_time.txt", "w")  as f:
-        f.write(last_run_time.strftime('%Y-%m-%d %H:%M:%S'))
-except FileNotFoundError:
-    logging.error(f"last_run_time.txt not found.")
-
-### --- WRITE DATA TO DATABASE --- ###
-
-# Connect to db
-try:
-    database_manager = DatabaseManager(db_path="reddit-sqlite.db")
-    database_manager.connect()
-except Exception as e:
-    logging.error(f"Error connecting to database: {e}")
-# Add raw data to db
-try:
-    database_manager.create_raw_table()
-    database_manager.insert_new_comments(df)
-except Exception as e:
-    logging.error(f"Error adding new data to comments table: {e}")
-
-# Log total API calls
-logging.info(f"Total API calls made: {api_connection.get_total_calls()}")
-
-### --- ANALYSIS --- ###
-   
-## Sentiment analysis
-try:
-    sent_df = an.get_sentiment(df, 'comment')
-    sent_df = sent_df[['comment_id', 'compound', 'sentiment']]
-except Exception as e:
-    logging.error(f"Error conducting sentiment analysis: {e}")
-
-# Add sentiment data to db
-try:
-    database_manager.create_sentiment_table()
-    database_manager.update_sentiment_table(sent_df)
-except Exception as e:
-    logging.error(f"Error adding new data to sentiment table: {e}")
-
-## Topic modelling and Summarisation
-    
-# Check if it's been ran today - compute intensive so only run once a day
-latest_date = database_manager.get_latest_date(table='topic_summaries')
-latest_date = datetime.strptime(latest_date, '%Y-%m-%d').date()
-if datetime.today().date() != latest_date:
-    
-    # Get last 7 days comment data from db
+        f.write(datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+
+    # Log total API calls
+    logging.info(f"Total API calls made: {api_connection.get_total_calls()}")
+    api_connection.scheduler.log_stats()
+    api_connection.transport.log_stats()
+    return {'n_comments': n_comments}
+
+def score_unscored(db, n_previous_days:int, sentiment_jobs:int=1):
+    """
+    Sentiment analysis of stored comments from the past n days that have none
+    yet, a chunk at a time, each scored by sentiment_jobs worker processes.
+    """
+    for unscored_df in db.iter_unscored_comments(n_previous_days=n_previous_days):
+        sent_df = an.get_sentiment(unscored_df, 'comment', n_jobs=sentiment_jobs)
+        db.update_sentiment_table(sent_df[['comment_id', 'compound', 'sentiment']])
+
+def score_sentiment(database_manager, sentiment_jobs, comment_batches=()):
+    """Sentiment analysis of each new batch, then of any stored comment an interrupted run left unscored."""
+    db = database_manager.copy()
     try:
-        recent_df = database_manager.get_data(n_previous_days=7)
-        comments = recent_df['comment'].to_list()
-    except:
-        logging.error(f"Error getting most recent data.")
-    
-    # Topic modelling
+        for batch in comment_batches:
+            scored_ids = db.get_existing_ids('sentiment', batch.column('comment_id'))
+            sent_df = an.get_sentiment(batch, 'comment', scored_ids=scored_ids, n_jobs=sentiment_jobs)
+            db.update_sentiment_table(sent_df[['comment_id', 'compound', 'sentiment']])
+        score_unscored(db, n_previous_days=7, sentiment_jobs=sentiment_jobs)
+    finally:
+        db.close()
+
+def backfill(database_manager, backfill_days, sentiment_jobs):
+    db = database_manager.copy()
+    try:
+        score_unscored(db, n_previous_days=backfill_days, sentiment_jobs=sentiment_jobs)
+    finally:
+        db.close()
+
+def archive(database_manager, retention_days):
+    db = database_manager.copy()
     try:
-        topics, topics_info = an.get_topics(comments, hdbscan_min_cluster_size=10)
-    except Exception as e:
-        logging.error(f"Error conducting topic modelling: {e}")
+        db.archive_comments(retention_days=retention_days)
+    finally:
+        db.close()
 
-    # Topic summarisation
+def model_topics(database_manager, force_topics, inference_backend, intra_op_threads, inter_op_threads, n_comments=None):
+    """
+    Topic modelling of the last 7 days - only comments not embedded on a previous
+    day are encoded, and only comments not seen by the saved topic model are assigned.
+    """
+    db = database_manager.copy()
     try:
-        topics_summary_df = an.topic_summarisation(comments, topics, topics_info)
-    except Exception as e:
-        logging.error(f"Error summarising topic clusters: {e}")
+        # Check if it's been ran today - compute intensive so only run once a day
+        latest_date = db.get_latest_date(table='topic_summaries')
+        if (not force_topics and latest_date is not None 
+                and datetime.strptime(latest_date, '%Y-%m-%d').date() == datetime.today().date()):
+            raise SkipStage("Topic modelling already conducted today.")
+
+        recent_df = db.get_data(n_previous_days=7, columns=['comment_id', 'comment'])
+        comments = recent_df['comment'].to_list()
+        comment_ids = recent_df['comment_id'].to_list()
+        topics, topics_info, embeddings = an.get_topics_incremental(comments, 
+                                                                    comment_ids,
+                                                                    topic_store=db,
+                                                                    embedding_store=db,
+                                                                    embedding_backend=inference_backend,
+                                                                    intra_op_threads=intra_op_threads,
+                                                                    inter_op_threads=inter_op_threads,
+                                                                    hdbscan_min_cluster_size=10)
+        db.evict_embeddings(n_previous_days=8)
+    finally:
+        db.close()
+    return {'comments': comments, 'topics': topics, 'topics_info': topics_info, 'embeddings': embeddings}
 
-    # Add topic summarisation to db
+def summarise_topics(database_manager, comments, topics, topics_info, embeddings,
+                     inference_backend, intra_op_threads, inter_op_threads):
+    """Topic summarisation, added to the topic_summaries table."""
+    topics_summary_df = an.topic_summarisation(comments, topics, topics_info, embeddings=embeddings,
+                                               backend=inference_backend,
+                                               intra_op_threads=intra_op_threads,
+                                               inter_op_threads=inter_op_threads)
+    db = database_manager.copy()
     try:
-        database_manager.create_topic_summaries_table()
-        database_manager.update_topic_summaries_table(topics_summary_df)
-    except Exception as e:
-        logging.error(f"Error adding new data to topics_summary table: {e}")
+        db.update_topic_summaries_table(topics_summary_df)
+    finally:
+        db.close()
+
+def build_stages(selected:list)->list:
+    """
+    The pipeline stages for the selected stage names. Stages run as soon as 
+    their inputs are ready: sentiment scores each batch as ingest stores it, 
+    and topic modelling runs alongside sentiment once ingest has finished.
+    """
+    stages = []
+    inference = ('inference_backend', 'intra_op_threads', 'inter_op_threads')
+    if 'ingest' in selected:
+        stages.append(Stage('ingest', ingest, inputs=('database_manager', 'api_connection', 'fetch_strategy'),
+                            outputs=('n_comments',), streams=('comment_batches',), resumable=False))
+    if 'sentiment' in selected:
+        # Without ingest, only stored comments left unscored are picked up
+        batches = ('comment_batches',) if 'ingest' in selected else ()
+        stages.append(Stage('sentiment', score_sentiment, inputs=('database_manager', 'sentiment_jobs') + batches))
+    if 'backfill' in selected:
+        stages.append(Stage('backfill', backfill, inputs=('database_manager', 'backfill_days', 'sentiment_jobs')))
+    if 'archive' in selected:
+        stages.append(Stage('archive', archive, inputs=('database_manager', 'retention_days')))
+    if 'topics' in selected or 'summarise' in selected:
+        # Model the comments this run fetched, if it fetches any
+        after_ingest = ('n_comments',) if 'ingest' in selected else ()
+        stages.append(Stage('topics', model_topics, inputs=('database_manager', 'force_topics') + inference + after_ingest,
+                            outputs=('comments', 'topics', 'topics_info', 'embeddings')))
+    if 'summarise' in selected:
+        stages.append(Stage('summarise', summarise_topics, 
+                            inputs=('database_manager', 'comments', 'topics', 'topics_info', 'embeddings') + inference))
+    return stages
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--stages", nargs="+", choices=STAGES, default=list(DEFAULT_STAGES))
+    parser.add_argument("--force-topics", action="store_true", help="run topic modelling even if it already ran today")
+    parser.add_argument("--backfill-days", type=int, default=30)
+    parser.add_argument("--sentiment-jobs", type=int, default=os.cpu_count() or 1,
+                        help="worker processes for sentiment scoring (small batches are scored in-process)")
+    parser.add_argument("--fetch-strategy", choices=FETCH_STRATEGIES, default='posts',
+                        help="expand each recent post's comments, or page each subreddit's comment listing")
+    parser.add_argument("--db-path", default="reddit-sqlite.db")
+    parser.add_argument("--retention-days", type=int, default=90, help="age at which the archive stage moves comments to Parquet")
+    parser.add_argument("--archive-dir", default="archive")
+    parser.add_argument("--inference-backend", choices=an.INFERENCE_BACKENDS, default='torch',
+                        help="how the embedding and summarisation models run")
+    parser.add_argument("--intra-op-threads", type=int, help="threads used within each model op")
+    parser.add_argument("--inter-op-threads", type=int, help="threads used to run independent ops in parallel")
+    args = parser.parse_args(argv)
+    if 'archive' in args.stages and len(set(args.stages)) > 1:
+        parser.error("archive vacuums the database and must run on its own: --stages archive")
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    ### --- CONNECT TO API --- ###
+
+    CLIENT_ID = os.environ.get("REDDIT_CLIENT_ID")
+    CLIENT_SECRET = os.environ.get("REDDIT_CLIENT_SECRET")
+    USER_AGENT= os.environ.get("REDDIT_USER_AGENT")
+    # live (default), record, replay or cache - see transport.HTTPTransport
+    transport = HTTPTransport(mode=os.environ.get("REDDIT_HTTP_MODE", "live"),
+                              store_path=os.environ.get("REDDIT_HTTP_STORE", "http_store"))
+    api_connection = APIConnection(CLIENT_ID, CLIENT_SECRET, USER_AGENT, transport=transport)
+
+    ### --- CONNECT TO DATABASE --- ###
+
+    # Connect to db and create every table up front - each stage then opens
+    # its own connection, as sqlite connections can't be shared between threads
+    database_manager = DatabaseManager(db_path=args.db_path, archive_dir=args.archive_dir)
+    database_manager.connect(wal=True, synchronous='NORMAL', cache_size=-64000, mmap_size=256 * 1024**2)
+    database_manager.create_raw_table()
+    database_manager.create_sentiment_table()
+    database_manager.create_sentiment_rollup_table()
+    database_manager.create_cursor_tables()
+    database_manager.create_embeddings_table()
+    database_manager.create_comment_topics_table()
+    database_manager.create_topic_summaries_table()
+    database_manager.create_pipeline_tables()
+    database_manager.create_run_metrics_table()
+
+    ### --- RUN PIPELINE --- ###
+
+    # Completed stages are checkpointed, so a rerun after a failure resumes where it stopped - 
+    # except ingest, which fetches fresh comments every run
+    runner = PipelineRunner(build_stages(args.stages), checkpoint_store=database_manager)
+    runner.run(database_manager=database_manager,
+               api_connection=api_connection,
+               fetch_strategy=args.fetch_strategy,
+               force_topics=args.force_topics,
+               backfill_days=args.backfill_days,
+               sentiment_jobs=args.sentiment_jobs,
+               retention_days=args.retention_days,
+               inference_backend=args.inference_backend,
+               intra_op_threads=args.intra_op_threads,
+               inter_op_threads=args.inter_op_threads)
+
+    ### --- RUN METRICS --- ###
+
+    # Timings, CPU, peak memory and throughput of every instrumented step
+    metrics = recorder.drain()
+    recorder.log_summary(metrics)
+    database_manager.insert_run_metrics(runner.run_id, metrics)
+    # Optional Prometheus text file, e.g. for node_exporter's textfile collector
+    if os.environ.get("METRICS_PROM_FILE"):
+        recorder.write_prometheus(os.environ["METRICS_PROM_FILE"], metrics, run_id=runner.run_id)
+
+    ### --- CLEAN UP --- ###
+
+    # Close connection to db
+    database_manager.close()
 
-# else:
-    logging.info("Topic modelling already conducted today.")
+    # Non-zero exit code so a scheduler can see the run failed
+    return 1 if 'failed' in runner.status.values() else 0
 
-### --- CLEAN UP --- ###
 
-# Close connection to db
-database_manager.close()
\ No newline at end of file
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,100 @@
+import gc
+import logging
+import threading
+from collections import OrderedDict
+
+
+def estimate_size(obj)->int:
+    """
+    Approximate memory held by a loaded model, in bytes. Counts the
+    parameters and buffers of torch modules, including ones inside tuples
+    such as (model, tokeniser); anything else counts as zero.
+    """
+    if isinstance(obj, (tuple, list)):
+        return sum(estimate_size(item) for item in obj)
+    if hasattr(obj, 'parameters') and hasattr(obj, 'buffers'):
+        tensors = list(obj.parameters()) + list(obj.buffers())
+        return sum(tensor.numel() * tensor.element_size() for tensor in tensors)
+    return 0
+
+
+class ModelRegistry:
+    """
+    Process-wide cache of loaded models. Each model is loaded once, on
+    first use, and shared by every later call. Loading is thread safe:
+    concurrent callers asking for the same model wait for a single load.
+
+    When max_bytes is set, the least recently used models are unloaded
+    once the estimated total goes over it.
+    """
+    def __init__(self, max_bytes:int=None):
+        self.max_bytes = max_bytes
+        self.models = OrderedDict()  # key -> (model, size in bytes), least recently used first
+        self.lock = threading.Lock()
+        self.load_locks = {}
+
+    def get(self, key, loader, size_fn=estimate_size):
+        """
+        Return the model stored under key, calling loader() to load it if
+        it isn't loaded yet.
+        """
+        with self.lock:
+            if key in self.models:
+                self.models.move_to_end(key)
+                return self.models[key][0]
+            load_lock = self.load_locks.setdefault(key, threading.Lock())
+
+        with load_lock:
+            # Another thread may have finished loading while we waited
+            with self.lock:
+                if key in self.models:
+                    self.models.move_to_end(key)
+                    return self.models[key][0]
+
+            logging.info(f"Loading model {key}...")
+            model = loader()
+            size = size_fn(model)
+            with self.lock:
+                self.models[key] = (model, size)
+                self.load_locks.pop(key, None)
+                self._evict(keep=key)
+            logging.info(f"Model {key} loaded ({size / 1024**2:.0f} MB).")
+            return model
+
+    def _evict(self, keep):
+        """Unload least recently used models until within max_bytes. Caller holds the lock."""
+        if self.max_bytes is None:
+            return
+        for key in list(self.models):
+            if self.total_bytes() <= self.max_bytes:
+                break
+            if key != keep:
+                self.models.pop(key)
+                logging.info(f"Evicted model {key} from the registry.")
+        gc.collect()
+
+    def unload(self, key):
+        """Drop a model from the registry. Returns True if it was loaded."""
+        with self.lock:
+            unloaded = self.models.pop(key, None) is not None
+        if unloaded:
+            gc.collect()
+            logging.info(f"Unloaded model {key}.")
+        return unloaded
+
+    def clear(self):
+        with self.lock:
+            self.models.clear()
+        gc.collect()
+
+    def total_bytes(self)->int:
+        return sum(size for _, size in self.models.values())
+
+    def memory_usage(self)->dict:
+        """Estimated bytes held by each loaded model."""
+        with self.lock:
+            return {key: size for key, (_, size) in self.models.items()}
+
+
+# Shared by every stage of the pipeline
+registry = ModelRegistry()
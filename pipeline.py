@@ -0,0 +1,306 @@
+import logging
+import pickle
+import queue
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from datetime import datetime, timedelta
+
+from telemetry import recorder
+
+
+class SkipStage(Exception):
+    """Raised by a stage with nothing to do; the stages depending on it are skipped too."""
+
+
+class StreamClosed(Exception):
+    """Raised when iterating over a stream whose producer failed."""
+
+
+class BatchStream:
+    """
+    Bounded queue of batches from one running stage to another, so a consumer
+    works on batch N while its producer is already fetching batch N+1.
+    """
+    _END = object()
+
+    def __init__(self, name:str, maxsize:int=2):
+        self.name = name
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.error = None
+        self.cancelled = False
+
+    def put(self, batch):
+        """Add a batch, waiting while the queue is full. Dropped once the stream is cancelled."""
+        while not self.cancelled:
+            try:
+                self.queue.put(batch, timeout=0.5)
+                return
+            except queue.Full:
+                pass
+
+    def cancel(self):
+        """Stop accepting batches because the consumer failed, so the producer can carry on."""
+        self.cancelled = True
+
+    def close(self, error:Exception=None):
+        self.error = error
+        self.put(self._END)
+
+    def __iter__(self):
+        while True:
+            batch = self.queue.get()
+            if batch is self._END:
+                if self.error is not None:
+                    raise StreamClosed(f"Producer of '{self.name}' failed: {self.error}")
+                return
+            yield batch
+
+
+class Stage:
+    """
+    A step of the pipeline.
+
+    Params:
+    -------
+    * name `str`: unique stage name, used for checkpoints.
+    * func: called with one keyword argument per input and stream; returns
+      a dict with a value for each output (or None if it has no outputs).
+    * inputs `tuple`: names of values or streams the stage needs.
+    * outputs `tuple`: names of the values the stage returns.
+    * streams `tuple`: names of the BatchStreams the stage writes to while
+      it runs. Their consumers start at the same time as the stage.
+    * persist `bool`: save the outputs with the checkpoint, so a resumed
+      run can reuse them. Otherwise a completed stage is run again when a
+      stage that needs its outputs has to be run again.
+    * resumable `bool`: whether a resumed run may skip the stage once it
+      completed. If not, e.g. for a stage fetching fresh data, it and 
+      every stage depending on it run again in each resumed run.
+    """
+    def __init__(self, name:str, func, inputs:tuple=(), outputs:tuple=(), streams:tuple=(), persist:bool=False,
+                 resumable:bool=True):
+        self.name = name
+        self.func = func
+        self.inputs = tuple(inputs)
+        self.outputs = tuple(outputs)
+        self.streams = tuple(streams)
+        self.persist = persist
+        self.resumable = resumable
+
+
+class PipelineRunner:
+    """
+    Runs a DAG of stages, each as soon as everything it needs is available,
+    with independent stages running concurrently.
+
+    A stage that fails or skips takes every stage depending on it along,
+    so nothing runs on missing or stale inputs. With a checkpoint_store
+    (e.g. a DatabaseManager), stage completion is recorded per run, and a
+    rerun within resume_within of a run of the same stages that did not 
+    complete resumes it.
+    """
+    def __init__(self, stages:list, checkpoint_store=None, max_workers:int=4,
+                 resume_within:timedelta=timedelta(hours=12)):
+        self.stages = {stage.name: stage for stage in stages}
+        # Runs of different stage selections are resumed separately
+        self.name = '+'.join(stage.name for stage in stages)
+        self.checkpoint_store = checkpoint_store
+        self.max_workers = max_workers
+        self.resume_within = resume_within
+        self.producers = {}
+        for stage in stages:
+            for name in stage.outputs + stage.streams:
+                if name in self.producers:
+                    raise ValueError(f"'{name}' is produced by both {self.producers[name]} and {stage.name}")
+                self.producers[name] = stage.name
+        self.dependencies = {stage.name: {self.producers[name] for name in stage.inputs if name in self.producers}
+                             for stage in stages}
+        # A stream's producer and consumers run at the same time, blocking on
+        # each other, so each needs a worker of its own
+        streaming = {stage.name for stage in stages if stage.streams}
+        streaming.update(stage.name for stage in stages
+                         if any(name in self.stages[self.producers[name]].streams
+                                for name in stage.inputs if name in self.producers))
+        if len(streaming) > max_workers:
+            raise ValueError(f"max_workers={max_workers} is fewer than the {len(streaming)} stages streaming "
+                             f"to each other ({', '.join(sorted(streaming))}), which would deadlock")
+        self.order = self._topological_order()
+        self.status = {}
+        self.run_id = None
+
+    def _topological_order(self)->list:
+        order, visiting, visited = [], set(), set()
+
+        def visit(name):
+            if name in visited:
+                return
+            if name in visiting:
+                raise ValueError(f"Stage dependencies form a cycle through '{name}'")
+            visiting.add(name)
+            for dependency in sorted(self.dependencies[name]):
+                visit(dependency)
+            visiting.discard(name)
+            visited.add(name)
+            order.append(name)
+
+        for name in self.stages:
+            visit(name)
+        return order
+
+    def _ready(self, stage)->bool:
+        """Whether every input of stage is available: values once their producer completed, streams once it started."""
+        for name in stage.inputs:
+            if name not in self.producers:
+                continue
+            producer_status = self.status.get(self.producers[name])
+            if producer_status in ('complete', 'restored'):
+                continue
+            if producer_status != 'running' or name not in self.stages[self.producers[name]].streams:
+                return False
+        return True
+
+    def _dependents(self, name:str)->set:
+        """Every stage that depends on name, directly or not."""
+        dependents = set()
+        for stage_name in self.order:
+            if self.dependencies[stage_name] & ({name} | dependents):
+                dependents.add(stage_name)
+        return dependents
+
+    def _plan(self, checkpoints:dict)->set:
+        """Names of the stages to run, given the checkpoints of completed stages."""
+        to_run = set()
+        for name in self.order:
+            if not self.stages[name].resumable:
+                if name in checkpoints:
+                    logging.info(f"Stage '{name}' is not resumable, running it and its dependents again.")
+                to_run |= {name} | self._dependents(name)
+        for name in reversed(self.order):
+            stage = self.stages[name]
+            if name in to_run:
+                continue
+            if name not in checkpoints:
+                to_run.add(name)
+                continue
+            # Completed, but its outputs are gone and a stage still to run needs them
+            reusable = stage.persist or not stage.outputs
+            needed = any(set(stage.outputs) & set(self.stages[other].inputs) for other in to_run)
+            if not reusable and needed:
+                to_run.add(name)
+        return to_run
+
+    def _start_run(self, run_id):
+        if self.checkpoint_store is None:
+            return run_id or datetime.now().strftime('%Y%m%d%H%M%S%f'), {}
+        if run_id is None:
+            since = (datetime.now() - self.resume_within).timestamp()
+            run_id = self.checkpoint_store.get_resumable_run(since, self.name)
+            if run_id is not None:
+                logging.info(f"Resuming pipeline run {run_id}.")
+        run_id = run_id or datetime.now().strftime('%Y%m%d%H%M%S%f')
+        self.checkpoint_store.start_run(run_id, self.name)
+        return run_id, self.checkpoint_store.get_stage_checkpoints(run_id)
+
+    def _checkpoint(self, run_id, name, status, started, error=None, outputs=None):
+        if self.checkpoint_store is None:
+            return
+        blob = pickle.dumps(outputs) if outputs is not None and self.stages[name].persist else None
+        self.checkpoint_store.checkpoint_stage(run_id, name, status, started, time.time(), error, blob)
+
+    def _execute(self, stage, kwargs, streams):
+        try:
+            with recorder.measure(f"stage.{stage.name}"):
+                outputs = stage.func(**kwargs) or {}
+        except BaseException as e:
+            for stream in streams:
+                stream.close(error=None if isinstance(e, SkipStage) else e)
+            raise
+        for stream in streams:
+            stream.close()
+        missing = set(stage.outputs) - set(outputs)
+        if missing:
+            raise ValueError(f"Stage '{stage.name}' did not return {sorted(missing)}")
+        return outputs
+
+    def run(self, run_id:str=None, **inputs)->dict:
+        """
+        Run the pipeline. Keyword arguments are extra inputs available to
+        every stage. Returns every value produced; see self.status for the
+        outcome of each stage ('complete', 'restored', 'failed' or 'skipped').
+        """
+        run_id, checkpoints = self._start_run(run_id)
+        self.run_id = run_id
+        to_run = self._plan(checkpoints)
+        values = dict(inputs)
+        self.status = {}
+        for name in self.order:
+            if name not in to_run:
+                stage = self.stages[name]
+                if stage.persist and checkpoints[name] is not None:
+                    values.update(pickle.loads(checkpoints[name]))
+                for stream_name in stage.streams:
+                    # Nothing more will be produced - consumers see an empty stream
+                    values[stream_name] = BatchStream(stream_name)
+                    values[stream_name].close()
+                self.status[name] = 'restored'
+                logging.info(f"Stage '{name}' already complete in run {run_id}.")
+
+        pending = [name for name in self.order if name in to_run]
+        running = {}
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while pending or running:
+                for name in list(pending):
+                    stage = self.stages[name]
+                    if not self._ready(stage):
+                        continue
+                    streams = [BatchStream(stream_name) for stream_name in stage.streams]
+                    for stream in streams:
+                        # Nobody left to read it
+                        if not any(stream.name in self.stages[other].inputs for other in pending):
+                            stream.cancel()
+                    values.update((stream.name, stream) for stream in streams)
+                    kwargs = {key: values[key] for key in stage.inputs + stage.streams}
+                    logging.info(f"Starting stage '{name}'.")
+                    future = executor.submit(self._execute, stage, kwargs, streams)
+                    running[future] = (name, time.time())
+                    self.status[name] = 'running'
+                    pending.remove(name)
+
+                if not running:
+                    break
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name, started = running.pop(future)
+                    try:
+                        outputs = future.result()
+                    except SkipStage as e:
+                        self.status[name] = 'skipped'
+                        self._checkpoint(run_id, name, 'skipped', started, error=str(e))
+                        logging.info(f"Stage '{name}' skipped: {e}")
+                    except Exception as e:
+                        self.status[name] = 'failed'
+                        self._checkpoint(run_id, name, 'failed', started, error=repr(e))
+                        logging.error(f"Stage '{name}' failed: {e}")
+                    else:
+                        values.update(outputs)
+                        self.status[name] = 'complete'
+                        self._checkpoint(run_id, name, 'complete', started, outputs=outputs)
+                        logging.info(f"Stage '{name}' complete in {time.time() - started:.1f}s.")
+                        continue
+
+                    # Let producers still waiting on this stage give up
+                    for key in self.stages[name].inputs:
+                        if isinstance(values.get(key), BatchStream):
+                            values[key].cancel()
+                    for dependent in self._dependents(name):
+                        if dependent in pending:
+                            pending.remove(dependent)
+                            for key in self.stages[dependent].inputs:
+                                if isinstance(values.get(key), BatchStream):
+                                    values[key].cancel()
+                            self.status[dependent] = 'skipped'
+                            logging.warning(f"Stage '{dependent}' skipped: '{name}' did not complete.")
+
+        failed = [name for name, status in self.status.items() if status == 'failed']
+        if self.checkpoint_store is not None:
+            self.checkpoint_store.finish_run(run_id, 'failed' if failed else 'complete')
+        return values
@@ -0,0 +1,242 @@
+"""
+Read-only HTTP service over the pipeline's results, for dashboards.
+
+Usage: python query_service.py [--db-path reddit-sqlite.db] [--port 8000]
+
+Endpoints (JSON):
+* /sentiment?firm=...&subreddit=...&days=30&by_subreddit=1 - daily sentiment
+  per firm, from the sentiment_daily rollup. firm and subreddit can repeat.
+* /topics - the latest topic summaries.
+* /comments?firm=...&days=7&limit=20 - the most upvoted recent comments
+  about a firm, with their sentiment.
+* /health
+
+Queries run on a pool of read-only connections, so they never take write
+locks, and identical queries are answered from a cache until the pipeline
+next commits to the database or ttl seconds pass.
+"""
+import argparse
+import json
+import logging
+import queue
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+from database import DatabaseManager
+from telemetry import recorder
+
+
+class ConnectionPool:
+    """Fixed set of read-only DatabaseManagers, each used by one request at a time."""
+    def __init__(self, db_path:str, size:int=4, **connect_kwargs):
+        self.managers = queue.Queue()
+        for _ in range(size):
+            database_manager = DatabaseManager(db_path)
+            database_manager.connect(read_only=True, **connect_kwargs)
+            self.managers.put(database_manager)
+        self.size = size
+
+    @contextmanager
+    def connection(self, timeout:float=30):
+        database_manager = self.managers.get(timeout=timeout)
+        try:
+            yield database_manager
+        finally:
+            self.managers.put(database_manager)
+
+    def close(self):
+        for _ in range(self.size):
+            self.managers.get().close()
+
+
+class QueryCache:
+    """
+    Thread-safe LRU cache of responses with a time to live. Cleared as soon
+    as the database changes: a dedicated connection's PRAGMA data_version
+    moves whenever another connection, e.g. the pipeline, commits.
+    """
+    def __init__(self, version_source:DatabaseManager, max_size:int=256, ttl:float=60):
+        self.version_source = version_source
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()  # key -> (expires at, value)
+        self.lock = threading.Lock()
+        self.data_version = None
+        self.hits = 0
+        self.misses = 0
+
+    def _check_version(self):
+        """Clear the cache if the database changed since the last check. Caller holds the lock."""
+        data_version = self.version_source.get_data_version()
+        if data_version != self.data_version:
+            if self.entries:
+                logging.info(f"Database changed, clearing {len(self.entries)} cached responses.")
+            self.entries.clear()
+            self.data_version = data_version
+
+    def get(self, key):
+        """
+        Cached value for key, or None, and the data_version it was checked
+        against - pass that to put, so a value read after a change that
+        lands meanwhile is not cached.
+        """
+        with self.lock:
+            self._check_version()
+            entry = self.entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                self.entries.pop(key, None)
+                self.misses += 1
+                return None, self.data_version
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1], self.data_version
+
+    def put(self, key, value, data_version):
+        """Cache value, unless the database changed since data_version, as value may predate the change."""
+        with self.lock:
+            self._check_version()
+            if data_version != self.data_version:
+                return
+            self.entries[key] = (time.monotonic() + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+
+class BadRequest(Exception):
+    """Raised for a request with missing or invalid parameters."""
+
+
+def int_param(params:dict, name:str, default:int, maximum:int)->int:
+    try:
+        value = int(params.get(name, [default])[0])
+    except ValueError:
+        raise BadRequest(f"'{name}' must be an integer")
+    if not 0 < value <= maximum:
+        raise BadRequest(f"'{name}' must be between 1 and {maximum}")
+    return value
+
+
+class QueryService:
+    """The queries behind each endpoint, run on pooled connections and cached."""
+    def __init__(self, db_path:str, pool_size:int=4, cache_size:int=256, ttl:float=60, mmap_size:int=None):
+        self.pool = ConnectionPool(db_path, size=pool_size, mmap_size=mmap_size)
+        self.version_source = DatabaseManager(db_path)
+        self.version_source.connect(read_only=True)
+        self.cache = QueryCache(self.version_source, max_size=cache_size, ttl=ttl)
+        self.routes = {
+            '/sentiment': self.sentiment,
+            '/topics': self.topics,
+            '/comments': self.comments,
+        }
+
+    def sentiment(self, database_manager, params:dict):
+        return database_manager.get_sentiment_trend(n_previous_days=int_param(params, 'days', 30, 3650),
+                                                    firms=params.get('firm'),
+                                                    subreddits=params.get('subreddit'),
+                                                    by_subreddit=params.get('by_subreddit', ['0'])[0] in ('1', 'true'))
+
+    def topics(self, database_manager, params:dict):
+        return database_manager.get_latest_topic_summaries()
+
+    def comments(self, database_manager, params:dict):
+        if not params.get('firm'):
+            raise BadRequest("'firm' is required")
+        return database_manager.get_comment_sample(params['firm'][0],
+                                                   n_previous_days=int_param(params, 'days', 7, 3650),
+                                                   limit=int_param(params, 'limit', 20, 500))
+
+    def handle(self, route, path:str, params:dict):
+        """
+        JSON body for a request to route, one of self.routes, and whether it
+        came from the cache. Raises BadRequest for invalid parameters.
+        """
+        key = (path, tuple(sorted((name, tuple(values)) for name, values in params.items())))
+        body, data_version = self.cache.get(key)
+        if body is not None:
+            return body, True
+        with self.pool.connection() as database_manager:
+            df = route(database_manager, params)
+        body = df.to_json(orient='records').encode('utf-8')
+        self.cache.put(key, body, data_version)
+        return body, False
+
+    def health(self)->bytes:
+        return json.dumps({'status': 'ok', 'cache_hits': self.cache.hits, 'cache_misses': self.cache.misses,
+                           'cached_responses': len(self.cache.entries)}).encode('utf-8')
+
+    def close(self):
+        self.pool.close()
+        self.version_source.close()
+
+
+def make_handler(service:QueryService):
+    class QueryHandler(BaseHTTPRequestHandler):
+        def send_json(self, status:int, body:bytes, cache_status:str=None):
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            if cache_status:
+                self.send_header('X-Cache', cache_status)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def send_error_json(self, status:int, message:str):
+            self.send_json(status, json.dumps({'error': message}).encode('utf-8'))
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            if url.path == '/health':
+                self.send_json(200, service.health())
+                return
+            route = service.routes.get(url.path)
+            if route is None:
+                self.send_error_json(404, f"Unknown endpoint '{url.path}'")
+                return
+            try:
+                body, cached = service.handle(route, url.path, parse_qs(url.query))
+            except BadRequest as e:
+                self.send_error_json(400, str(e))
+            except queue.Empty:
+                self.send_error_json(503, "All database connections are busy")
+            except Exception as e:
+                logging.exception(f"Query {self.path} failed")
+                self.send_error_json(500, type(e).__name__)
+            else:
+                self.send_json(200, body, 'HIT' if cached else 'MISS')
+
+        def log_message(self, format, *args):
+            logging.debug(f"{self.address_string()} - {format % args}")
+
+    return QueryHandler
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--db-path", default="reddit-sqlite.db")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--pool-size", type=int, default=4, help="read-only connections to query on")
+    parser.add_argument("--cache-size", type=int, default=256, help="responses to keep cached")
+    parser.add_argument("--ttl", type=float, default=60, help="seconds a cached response is kept at most")
+    args = parser.parse_args()
+
+    # A long-running process - don't keep a measurement of every query
+    recorder.enabled = False
+
+    service = QueryService(args.db_path, pool_size=args.pool_size, cache_size=args.cache_size, ttl=args.ttl,
+                           mmap_size=256 * 1024**2)
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(service))
+    logging.info(f"Serving {args.db_path} on http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
@@ -0,0 +1,72 @@
+import sys
+from datetime import datetime
+from operator import attrgetter
+
+import pandas as pd
+
+# Columns of the comments table, in order
+COMMENT_COLUMNS = ('subreddit', 'post_title', 'comment_id', 'comment_date', 'comment_epoch', 'comment',
+                   'matched_phrase', 'firm', 'upvotes')
+
+
+class CommentRecord:
+    """
+    One collected comment. Slots instead of a dict per comment, subreddit,
+    matched_phrase and firm interned, and the time kept as an integer epoch
+    - comment_date, the local 'YYYY-MM-DD HH:MM:SS' string the comments
+    table stores, is only formatted when a row is written.
+    """
+    __slots__ = ('subreddit', 'post_title', 'comment_id', 'comment_epoch', 'comment', 'matched_phrase', 'firm',
+                 'upvotes')
+
+    def __init__(self, subreddit:str, post_title:str, comment_id:str, comment_epoch:int, comment:str,
+                 matched_phrase:str='', firm:str='', upvotes:int=0):
+        self.subreddit = sys.intern(subreddit)
+        self.post_title = post_title
+        self.comment_id = comment_id
+        self.comment_epoch = int(comment_epoch)
+        self.comment = comment
+        self.matched_phrase = sys.intern(matched_phrase)
+        self.firm = sys.intern(firm)
+        self.upvotes = upvotes or 0
+
+    @property
+    def comment_date(self)->str:
+        return datetime.fromtimestamp(self.comment_epoch).strftime('%Y-%m-%d %H:%M:%S')
+
+    def __repr__(self):
+        return f"CommentRecord({self.comment_id!r}, r/{self.subreddit}, {self.firm!r})"
+
+
+class CommentBatch(list):
+    """
+    A list of CommentRecords, as yielded by GetData.iter_comment_batches.
+    DatabaseManager.insert_new_comments and analytics.get_sentiment take a
+    batch as it is, reading the records' fields without building a
+    DataFrame of the whole batch first.
+    """
+    def column(self, name:str)->list:
+        return [getattr(record, name) for record in self]
+
+    def rows(self, columns:tuple=COMMENT_COLUMNS):
+        """Iterator of tuples of the given columns, one per record, made as they are consumed."""
+        get = attrgetter(*columns)
+        if len(columns) == 1:
+            return ((get(record),) for record in self)
+        return map(get, self)
+
+    def to_frame(self, columns:tuple=COMMENT_COLUMNS)->pd.DataFrame:
+        """
+        DataFrame of the given columns. Text columns hold the records' own
+        string objects, and subreddit and firm are categorical.
+        """
+        data = {}
+        for name in columns:
+            values = self.column(name)
+            if name in ('subreddit', 'firm'):
+                data[name] = pd.Categorical(values)
+            elif name in ('comment_epoch', 'upvotes'):
+                data[name] = pd.array(values, dtype='int64')
+            else:
+                data[name] = pd.array(values, dtype=object)
+        return pd.DataFrame(data, columns=list(columns))
@@ -0,0 +1,198 @@
+"""
+Synthetic Reddit comment streams built from tweet_templates.csv and firms.csv,
+for benchmarks and offline testing of the pipeline.
+
+Usage: python synthetic_data.py --records 1000000 --output synthetic.csv
+"""
+import argparse
+import csv
+import logging
+import re
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+
+try:
+    from faker import Faker
+except ImportError:
+    Faker = None
+
+# Subjects of comments that don't mention a firm
+GENERIC_SUBJECTS = ['my bank', 'the bank', 'my broker', 'this fund', 'the market', 'my credit union',
+                    'the big banks', 'my pension provider', 'the app', 'my card issuer']
+SUBREDDITS = ['wallstreetbets', 'investing', 'stocks', 'SecurityAnalysis', 'finance']
+# Small edits that turn a copy of a comment into a near-duplicate
+NEAR_DUPLICATE_EDITS = ['!', '!!', ' lol', ' 🚀', ' (edit: typo)', '.', ' +1', ' this']
+
+
+def load_firms_from_csv(firm_list_path:str="firms.csv") -> list:
+    """(name, term) pairs for every name, abbreviation and ticker in a firms.csv style file."""
+    df = pd.read_csv(firm_list_path)
+    term_columns = ['name', 'altname', 'abbreviation', 'ticker', 'altticker']
+    df[term_columns] = df[term_columns].fillna('')
+    firms = []
+    for _, row in df.iterrows():
+        for column in term_columns:
+            if row[column].strip():
+                firms.append((row['name'].strip(), row[column].strip()))
+    return firms
+
+
+def read_tweet_templates(filepath:str="tweet_templates.csv") -> list:
+    with open(filepath, newline='', encoding='utf-8') as f:
+        reader = csv.reader(f, quotechar='"')
+        tweet_templates = [item for row in reader for item in row if item]
+    return tweet_templates
+
+
+class SyntheticCommentGenerator:
+    """
+    Generates comment streams in the layout of the comments table, in
+    batches, so millions of rows can be produced with flat memory.
+
+    Params:
+    -------
+    * firm_list_path `str`: firms.csv style file of firms to mention.
+    * templates_path `str`: comment templates with a {} for the subject.
+    * mention_rate `float`: share of comments mentioning a firm.
+    * duplicate_rate `float`: share of comments that copy an earlier one exactly.
+    * near_duplicate_rate `float`: share of comments that copy an earlier one with a small edit.
+    * noise_words `int`: up to this many random words are appended to each
+      comment, so that templated comments are not all identical. Words come
+      from Faker if it is installed, otherwise from the templates.
+    * start, end `datetime`: comment timestamps are spread over this range
+      (default: the 7 days up to now), in increasing order.
+    * subreddits `list`: subreddits to spread the comments over.
+    * seed `int`: seed, so the same settings give the same stream.
+    """
+    def __init__(self,
+                 firm_list_path:str="firms.csv",
+                 templates_path:str="tweet_templates.csv",
+                 mention_rate:float=0.3,
+                 duplicate_rate:float=0.05,
+                 near_duplicate_rate:float=0.05,
+                 noise_words:int=6,
+                 start:datetime=None,
+                 end:datetime=None,
+                 subreddits:list=None,
+                 seed:int=42):
+        if mention_rate + duplicate_rate + near_duplicate_rate > 1 or min(mention_rate, duplicate_rate, near_duplicate_rate) < 0:
+            raise ValueError("Rates must be between 0 and 1")
+        self.firms = load_firms_from_csv(firm_list_path)
+        self.templates = read_tweet_templates(templates_path)
+        self.mention_rate = mention_rate
+        self.duplicate_rate = duplicate_rate
+        self.near_duplicate_rate = near_duplicate_rate
+        self.noise_words = noise_words
+        self.end = end or datetime.now()
+        self.start = start or self.end - timedelta(days=7)
+        self.subreddits = subreddits or SUBREDDITS
+        self.seed = seed
+        self.vocabulary = self._vocabulary()
+
+    def _vocabulary(self)->np.ndarray:
+        if Faker is not None:
+            fake = Faker()
+            fake.seed_instance(self.seed)
+            words = fake.words(nb=2000)
+        else:
+            words = re.findall(r"[a-z']+", ' '.join(self.templates).lower())
+        return np.array(sorted(set(words)))
+
+    def iter_batches(self, num_records:int, batch_size:int=100_000):
+        """Yield num_records comments as DataFrames of up to batch_size rows."""
+        rng = np.random.default_rng(self.seed)
+        span = (self.end - self.start).total_seconds()
+        start_epoch = self.start.timestamp()
+        # Recent comments that duplicates can copy
+        recent = []
+        for batch_start in range(0, num_records, batch_size):
+            n = min(batch_size, num_records - batch_start)
+            positions = np.arange(batch_start, batch_start + n)
+            epochs = (start_epoch + span * positions / max(num_records - 1, 1)).astype(np.int64)
+            kinds = rng.choice(4, size=n, p=[1 - self.mention_rate - self.duplicate_rate - self.near_duplicate_rate,
+                                              self.mention_rate, self.duplicate_rate, self.near_duplicate_rate])
+            templates = rng.integers(len(self.templates), size=n)
+            firms = rng.integers(len(self.firms), size=n)
+            generic = rng.integers(len(GENERIC_SUBJECTS), size=n)
+            noise_counts = rng.integers(self.noise_words + 1, size=n)
+            noise = rng.integers(len(self.vocabulary), size=(n, max(self.noise_words, 1)))
+            edits = rng.integers(len(NEAR_DUPLICATE_EDITS), size=n)
+            copies = rng.random(n)
+
+            comments, phrases, names = [], [], []
+            for i in range(n):
+                kind = kinds[i]
+                if kind >= 2 and recent:
+                    # Copy of a recent comment, keeping its firm
+                    comment, phrase, name = recent[int(copies[i] * len(recent))]
+                    if kind == 3:
+                        comment += NEAR_DUPLICATE_EDITS[edits[i]]
+                else:
+                    if kind == 1:
+                        name, phrase = self.firms[firms[i]]
+                    else:
+                        name, phrase = '', ''
+                    subject = phrase or GENERIC_SUBJECTS[generic[i]]
+                    comment = self.templates[templates[i]].format(subject)
+                    if noise_counts[i]:
+                        comment += ' ' + ' '.join(self.vocabulary[noise[i, :noise_counts[i]]])
+                    recent.append((comment, phrase, name))
+                    if len(recent) > 1000:
+                        recent.pop(0)
+                comments.append(comment)
+                phrases.append(phrase)
+                names.append(name)
+
+            # comment_date is local time, like the crawled comments. UTC 
+            # offsets only change on a quarter hour, so look one up per 
+            # quarter hour the batch spans, not per comment
+            quarters, quarter_index = np.unique(epochs // 900, return_inverse=True)
+            utc_offsets = np.array([datetime.fromtimestamp(quarter * 900).astimezone().utcoffset().total_seconds()
+                                    for quarter in quarters.tolist()], dtype='int64')
+            comment_dates = pd.Series(pd.to_datetime(epochs + utc_offsets[quarter_index], unit='s')
+                                      .strftime('%Y-%m-%d %H:%M:%S'))
+            subreddit_index = rng.integers(len(self.subreddits), size=n)
+            yield pd.DataFrame({
+                'subreddit': np.array(self.subreddits, dtype=object)[subreddit_index],
+                'post_title': 'Daily discussion thread ' + comment_dates.str[:10],
+                'comment_id': [f"syn{self.seed}_{position}" for position in positions],
+                'comment_date': comment_dates,
+                'comment_epoch': epochs,
+                'comment': comments,
+                'matched_phrase': phrases,
+                'firm': names,
+                'upvotes': rng.geometric(0.2, size=n) - 1
+            })
+
+    def generate(self, num_records:int)->pd.DataFrame:
+        """num_records comments in one DataFrame."""
+        batches = list(self.iter_batches(num_records))
+        if not batches:
+            return pd.DataFrame()
+        return pd.concat(batches, ignore_index=True)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--records", type=int, default=2000)
+    parser.add_argument("--mention-rate", type=float, default=0.3)
+    parser.add_argument("--duplicate-rate", type=float, default=0.05)
+    parser.add_argument("--near-duplicate-rate", type=float, default=0.05)
+    parser.add_argument("--days", type=float, default=7, help="spread the comments over the last N days")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", default="synthetic.csv")
+    args = parser.parse_args()
+
+    end = datetime.now()
+    generator = SyntheticCommentGenerator(mention_rate=args.mention_rate,
+                                          duplicate_rate=args.duplicate_rate,
+                                          near_duplicate_rate=args.near_duplicate_rate,
+                                          start=end - timedelta(days=args.days),
+                                          end=end,
+                                          seed=args.seed)
+    for i, batch in enumerate(generator.iter_batches(args.records)):
+        batch.to_csv(args.output, mode='w' if i == 0 else 'a', header=i == 0, index=False)
+    logging.info(f"Wrote {args.records} synthetic comments to {args.output}.")
@@ -0,0 +1,264 @@
+import functools
+import inspect
+import logging
+import os
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+_process = psutil.Process() if psutil is not None else None
+
+
+def peak_rss_bytes():
+    """
+    High-water mark of the process's resident memory, in bytes, or None
+    if neither psutil nor resource is available.
+    """
+    if _process is not None:
+        memory_info = _process.memory_info()
+        # Windows reports the peak directly
+        if hasattr(memory_info, 'peak_wset'):
+            return memory_info.peak_wset
+    if resource is not None:
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # kilobytes on Linux, bytes on macOS
+        return max_rss if os.uname().sysname == 'Darwin' else max_rss * 1024
+    if _process is not None:
+        return _process.memory_info().rss
+    return None
+
+
+def count_items(result):
+    """Default item count of a step: rows or entries returned, or the sum of an (inserted, skipped) tuple."""
+    if isinstance(result, tuple) and result and all(isinstance(value, int) for value in result):
+        return sum(result)
+    if isinstance(result, bool) or result is None:
+        return None
+    if isinstance(result, int):
+        return result
+    try:
+        return len(result)
+    except TypeError:
+        return None
+
+
+class Measurement:
+    """
+    Metrics of one call of a step. Set items inside the block if the result
+    doesn't show it. nested is set for a call made within another 
+    instrumented call, whose measurement already includes it.
+    """
+    def __init__(self, step:str, items:int=None, nested:bool=False):
+        self.step = step
+        self.items = items
+        self.nested = nested
+        self.started_at = None
+        self.wall_s = None
+        self.cpu_s = None
+        self.peak_rss_bytes = None
+        self.error = None
+
+    def to_dict(self):
+        return {
+            'step': self.step,
+            'started_at': self.started_at,
+            'wall_s': self.wall_s,
+            'cpu_s': self.cpu_s,
+            'peak_rss_mb': None if self.peak_rss_bytes is None else self.peak_rss_bytes / 1024**2,
+            'items': self.items,
+            'items_per_s': self.items / self.wall_s if self.items is not None and self.wall_s else None,
+            'error': self.error,
+            'nested': self.nested
+        }
+
+
+class MetricsRecorder:
+    """
+    Collects the wall time, CPU time, peak RSS and throughput of each
+    instrumented call, to be written to the run_metrics table and,
+    optionally, a Prometheus text file at the end of a run.
+
+    CPU time is the whole process's, so it includes other threads running
+    at the same time, and peak RSS is the process high-water mark when the
+    call returned - a step that raises it is the one using the memory.
+    """
+    def __init__(self, enabled:bool=True):
+        self.enabled = enabled
+        self.measurements = []
+        self.lock = threading.Lock()
+        # Instrumented calls in progress on each thread
+        self._local = threading.local()
+
+    def _depth(self)->int:
+        return getattr(self._local, 'depth', 0)
+
+    @contextmanager
+    def _inside(self):
+        """Mark the thread as inside an instrumented call, so the calls it makes are measured as nested."""
+        self._local.depth = self._depth() + 1
+        try:
+            yield
+        finally:
+            self._local.depth -= 1
+
+    @contextmanager
+    def measure(self, step:str, items:int=None):
+        measurement = Measurement(step, items)
+        if not self.enabled:
+            yield measurement
+            return
+        measurement.started_at = time.time()
+        wall_start, cpu_start = time.perf_counter(), time.process_time()
+        try:
+            yield measurement
+        except BaseException as e:
+            measurement.error = type(e).__name__
+            raise
+        finally:
+            measurement.wall_s = time.perf_counter() - wall_start
+            measurement.cpu_s = time.process_time() - cpu_start
+            measurement.peak_rss_bytes = peak_rss_bytes()
+            with self.lock:
+                self.measurements.append(measurement)
+
+    def _record_generator(self, name, generator, items, nested):
+        """Measure a generator over its whole iteration, counting only the time spent inside it."""
+        measurement = Measurement(name, 0 if items is not None else None, nested=nested)
+        measurement.started_at = time.time()
+        measurement.wall_s, measurement.cpu_s = 0.0, 0.0
+        try:
+            while True:
+                wall_start, cpu_start = time.perf_counter(), time.process_time()
+                try:
+                    with self._inside():
+                        value = next(generator)
+                except StopIteration:
+                    return
+                finally:
+                    measurement.wall_s += time.perf_counter() - wall_start
+                    measurement.cpu_s += time.process_time() - cpu_start
+                if items is not None:
+                    measurement.items += items(value) or 0
+                yield value
+        except BaseException as e:
+            if not isinstance(e, GeneratorExit):
+                measurement.error = type(e).__name__
+            raise
+        finally:
+            generator.close()
+            measurement.peak_rss_bytes = peak_rss_bytes()
+            with self.lock:
+                self.measurements.append(measurement)
+
+    def instrument(self, step:str=None, items=count_items):
+        """
+        Decorator measuring every call of a function. items is called with
+        the function's result to count the items it processed. Generator
+        functions are measured over their whole iteration, with items
+        called on each value they yield. Instrumented calls made inside 
+        one are measured as nested, and left out of summarise's totals.
+        """
+        def decorator(function):
+            name = step or function.__qualname__
+
+            if inspect.isgeneratorfunction(function):
+                @functools.wraps(function)
+                def generator_wrapper(*args, **kwargs):
+                    generator = function(*args, **kwargs)
+                    if not self.enabled:
+                        return generator
+                    return self._record_generator(name, generator, items, nested=self._depth() > 0)
+                return generator_wrapper
+
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                nested = self._depth() > 0
+                with self.measure(name) as measurement, self._inside():
+                    measurement.nested = nested
+                    result = function(*args, **kwargs)
+                    if measurement.items is None and items is not None:
+                        measurement.items = items(result)
+                return result
+            return wrapper
+        return decorator
+
+    def instrument_methods(self, prefix:str=None):
+        """Class decorator instrumenting every public method, as '<prefix>.<method>'."""
+        def decorator(cls):
+            for name, attribute in list(vars(cls).items()):
+                if inspect.isfunction(attribute) and not name.startswith('_'):
+                    setattr(cls, name, self.instrument(f"{prefix or cls.__name__}.{name}")(attribute))
+            return cls
+        return decorator
+
+    def drain(self)->list:
+        """Remove and return the recorded measurements, as dicts."""
+        with self.lock:
+            measurements, self.measurements = self.measurements, []
+        return [measurement.to_dict() for measurement in measurements]
+
+    @staticmethod
+    def summarise(metrics:list)->dict:
+        """
+        Per-step totals: calls, wall and CPU seconds, items and the highest
+        peak RSS. Nested measurements are left out, as the call they were
+        made in already counts their time and items.
+        """
+        summary = defaultdict(lambda: {'calls': 0, 'wall_s': 0.0, 'cpu_s': 0.0, 'items': 0, 'peak_rss_mb': 0.0})
+        for metric in metrics:
+            if metric.get('nested'):
+                continue
+            step = summary[metric['step']]
+            step['calls'] += 1
+            step['wall_s'] += metric['wall_s']
+            step['cpu_s'] += metric['cpu_s']
+            step['items'] += metric['items'] or 0
+            step['peak_rss_mb'] = max(step['peak_rss_mb'], metric['peak_rss_mb'] or 0.0)
+        return dict(summary)
+
+    def log_summary(self, metrics:list):
+        for step, totals in sorted(self.summarise(metrics).items(), key=lambda item: -item[1]['wall_s']):
+            rate = totals['items'] / totals['wall_s'] if totals['wall_s'] else 0.0
+            logging.info(f"{step}: {totals['calls']} calls, {totals['wall_s']:.2f}s wall, {totals['cpu_s']:.2f}s CPU, "
+                         f"{totals['items']} items ({rate:.1f}/s), peak RSS {totals['peak_rss_mb']:.0f} MB")
+
+    def write_prometheus(self, path:str, metrics:list, run_id:str=None):
+        """Write per-step totals in the Prometheus text format, e.g. for node_exporter's textfile collector."""
+        summary = self.summarise(metrics)
+        series = [
+            ('reddit_pipeline_step_calls', 'gauge', 'Calls of the step in the run.', 'calls'),
+            ('reddit_pipeline_step_wall_seconds', 'gauge', 'Wall time spent in the step.', 'wall_s'),
+            ('reddit_pipeline_step_cpu_seconds', 'gauge', 'Process CPU time while in the step.', 'cpu_s'),
+            ('reddit_pipeline_step_items', 'gauge', 'Items processed by the step.', 'items'),
+            ('reddit_pipeline_step_peak_rss_bytes', 'gauge', 'Process peak RSS after the step.', 'peak_rss_mb'),
+        ]
+        lines = []
+        for metric_name, metric_type, help_text, key in series:
+            lines.append(f"# HELP {metric_name} {help_text}")
+            lines.append(f"# TYPE {metric_name} {metric_type}")
+            for step, totals in sorted(summary.items()):
+                value = totals[key] * 1024**2 if key == 'peak_rss_mb' else totals[key]
+                labels = f'step="{step}"' + (f',run_id="{run_id}"' if run_id else '')
+                lines.append(f"{metric_name}{{{labels}}} {value}")
+        # Write then rename, so a scraper never reads a partial file
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(tmp_path, path)
+        logging.info(f"Metrics written to {path}.")
+
+
+# Shared by every module of the pipeline
+recorder = MetricsRecorder()
@@ -0,0 +1,43 @@
+import numpy as np
+
+from analytics import approx_token_count, select_representative_comments
+
+
+def make_topic(n_comments:int, seed:int=0):
+    rng = np.random.default_rng(seed)
+    embeddings = rng.normal(size=(n_comments, 16)) + 3
+    # Mostly long comments, which stop fitting once the budget is nearly used
+    comments = [' '.join(['word'] * int(length)) for length in rng.integers(20, 200, size=n_comments)]
+    return comments, embeddings
+
+
+def test_token_budget_is_respected():
+    comments, embeddings = make_topic(2000)
+    selected = select_representative_comments(comments, embeddings, top_k=20, token_budget=300)
+    assert selected
+    assert sum(approx_token_count(comment) for comment in selected) <= 300
+
+
+class CountingList(list):
+    """A list that counts the items looked up one at a time."""
+    lookups = 0
+
+    def __getitem__(self, index):
+        self.lookups += 1
+        return super().__getitem__(index)
+
+
+def test_spent_budget_costs_no_more_for_large_topics():
+    comments, embeddings = make_topic(20000)
+    comments = CountingList(comments)
+    selected = select_representative_comments(comments, embeddings, top_k=20, token_budget=300)
+    assert sum(approx_token_count(comment) for comment in selected) <= 300
+    # Only the picked comments are looked up - not one candidate per scoring 
+    # pass until every comment has been tried
+    assert comments.lookups == len(selected)
+
+
+def test_most_relevant_comment_is_always_picked():
+    comments, embeddings = make_topic(500)
+    selected = select_representative_comments(comments, embeddings, top_k=5, token_budget=1)
+    assert len(selected) == 1
@@ -0,0 +1,109 @@
+import os
+import sqlite3
+import time
+from datetime import datetime, timedelta
+
+import pandas as pd
+import pytest
+
+from database import DatabaseManager
+
+
+def make_database(db_path):
+    database_manager = DatabaseManager(str(db_path))
+    database_manager.connect(wal=True)
+    database_manager.create_raw_table()
+    database_manager.create_sentiment_table()
+    database_manager.create_sentiment_rollup_table()
+    return database_manager
+
+
+def comment_rows(prefix:str, n:int):
+    now = int(time.time())
+    return pd.DataFrame({'comment_id': [f'{prefix}{i}' for i in range(n)],
+                         'subreddit': 'stocks', 'comment': 'Barclays', 'matched_phrase': 'barclays',
+                         'firm': 'Barclays', 'comment_epoch': now, 'upvotes': 1,
+                         'comment_date': pd.Timestamp.fromtimestamp(now).strftime('%Y-%m-%d %H:%M:%S')})
+
+
+def test_sentiment_update_survives_a_concurrent_commit(tmp_path):
+    scorer = make_database(tmp_path / 'reddit.db')
+    scorer.insert_new_comments(comment_rows('c', 10))
+    ingest = sqlite3.connect(str(tmp_path / 'reddit.db'), timeout=0.1)
+    ingest_errors = []
+
+    def commit_from_other_connection(statement):
+        # Once the update has read the scored ids, before it writes, another
+        # connection commits - as ingest does while sentiment runs
+        if statement.startswith('SELECT COUNT(*) FROM sentiment_staging'):
+            try:
+                with ingest:
+                    ingest.execute("INSERT INTO comments (comment_id, comment) VALUES ('new', 'Barclays')")
+            except sqlite3.OperationalError as e:
+                ingest_errors.append(e)
+
+    scorer.conn.set_trace_callback(commit_from_other_connection)
+    inserted, skipped = scorer.update_sentiment_table(
+        pd.DataFrame({'comment_id': [f'c{i}' for i in range(10)], 'compound': 0.5, 'sentiment': 'positive'}))
+    scorer.conn.set_trace_callback(None)
+
+    assert (inserted, skipped) == (10, 0)
+    # The other writer waited for the update instead of breaking it, and can write now
+    assert ingest_errors
+    with ingest:
+        ingest.execute("INSERT INTO comments (comment_id, comment) VALUES ('new', 'Barclays')")
+    ingest.close()
+    scorer.close()
+
+
+def test_archive_survives_a_concurrent_commit(tmp_path):
+    pytest.importorskip('pyarrow')
+    database_manager = make_database(tmp_path / 'reddit.db')
+    database_manager.archive_dir = str(tmp_path / 'archive')
+    old_comments = comment_rows('old', 10)
+    old_comments['comment_epoch'] -= 200 * 86400
+    database_manager.insert_new_comments(old_comments)
+    ingest = sqlite3.connect(str(tmp_path / 'reddit.db'), timeout=0.1)
+
+    def commit_from_other_connection(statement):
+        # Ingest commits while the old comments are being read
+        if statement.startswith('INSERT OR IGNORE INTO archived_ids'):
+            with ingest:
+                ingest.execute("INSERT OR IGNORE INTO comments (comment_id, comment, comment_epoch) VALUES (?, ?, ?)",
+                               ('new', 'Barclays', int(time.time()) - 60))
+
+    database_manager.conn.set_trace_callback(commit_from_other_connection)
+    assert database_manager.archive_comments(retention_days=90, vacuum=False) == 10
+    database_manager.conn.set_trace_callback(None)
+    ingest.close()
+    assert database_manager.conn.execute("SELECT COUNT(*) FROM comments WHERE comment_id LIKE 'old%'").fetchone()[0] == 0
+
+    # The same comments stored and archived again are still read once
+    database_manager.insert_new_comments(old_comments)
+    assert database_manager.archive_comments(retention_days=90, vacuum=False) == 10
+    since = datetime.now() - timedelta(days=365)
+    assert len(database_manager.get_archived_data(since, columns=['firm'])) == 10
+    assert len(database_manager.get_history(since, columns=['firm', 'compound'])) == 11
+    database_manager.close()
+
+
+def test_upgrade_sets_firm_of_older_comments(tmp_path):
+    database_manager = DatabaseManager(str(tmp_path / 'reddit.db'))
+    database_manager.connect()
+    # The comments table as it was before the firm and comment_epoch columns
+    database_manager.conn.execute("""
+    CREATE TABLE comments (comment_id TEXT PRIMARY KEY, post_title TEXT, subreddit TEXT, comment_date TEXT,
+                           comment TEXT, matched_phrase TEXT, upvotes INTEGER)
+    """)
+    comment_date = (datetime.now() - timedelta(hours=1)).strftime('%Y-%m-%d %H:%M:%S')
+    database_manager.conn.executemany("INSERT INTO comments VALUES (?, 'title', 'stocks', ?, ?, ?, 1)",
+                                      [('a', comment_date, 'BoE hikes again', 'BoE'),
+                                       ('b', comment_date, 'barclays app down', 'barclays'),
+                                       ('c', comment_date, 'nothing here', '')])
+    database_manager.conn.commit()
+
+    database_manager.create_raw_table(firm_list_path=os.path.join(os.path.dirname(__file__), 'firms.csv'))
+    firms = dict(database_manager.conn.execute("SELECT comment_id, firm FROM comments"))
+    assert firms == {'a': 'Bank of England', 'b': 'Barclays', 'c': ''}
+    assert list(database_manager.get_data(1, columns=['comment_id'], firms=['Barclays'])['comment_id']) == ['b']
+    database_manager.close()
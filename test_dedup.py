@@ -0,0 +1,17 @@
+from dedup import find_near_duplicates
+
+
+def test_near_duplicates_are_grouped():
+    texts = ['Barclays just cut its savings rate again!!', 'barclays just cut its savings rate again',
+             'Barclays just cut its savings rate again https://bbc.co.uk/news', 'Lloyds app is down for everyone']
+    groups = find_near_duplicates(texts)
+    assert list(groups.counts) == [3, 1]
+    assert list(groups.inverse) == [0, 0, 0, 1]
+
+
+def test_texts_empty_once_normalised_are_not_duplicates():
+    texts = ['🚀🚀🚀', 'https://imgur.com/a.png', '!!!', '💀 💀', 'Barclays to the moon', 'barclays to the moon!']
+    groups = find_near_duplicates(texts)
+    assert list(groups.counts) == [1, 1, 1, 1, 2]
+    assert list(groups.representatives) == [0, 1, 2, 3, 4]
+    assert groups.expand(['a', 'b', 'c', 'd', 'e']) == ['a', 'b', 'c', 'd', 'e', 'e']
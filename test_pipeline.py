@@ -0,0 +1,47 @@
+from database import DatabaseManager
+from pipeline import PipelineRunner, Stage
+
+
+def make_stages(calls:dict):
+    def ingest(comment_batches):
+        calls['ingest'] += 1
+        for i in range(3):
+            comment_batches.put([f'run{calls["ingest"]}-{i}'])
+        return {'n_comments': 3}
+
+    def sentiment(comment_batches):
+        calls['sentiment'] += 1
+        for _ in comment_batches:
+            pass
+
+    def report():
+        calls['report'] += 1
+
+    def topics(n_comments):
+        calls['topics'] += 1
+        raise RuntimeError('topic model unavailable')
+
+    return [Stage('ingest', ingest, outputs=('n_comments',), streams=('comment_batches',), resumable=False),
+            Stage('sentiment', sentiment, inputs=('comment_batches',)),
+            Stage('report', report),
+            Stage('topics', topics, inputs=('n_comments',))]
+
+
+def test_failing_stage_does_not_stop_fresh_ingestion(tmp_path):
+    checkpoint_store = DatabaseManager(str(tmp_path / 'reddit.db'))
+    checkpoint_store.connect()
+    checkpoint_store.create_pipeline_tables()
+    calls = {'ingest': 0, 'sentiment': 0, 'report': 0, 'topics': 0}
+    run_ids = []
+    for _ in range(3):
+        runner = PipelineRunner(make_stages(calls), checkpoint_store=checkpoint_store)
+        runner.run()
+        run_ids.append(runner.run_id)
+        assert runner.status['ingest'] == 'complete'
+        assert runner.status['topics'] == 'failed'
+
+    # Each rerun resumed the failed run, but fetched (and scored) new comments again
+    assert len(set(run_ids)) == 1
+    assert calls == {'ingest': 3, 'sentiment': 3, 'report': 1, 'topics': 3}
+    assert runner.status['report'] == 'restored'
+    checkpoint_store.close()
@@ -0,0 +1,41 @@
+from telemetry import MetricsRecorder
+
+
+def make_steps(recorder:MetricsRecorder):
+    @recorder.instrument('batches')
+    def iter_batches(n:int):
+        for i in range(n):
+            yield list(range(10))
+
+    @recorder.instrument('collect')
+    def collect(n:int):
+        return [item for batch in iter_batches(n) for item in batch]
+
+    @recorder.instrument('summarise_many')
+    def summarise_many(texts:list):
+        return [text[:5] for text in texts]
+
+    @recorder.instrument('summarise', items=lambda result: 1)
+    def summarise(text:str):
+        return summarise_many([text])[0]
+
+    return iter_batches, collect, summarise_many, summarise
+
+
+def test_nested_calls_are_left_out_of_totals():
+    recorder = MetricsRecorder()
+    iter_batches, collect, summarise_many, summarise = make_steps(recorder)
+    assert len(collect(3)) == 30
+    summarise('a long comment')
+    summarise_many(['one', 'two'])
+    list(iter_batches(2))
+
+    metrics = recorder.drain()
+    assert sorted((metric['step'], metric['nested']) for metric in metrics) == [
+        ('batches', False), ('batches', True), ('collect', False),
+        ('summarise', False), ('summarise_many', False), ('summarise_many', True)]
+    summary = MetricsRecorder.summarise(metrics)
+    # Each item is counted once, by the outermost call that handled it
+    assert {step: totals['items'] for step, totals in summary.items()} == {
+        'collect': 30, 'summarise': 1, 'summarise_many': 2, 'batches': 20}
+    assert summary['batches']['calls'] == 1
@@ -0,0 +1,59 @@
+import glob
+import gzip
+import json
+
+import requests
+
+from transport import HTTPTransport, REPLAY_TOKEN
+
+ACCESS_TOKEN = 'live-access-token-1234567890'
+REFRESH_TOKEN = 'live-refresh-token-0987654321'
+
+
+def make_response(body:dict)->requests.Response:
+    response = requests.Response()
+    response.status_code = 200
+    response.reason = 'OK'
+    response.headers['Content-Type'] = 'application/json'
+    response._content = json.dumps(body).encode('utf-8')
+    return response
+
+
+def fake_reddit(method, url, *args, **kwargs):
+    if url.endswith('/api/v1/access_token'):
+        return make_response({'access_token': ACCESS_TOKEN, 'refresh_token': REFRESH_TOKEN,
+                              'token_type': 'bearer', 'expires_in': 86400, 'scope': '*'})
+    return make_response({'kind': 'Listing', 'data': {'children': []}})
+
+
+def record_session(store_path):
+    transport = HTTPTransport(mode='record', store_path=str(store_path))
+    token_response = transport.send(fake_reddit, 'POST', 'https://www.reddit.com/api/v1/access_token',
+                                    data={'grant_type': 'client_credentials'})
+    transport.send(fake_reddit, 'GET', 'https://oauth.reddit.com/r/stocks/new', params={'limit': 100})
+    return token_response
+
+
+def test_recorded_store_contains_no_tokens(tmp_path):
+    token_response = record_session(tmp_path)
+    # The live caller still gets the real token
+    assert token_response.json()['access_token'] == ACCESS_TOKEN
+
+    files = glob.glob(str(tmp_path / '**' / '*.json.gz'), recursive=True)
+    assert len(files) == 2
+    for file_path in files:
+        with gzip.open(file_path, 'rt', encoding='utf-8') as f:
+            stored = f.read()
+        assert ACCESS_TOKEN not in stored
+        assert REFRESH_TOKEN not in stored
+
+
+def test_replay_returns_placeholder_token(tmp_path):
+    record_session(tmp_path)
+    transport = HTTPTransport(mode='replay', store_path=str(tmp_path))
+    response = transport.send(fake_reddit, 'POST', 'https://www.reddit.com/api/v1/access_token',
+                              data={'grant_type': 'client_credentials'})
+    body = response.json()
+    assert body['access_token'] == REPLAY_TOKEN
+    assert body['refresh_token'] == REPLAY_TOKEN
+    assert body['token_type'] == 'bearer'
@@ -0,0 +1,163 @@
+import gzip
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+from urllib.parse import urlparse
+
+import requests
+from requests.structures import CaseInsensitiveDict
+
+
+class ReplayMissError(Exception):
+    """Raised in replay mode when a request has no recorded response."""
+
+
+# Fields of OAuth responses that are never written to the store
+SECRET_FIELDS = ('access_token', 'refresh_token', 'id_token')
+# Stored in their place, so a replayed session still gets a well-formed token
+REPLAY_TOKEN = 'replay-token'
+
+
+def redact_secrets(content:str)->str:
+    """content with the values of SECRET_FIELDS in a JSON object replaced by REPLAY_TOKEN."""
+    try:
+        body = json.loads(content)
+    except ValueError:
+        return content
+    if not isinstance(body, dict) or not any(field in body for field in SECRET_FIELDS):
+        return content
+    return json.dumps({key: REPLAY_TOKEN if key in SECRET_FIELDS else value for key, value in body.items()})
+
+
+class ResponseStore:
+    """
+    On-disk store of HTTP responses, one gzipped JSON file per request.
+    Requests are keyed on method, URL, query parameters and body only, so
+    credentials and access tokens never affect (or end up in) the key, and
+    tokens in response bodies are replaced before they are written.
+    """
+    def __init__(self, path:str):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    @staticmethod
+    def request_key(method, url, params=None, data=None, json_body=None):
+        if isinstance(data, dict):
+            data = sorted(data.items())
+        elif isinstance(data, (list, tuple)):
+            data = sorted(data)
+        key = json.dumps([method.upper(), url, sorted((params or {}).items()), data, json_body],
+                         default=str, sort_keys=True)
+        return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+    def _file_path(self, key):
+        return os.path.join(self.path, key[:2], f"{key}.json.gz")
+
+    def get(self, key):
+        """Return the stored entry for key, or None."""
+        try:
+            with gzip.open(self._file_path(key), 'rt', encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def put(self, key, method, url, response):
+        file_path = self._file_path(key)
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        entry = {
+            'method': method.upper(),
+            'url': url,
+            'status_code': response.status_code,
+            'reason': response.reason,
+            'headers': dict(response.headers),
+            'content': redact_secrets(response.content.decode('utf-8', errors='replace')),
+            'recorded_at': time.time()
+        }
+        # Write then rename, so parallel workers never read a partial file
+        tmp_path = f"{file_path}.{threading.get_ident()}.tmp"
+        with gzip.open(tmp_path, 'wt', encoding='utf-8') as f:
+            json.dump(entry, f)
+        os.replace(tmp_path, file_path)
+
+    @staticmethod
+    def to_response(entry):
+        """Rebuild a requests.Response from a stored entry."""
+        response = requests.Response()
+        response.status_code = entry['status_code']
+        response.reason = entry['reason']
+        response.headers = CaseInsensitiveDict(entry['headers'])
+        response._content = entry['content'].encode('utf-8')
+        response.encoding = 'utf-8'
+        response.url = entry['url']
+        return response
+
+
+class HTTPTransport:
+    """
+    Pluggable transport for the Reddit clients of an APIConnection.
+
+    Modes:
+    ------
+    * live: send every request to Reddit (default).
+    * record: send every request and save the response to the store.
+    * replay: serve every response from the store, never touching the
+      network. Requests that were not recorded raise ReplayMissError.
+    * cache: serve listing and comment-tree GETs from the store while they
+      are younger than ttl seconds, otherwise fetch and store them.
+    """
+    MODES = ('live', 'record', 'replay', 'cache')
+    # Listings and comment trees - the responses worth reusing between runs
+    CACHEABLE_PATH_RE = re.compile(r'^/(r/[^/]+/(new|comments)|comments/[^/]+|api/morechildren)')
+
+    def __init__(self, mode:str='live', store_path:str='http_store', ttl:float=300):
+        if mode not in self.MODES:
+            raise ValueError(f"Unknown transport mode '{mode}', expected one of {self.MODES}")
+        self.mode = mode
+        self.ttl = ttl
+        self.store = ResponseStore(store_path) if mode != 'live' else None
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def is_cacheable(self, method, url):
+        return method.upper() == 'GET' and self.CACHEABLE_PATH_RE.match(urlparse(url).path) is not None
+
+    def send(self, send_request, method, url, *args, **kwargs):
+        """Serve a request according to the mode, calling send_request for live requests."""
+        if self.mode == 'live':
+            return send_request(method, url, *args, **kwargs)
+
+        key = self.store.request_key(method, url, kwargs.get('params'), kwargs.get('data'), kwargs.get('json'))
+        if self.mode == 'replay':
+            entry = self.store.get(key)
+            if entry is None:
+                raise ReplayMissError(f"No recorded response for {method.upper()} {url}")
+            self._count(hit=True)
+            return self.store.to_response(entry)
+
+        if self.mode == 'cache' and self.is_cacheable(method, url):
+            entry = self.store.get(key)
+            if entry is not None and time.time() - entry['recorded_at'] <= self.ttl:
+                self._count(hit=True)
+                return self.store.to_response(entry)
+
+        self._count(hit=False)
+        response = send_request(method, url, *args, **kwargs)
+        if self.mode == 'record' or (response.status_code == 200 and self.is_cacheable(method, url)):
+            self.store.put(key, method, url, response)
+        return response
+
+    def _count(self, hit):
+        with self.lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def log_stats(self):
+        if self.mode != 'live':
+            logging.info(f"HTTP transport ({self.mode}): {self.hits} served from store, {self.misses} sent.")